@@ -53,8 +53,16 @@ initial_sampling_rate = 100e3 # in S/s
 initial_duration = 20
 # define a fixed length (in s) for the time axis of viewbox signal vs time
 initial_viewbox_length = 2 # in s
+max_viewbox_length = 10 # in s
 # define a downsampling period for visualization purposes
 initial_downsampling_period = 100
+# min/max envelope display (see envelope_pyramid)
+# the displayed envelope has about 2 points per pixel of the plot, whatever
+# the sampling rate and the time window length
+initial_envelope_display = True
+envelope_max_base_bins = 2**18 # bins of the finest level over max_viewbox_length
+envelope_min_bins = 256 # bins of the coarsest level
+initial_plot_width = 1000 # in pixels, updated by the Frontend
 # initial Y range
 initial_min_y_range = -0.01
 initial_max_y_range = 0.03
@@ -107,6 +115,36 @@ def autocorr(x):
     lag = np.arange(0, corr_coef.size//2+1)
     return z, lag
 
+def ring_buffer_path(x_buffer, y_buffer, write_index, filled):
+    # path through the samples of a circular buffer, oldest first
+    # it is built from the two contiguous segments of the buffer (no copies)
+    if filled:
+        segments = [slice(write_index, None), slice(0, write_index)]
+    else:
+        segments = [slice(0, write_index)]
+    path = None
+    for segment in segments:
+        if x_buffer[segment].size == 0:
+            continue
+        segment_path = pg.arrayToQPath(x_buffer[segment], y_buffer[segment], connect = 'all', finiteCheck = True)
+        if path is None:
+            path = segment_path
+        else:
+            path.connectPath(segment_path)
+    if path is None:
+        path = pg.QtGui.QPainterPath()
+    return path
+
+def chunk_segments(chunk_stats, level_column, sd_column = None, sd_sign = 0):
+    # horizontal segments (one per acquired chunk) at the mean (+/- 3 sigma)
+    # chunk_stats rows are start time, end time and the stats of the chunk
+    x = chunk_stats[:, 0:2].ravel()
+    level = chunk_stats[:, level_column]
+    if sd_column is not None:
+        level = level + sd_sign*3*chunk_stats[:, sd_column] # 3 sigma means 99.73%
+    y = np.repeat(level, 2)
+    return x, y
+
 #=====================================
 
 # Fast Plot Class definition
@@ -114,10 +152,12 @@ def autocorr(x):
 #=====================================
 
 class FastLine(pg.QtGui.QGraphicsPathItem):
-    def __init__(self, x, y, color = 'w'):
+    def __init__(self, x, y, color = 'w', connect = 'all', path = None):
         # from https://stackoverflow.com/questions/17103698/plotting-large-arrays-in-pyqtgraph?rq=1
-        """x and y are 1D arrays"""
-        self.path = pg.arrayToQPath(x, y, connect = 'all', finiteCheck = True)
+        """x and y are 1D arrays, or path is an already built QPainterPath"""
+        if path is None:
+            path = pg.arrayToQPath(x, y, connect = connect, finiteCheck = True)
+        self.path = path
         pg.QtGui.QGraphicsPathItem.__init__(self, self.path)
         self.setPen(pg.mkPen(color))
 
@@ -129,6 +169,113 @@ class FastLine(pg.QtGui.QGraphicsPathItem):
 
 #=====================================
 
+# Envelope Pyramid Class definition
+
+#=====================================
+
+class envelope_pyramid(object):
+    """
+    Min/max envelope of a signal at several resolutions. Level 0 keeps the
+    min and max of every base_bin raw samples and each level above combines
+    two bins of the level below. Every level is a circular buffer covering
+    samples_in_window samples and is updated incrementally as samples
+    arrive, so the envelope of any shorter span is read without touching
+    the raw samples.
+    """
+    def __init__(self, samples_in_window, max_base_bins = envelope_max_base_bins, \
+                 min_bins = envelope_min_bins):
+        self.base_bin = max(1, int(np.ceil(samples_in_window/max_base_bins)))
+        number_of_bins = int(np.ceil(samples_in_window/self.base_bin)) + 1
+        self.levels = []
+        while True:
+            self.levels.append({'min': np.full(number_of_bins, np.nan), \
+                                'max': np.full(number_of_bins, np.nan), \
+                                'start': np.full(number_of_bins, np.nan), \
+                                'write_index': 0, \
+                                'count': 0, \
+                                'carry': None})
+            if number_of_bins <= min_bins:
+                break
+            number_of_bins = number_of_bins//2 + 1
+        # raw samples that do not fill a bin yet
+        self.remainder = np.array([])
+        self.next_sample_index = None
+        return
+
+    def append(self, samples, first_sample_index):
+        # samples are contiguous and first_sample_index is the index of the first one
+        if self.next_sample_index != first_sample_index:
+            # gap in the data, drop the incomplete bin
+            self.remainder = np.array([])
+            remainder_start = first_sample_index
+        else:
+            remainder_start = first_sample_index - self.remainder.size
+        samples = np.concatenate((self.remainder, samples))
+        self.next_sample_index = remainder_start + samples.size
+        number_of_new_bins = samples.size//self.base_bin
+        complete_size = number_of_new_bins*self.base_bin
+        self.remainder = samples[complete_size:]
+        if number_of_new_bins == 0:
+            return
+        binned = samples[:complete_size].reshape(number_of_new_bins, self.base_bin)
+        new_min = binned.min(axis = 1)
+        new_max = binned.max(axis = 1)
+        new_start = remainder_start + np.arange(number_of_new_bins)*self.base_bin
+        for level in self.levels:
+            self.write_level(level, new_min, new_max, new_start)
+            # pairs of bins for the next level
+            if level['carry'] is not None:
+                carry_min, carry_max, carry_start = level['carry']
+                new_min = np.concatenate(([carry_min], new_min))
+                new_max = np.concatenate(([carry_max], new_max))
+                new_start = np.concatenate(([carry_start], new_start))
+            if new_min.size % 2 == 1:
+                level['carry'] = (new_min[-1], new_max[-1], new_start[-1])
+                new_min, new_max, new_start = new_min[:-1], new_max[:-1], new_start[:-1]
+            else:
+                level['carry'] = None
+            if new_min.size == 0:
+                break
+            new_min = np.minimum(new_min[0::2], new_min[1::2])
+            new_max = np.maximum(new_max[0::2], new_max[1::2])
+            new_start = new_start[0::2]
+        return
+
+    def write_level(self, level, new_min, new_max, new_start):
+        length = level['min'].size
+        if new_min.size > length:
+            new_min, new_max, new_start = new_min[-length:], new_max[-length:], new_start[-length:]
+        n_new = new_min.size
+        start = level['write_index']
+        n_first = min(n_new, length - start)
+        for key, new_data in (('min', new_min), ('max', new_max), ('start', new_start)):
+            level[key][start:start + n_first] = new_data[:n_first]
+            level[key][:n_new - n_first] = new_data[n_first:]
+        level['write_index'] = (start + n_new) % length
+        level['count'] += n_new
+        return
+
+    def envelope(self, span_samples, max_points, time_base):
+        # x, y arrays of the min/max envelope of the last span_samples samples
+        # using the finest level with no more than max_points/2 bins in the span
+        for k, level in enumerate(self.levels):
+            bin_size = self.base_bin*2**k
+            number_of_bins = int(np.ceil(span_samples/bin_size))
+            if 2*number_of_bins <= max_points:
+                break
+        number_of_bins = min(number_of_bins, level['count'], level['min'].size)
+        end = level['write_index']
+        indexes = np.arange(end - number_of_bins, end) % level['min'].size
+        bin_time = (level['start'][indexes] + bin_size/2)*time_base
+        # each bin is drawn as a vertical segment from its min to its max
+        x = np.repeat(bin_time, 2)
+        y = np.empty(2*number_of_bins)
+        y[0::2] = level['min'][indexes]
+        y[1::2] = level['max'][indexes]
+        return x, y
+
+#=====================================
+
 # Autocorrelation Window definition
 
 #===================================== 
@@ -306,6 +453,11 @@ class DataProcessor(QProcess):
         self.sd_value_monitor = 0
         self.autocorrelation_on = False
         self.autocorr_window = initial_autocorr_time_window
+        self.envelope_display = initial_envelope_display
+        self.apd_pyramid = None
+        self.monitor_pyramid = None
+        self.pyramid_sampling_rate = 0
+        self.plot_width = initial_plot_width
         self.running = False
         self.displayDataTimer = QtCore.QTimer()
         # configure the connection to allow queued executions to avoid interruption of previous calls
@@ -326,29 +478,75 @@ class DataProcessor(QProcess):
         # viewbox_length is in s
         # so multiply by 1000 to obtain the right size of "points_to_be_displayed"
         self.points_to_be_displayed = int(self.viewbox_length*self.sampling_rate*1e3/self.downsampling_period)
-        # data array
-        self.data_apd_array_to_plot = np.empty(self.points_to_be_displayed)
-        self.data_apd_array_to_plot[:] = np.nan
-        # monitor array
-        self.monitor_array_to_plot = np.empty(self.points_to_be_displayed)
-        self.monitor_array_to_plot[:] = np.nan
-        # mean array
-        self.mean_apd_array_to_plot = np.empty(self.points_to_be_displayed)
-        self.mean_apd_array_to_plot[:] = np.nan
-        self.mean_monitor_array_to_plot = np.empty(self.points_to_be_displayed)
-        self.mean_monitor_array_to_plot[:] = np.nan
-        # std dev +/- array
-        self.std_apd_plus_array_to_plot = np.empty(self.points_to_be_displayed)
-        self.std_apd_plus_array_to_plot[:] = np.nan
-        self.std_apd_minus_array_to_plot = np.empty(self.points_to_be_displayed)
-        self.std_apd_minus_array_to_plot[:] = np.nan
-        self.std_monitor_plus_array_to_plot = np.empty(self.points_to_be_displayed)
-        self.std_monitor_plus_array_to_plot[:] = np.nan
-        self.std_monitor_minus_array_to_plot = np.empty(self.points_to_be_displayed)
-        self.std_monitor_minus_array_to_plot[:] = np.nan
-        # time array
-        self.time_array_to_plot = np.empty(self.points_to_be_displayed)
-        self.time_array_to_plot[:] = np.nan
+        self.reset_buffers()
+        # span of the min/max envelope
+        self.samples_in_window = int(self.viewbox_length*self.sampling_rate*1e3)
+        # the pyramids cover max_viewbox_length, so changing the viewbox
+        # keeps their history, only a new sampling rate needs new ones
+        if self.sampling_rate != self.pyramid_sampling_rate:
+            self.reset_pyramids()
+        return
+
+    def reset_buffers(self):
+        # circular buffers (one per channel and one for the time), new samples
+        # are written at write_index, so a refresh only copies the new samples
+        self.time_buffer = np.full(self.points_to_be_displayed, np.nan)
+        self.data_apd_buffer = np.full(self.points_to_be_displayed, np.nan)
+        self.monitor_buffer = np.full(self.points_to_be_displayed, np.nan)
+        self.write_index = 0
+        self.buffer_filled = False
+        # stats of each displayed chunk, to draw the mean and +/- 3 sigma lines
+        # columns: start time, end time, mean apd, sd apd, mean monitor, sd monitor
+        self.chunk_stats = np.empty((0, 6))
+        return
+
+    def reset_pyramids(self):
+        # min/max envelope pyramids of the raw samples
+        max_samples_in_window = int(max_viewbox_length*self.sampling_rate*1e3)
+        self.apd_pyramid = envelope_pyramid(max_samples_in_window)
+        self.monitor_pyramid = envelope_pyramid(max_samples_in_window)
+        self.pyramid_sampling_rate = self.sampling_rate
+        return
+
+    def envelope_item(self, pyramid):
+        # curve of the min/max envelope with about 2 points per pixel
+        x, y = pyramid.envelope(self.samples_in_window, 2*self.plot_width, self.time_base)
+        if x.size == 0:
+            return FastLine(None, None, 'w', path = pg.QtGui.QPainterPath())
+        return FastLine(x, y, 'w')
+
+    def write_to_buffers(self, time_array, data_apd_array, monitor_array):
+        # write the new samples into the circular buffers (with wraparound)
+        buffer_length = self.points_to_be_displayed
+        n_new = time_array.size
+        if n_new >= buffer_length:
+            # only the last samples fit in the buffer
+            self.time_buffer[:] = time_array[-buffer_length:]
+            self.data_apd_buffer[:] = data_apd_array[-buffer_length:]
+            self.monitor_buffer[:] = monitor_array[-buffer_length:]
+            self.write_index = 0
+            self.buffer_filled = True
+            return
+        start = self.write_index
+        n_first = min(n_new, buffer_length - start)
+        n_second = n_new - n_first
+        for buffer, new_data in ((self.time_buffer, time_array), \
+                                 (self.data_apd_buffer, data_apd_array), \
+                                 (self.monitor_buffer, monitor_array)):
+            buffer[start:start + n_first] = new_data[:n_first]
+            buffer[:n_second] = new_data[n_first:]
+        self.write_index = (start + n_new) % buffer_length
+        if start + n_new >= buffer_length:
+            self.buffer_filled = True
+        return
+
+    def append_chunk_stats(self, time_array):
+        # keep the stats of the chunks that are inside the viewbox
+        new_row = np.array([[time_array[0], time_array[-1], \
+                             self.mean_value_apd, self.sd_value_apd, \
+                             self.mean_value_monitor, self.sd_value_monitor]])
+        in_view = self.chunk_stats[:, 1] >= time_array[-1] - self.viewbox_length
+        self.chunk_stats = np.concatenate((self.chunk_stats[in_view], new_row))
         return
 
     @pyqtSlot()
@@ -392,7 +590,11 @@ class DataProcessor(QProcess):
                 if self.autocorrelation_on:
                     self.accum_data_for_autocorr(data_apd_array, n_retrieved_samples)
                 # for visualizing purposes
-                if self.downsampling_period != 1:
+                if self.envelope_display:
+                    # the raw samples only update the min/max envelope pyramids
+                    self.apd_pyramid.append(data_apd_array, start)
+                    self.monitor_pyramid.append(monitor_array, start)
+                elif self.downsampling_period != 1:
                     if self.downsampling_by_average:
                         # crop and resize data for later averaging as downsampling method
                         data_array_length = data_apd_array.size
@@ -418,43 +620,40 @@ class DataProcessor(QProcess):
                         time_array = time_array[::self.downsampling_period]
                         # reshape
                         new_size = data_apd_array.size
-                    n_roll = new_size
+                if time_array.size == 0:
+                    return
+                self.append_chunk_stats(time_array)
+
+                if self.envelope_display:
+                    # prepare objects to plot the min/max envelope
+                    item_raw_apd_data_curve = self.envelope_item(self.apd_pyramid)
+                    item_raw_monitor_data_curve = self.envelope_item(self.monitor_pyramid)
                 else:
-                    # no downsampling or averaging
-                    n_roll = n_retrieved_samples
-                # prepare arrays to queue    
-                self.time_array_to_plot = np.roll(self.time_array_to_plot, -n_roll)
-                self.data_apd_array_to_plot = np.roll(self.data_apd_array_to_plot, -n_roll)
-                self.mean_apd_array_to_plot = np.roll(self.mean_apd_array_to_plot, -n_roll)
-                self.std_apd_plus_array_to_plot = np.roll(self.std_apd_plus_array_to_plot, -n_roll)
-                self.std_apd_minus_array_to_plot = np.roll(self.std_apd_minus_array_to_plot, -n_roll)
-                self.monitor_array_to_plot = np.roll(self.monitor_array_to_plot, -n_roll)
-                self.mean_monitor_array_to_plot = np.roll(self.mean_monitor_array_to_plot, -n_roll)
-                self.std_monitor_plus_array_to_plot = np.roll(self.std_monitor_plus_array_to_plot, -n_roll)
-                self.std_monitor_minus_array_to_plot = np.roll(self.std_monitor_minus_array_to_plot, -n_roll)
-
-                # prepare objects to plot raw data (with or without downsampling)
-                self.time_array_to_plot[-n_roll:] = time_array
-                self.data_apd_array_to_plot[-n_roll:] = data_apd_array
-                self.monitor_array_to_plot[-n_roll:] = monitor_array
-                item_raw_apd_data_curve = FastLine(self.time_array_to_plot, self.data_apd_array_to_plot, 'w')
-                item_raw_monitor_data_curve = FastLine(self.time_array_to_plot, self.monitor_array_to_plot, 'w')
+                    # write the new samples into the circular buffers
+                    self.write_to_buffers(time_array, data_apd_array, monitor_array)
+                    # prepare objects to plot raw data (with or without downsampling)
+                    item_raw_apd_data_curve = FastLine(None, None, 'w', \
+                                                       path = ring_buffer_path(self.time_buffer, self.data_apd_buffer, \
+                                                                               self.write_index, self.buffer_filled))
+                    item_raw_monitor_data_curve = FastLine(None, None, 'w', \
+                                                           path = ring_buffer_path(self.time_buffer, self.monitor_buffer, \
+                                                                                   self.write_index, self.buffer_filled))
                 
-                # prepare objects to plot the mean (using previous arrays)
-                self.mean_apd_array_to_plot[-n_roll:] = self.mean_value_apd
-                item_mean_apd_data_curve = FastLine(self.time_array_to_plot, self.mean_apd_array_to_plot, 'b')
-                self.mean_monitor_array_to_plot[-n_roll:] = self.mean_value_monitor
-                item_mean_monitor_data_curve = FastLine(self.time_array_to_plot, self.mean_monitor_array_to_plot, 'm')
+                # prepare objects to plot the mean, one segment per chunk
+                x, y = chunk_segments(self.chunk_stats, 2)
+                item_mean_apd_data_curve = FastLine(x, y, 'b', connect = 'pairs')
+                x, y = chunk_segments(self.chunk_stats, 4)
+                item_mean_monitor_data_curve = FastLine(x, y, 'm', connect = 'pairs')
                 
-                # prepare objects to plot the std dev (using previous arrays)
-                self.std_apd_plus_array_to_plot[-n_roll:] = self.mean_value_apd + 3*self.sd_value_apd # 3 sigma means 99.73%
-                self.std_apd_minus_array_to_plot[-n_roll:] = self.mean_value_apd - 3*self.sd_value_apd # 3 sigma means 99.73%
-                item_std_apd_plus_data_curve = FastLine(self.time_array_to_plot, self.std_apd_plus_array_to_plot, 'g')
-                item_std_apd_minus_data_curve = FastLine(self.time_array_to_plot, self.std_apd_minus_array_to_plot, 'g')
-                self.std_monitor_plus_array_to_plot[-n_roll:] = self.mean_value_monitor + 3*self.sd_value_monitor # 3 sigma means 99.73%
-                self.std_monitor_minus_array_to_plot[-n_roll:] = self.mean_value_monitor - 3*self.sd_value_monitor # 3 sigma means 99.73%
-                item_std_monitor_plus_data_curve = FastLine(self.time_array_to_plot, self.std_monitor_plus_array_to_plot, 'y')
-                item_std_monitor_minus_data_curve = FastLine(self.time_array_to_plot, self.std_monitor_minus_array_to_plot, 'y')
+                # prepare objects to plot the std dev, one segment per chunk
+                x, y = chunk_segments(self.chunk_stats, 2, 3, +1)
+                item_std_apd_plus_data_curve = FastLine(x, y, 'g', connect = 'pairs')
+                x, y = chunk_segments(self.chunk_stats, 2, 3, -1)
+                item_std_apd_minus_data_curve = FastLine(x, y, 'g', connect = 'pairs')
+                x, y = chunk_segments(self.chunk_stats, 4, 5, +1)
+                item_std_monitor_plus_data_curve = FastLine(x, y, 'y', connect = 'pairs')
+                x, y = chunk_segments(self.chunk_stats, 4, 5, -1)
+                item_std_monitor_minus_data_curve = FastLine(x, y, 'y', connect = 'pairs')
 
                 # send data using signal
                 self.dataReadySignal.emit(time_array, item_raw_apd_data_curve, item_mean_apd_data_curve, \
@@ -498,9 +697,27 @@ class DataProcessor(QProcess):
         self.autocorr_window = new_window
         return
 
+    @pyqtSlot(bool)
+    def enable_envelope(self, enablebool):
+        self.envelope_display = enablebool
+        print('Min/max envelope display:', enablebool)
+        # the mode that was off has not been fed, drop its stale data
+        if self.apd_pyramid is not None:
+            self.reset_buffers()
+            self.reset_pyramids()
+        return
+
+    @pyqtSlot(int)
+    def plot_width_changed(self, plot_width):
+        self.plot_width = max(plot_width, 100)
+        return
+
     @pyqtSlot(bool)
     def start_stop(self, run):
         if run:
+            # a new acquisition restarts the sample count
+            if self.apd_pyramid is not None:
+                self.reset_pyramids()
             self.running = True
             self.displayDataTimer.start()
         else:
@@ -516,6 +733,8 @@ class DataProcessor(QProcess):
         frontend.startAutocorrSignal.connect(self.start_autocorr)
         frontend.stopAutocorrSignal.connect(self.stop_autocorr)
         frontend.autocorrWindowChangedSignal.connect(self.autocorr_window_changed)
+        frontend.envelopeSignal.connect(self.enable_envelope)
+        frontend.plotWidthSignal.connect(self.plot_width_changed)
         return
 
 #=====================================
@@ -545,6 +764,8 @@ class Frontend(QtGui.QFrame):
     startAutocorrSignal = pyqtSignal()
     stopAutocorrSignal = pyqtSignal()
     autocorrWindowChangedSignal = pyqtSignal(float)
+    envelopeSignal = pyqtSignal(bool)
+    plotWidthSignal = pyqtSignal(int)
 
     def __init__(self, enable_connection_to_laser_module = False, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -746,12 +967,19 @@ class Frontend(QtGui.QFrame):
         self.enableAveragingTickBox.stateChanged.connect(self.enable_averaging)
         self.enableAveragingTickBox.setToolTip('Set/Tick to enable downsampling using averaging instead of reduced sampling rate.')
 
+        # min/max envelope
+        self.enableEnvelopeTickBox = QtGui.QCheckBox('Min/max envelope')
+        self.enableEnvelopeTickBox.setChecked(initial_envelope_display)
+        self.enableEnvelopeTickBox.stateChanged.connect(self.enable_envelope)
+        self.enableEnvelopeTickBox.setToolTip('Set/Tick to display the min/max envelope of the raw samples (spikes are never hidden).\nDownsampling/averaging are not used then.')
+        self.plot_width = initial_plot_width
+
         # Time window length
         self.viewbox_length = initial_viewbox_length
         self.timeViewboxLength_label = QtGui.QLabel('Time window length (s): ')
         self.timeViewboxLength_value = QtGui.QLineEdit(str(self.viewbox_length))
         self.timeViewboxLength_value.setFixedWidth(100)
-        self.timeViewboxLength_value.setValidator(QtGui.QDoubleValidator(0.01, 10.0, 2))
+        self.timeViewboxLength_value.setValidator(QtGui.QDoubleValidator(0.01, max_viewbox_length, 2))
         self.timeViewboxLength_value.setToolTip('For displaying purposes. Set the time length of the viewbox in seconds.')
         self.timeViewboxLength_value.editingFinished.connect(self.time_viewbox_length_changed)
 
@@ -853,6 +1081,7 @@ class Frontend(QtGui.QFrame):
         subgridDisp_layout.addWidget(self.enableAveragingTickBox, 7, 2)
         subgridDisp_layout.addWidget(self.timeViewboxLength_label, 8, 0)
         subgridDisp_layout.addWidget(self.timeViewboxLength_value, 8, 1)
+        subgridDisp_layout.addWidget(self.enableEnvelopeTickBox, 8, 2)
         subgridDisp_layout.addWidget(self.effSamplingRateLabel, 9, 0, 1, 3)
         subgridDisp_layout.addWidget(self.autocorr_time_window_label, 10, 0)
         subgridDisp_layout.addWidget(self.autocorr_time_window_value, 10, 1)
@@ -1070,6 +1299,10 @@ class Frontend(QtGui.QFrame):
                                        self.downsampling_period, self.downsampling_by_average)
         return
 
+    def enable_envelope(self, enablebool):
+        self.envelopeSignal.emit(bool(enablebool))
+        return
+
     def set_y_range(self):
         self.signal_plot.setYRange(float(self.minYRangeValue_apd.text()), 
                                    float(self.maxYRangeValue_apd.text()))
@@ -1142,6 +1375,11 @@ class Frontend(QtGui.QFrame):
         self.monitor_plot.addItem(item_std_monitor_plus_data_curve, skipFiniteCheck = False)
         self.monitor_plot.addItem(item_std_monitor_minus_data_curve, skipFiniteCheck = False)
         
+        # the envelope is computed for the width of the plot
+        plot_width = int(self.signal_plot.getViewBox().width())
+        if plot_width != self.plot_width:
+            self.plot_width = plot_width
+            self.plotWidthSignal.emit(plot_width)
         # set range and fix rolling window length
         x_viewbox = time_array[-1]
         self.signal_plot.setXRange(x_viewbox - self.viewbox_length, x_viewbox)
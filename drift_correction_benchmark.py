@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the localization estimators of drift_correction_toolbox
+using synthetic pco-like frames (no microscope needed).
+
+Frames contain Gaussian fiducials that follow a known sub-pixel drift
+trajectory, with Poisson (shot) noise, background and camera read noise,
+for the binnings/pixel sizes used in xy_stabilization_GUI_v2.
+For every estimator it reports the latency of each call (percentiles) and
+the localization error against the ground truth.
+Results are printed and saved as a JSON file to compare versions.
+
+Usage:
+    python drift_correction_benchmark.py
+    python drift_correction_benchmark.py --frames 500 --binning 4 --output bench.json
+"""
+
+import os
+import sys
+import json
+import time as tm
+import platform
+import argparse
+import numpy as np
+import scipy
+from timeit import default_timer as timer
+import drift_correction_toolbox as drift
+
+#=====================================
+
+# Parameters
+
+#=====================================
+
+# pixel size at the sample plane without binning, in nm
+# (see xy_stabilization_GUI_v2: 260 nm with 4x4 binning)
+unbinned_pixel_size = 65 # in nm
+binning_options = [1, 2, 4] # binnings allowed in xy_stabilization_GUI_v2
+# ROI size of the fiducials, in nm (11 pixels with 4x4 binning as in xy_stabilization_GUI_v2)
+box_size_nm = 11*260
+# field of view, in nm (512 pixels without binning)
+field_of_view_nm = 512*unbinned_pixel_size
+# fiducial (1/e^2 radius of the PSF), in nm
+w0_nm = 350
+# photons collected from each fiducial per frame
+photons_per_fiducial = 20000
+# background photons per unbinned pixel per frame
+background_photons = 10
+# pco.edge-like camera
+read_noise_electrons = 1.5 # rms per unbinned pixel
+conversion_factor = 0.46 # electrons per count
+camera_offset = 100 # counts
+# drift trajectory
+drift_velocity_nm = np.array([1.5, -1.0]) # nm per frame
+drift_oscillation_nm = np.array([20.0, 15.0]) # amplitude in nm
+drift_oscillation_period = 50 # in frames
+drift_random_walk_nm = 1.0 # rms step in nm
+# threshold used by the confocal estimators (fraction of the normalized intensity)
+confocal_threshold = 0.3
+percentiles = [50, 90, 95, 99]
+
+#=====================================
+
+# Functions definition
+
+#=====================================
+
+def drift_trajectory(number_of_frames, rng):
+    # known drift, in nm, shape (number_of_frames, 2)
+    # linear drift + oscillation + random walk
+    frames = np.arange(number_of_frames)[:, None]
+    trajectory = drift_velocity_nm*frames + \
+                 drift_oscillation_nm*np.sin(2*np.pi*frames/drift_oscillation_period)
+    steps = rng.normal(0, drift_random_walk_nm, (number_of_frames, 2))
+    steps[0] = 0
+    trajectory += np.cumsum(steps, axis = 0)
+    return trajectory
+
+def simulate_frames(binning, number_of_frames, number_of_fiducials, rng):
+    # returns uint16 frames, the true centers (frame, fiducial, axis) in pixels,
+    # and the ROI limits (x1, x2, y1, y2) of each fiducial
+    pixel_size = unbinned_pixel_size*binning
+    number_of_pixels = int(field_of_view_nm/pixel_size)
+    box_size = int(box_size_nm/pixel_size) | 1 # always odd number of pixels
+    w0 = w0_nm/pixel_size
+    # fiducials on a grid with random sub-pixel offsets
+    # keep them away from the borders so the drift does not take them out of the frame
+    grid_size = int(np.ceil(np.sqrt(number_of_fiducials)))
+    grid = np.linspace(0.2, 0.8, grid_size)*number_of_pixels
+    initial_centers = np.array([(grid[i // grid_size], grid[i % grid_size]) \
+                                for i in range(number_of_fiducials)])
+    initial_centers += rng.uniform(-0.5, 0.5, initial_centers.shape)
+    trajectory = drift_trajectory(number_of_frames, rng)/pixel_size
+    centers = initial_centers[None, :, :] + trajectory[:, None, :]
+    # ROIs are fixed (as when locking), centered on the initial positions
+    rois = []
+    for x0, y0 in np.round(initial_centers).astype(int):
+        rois.append((x0 - box_size//2, x0 + box_size//2 + 1, y0 - box_size//2, y0 + box_size//2 + 1))
+    # expected photons: pixels are evaluated at their centers (integer coordinates)
+    # binned pixels collect binning^2 times more background
+    axis = np.arange(number_of_pixels)
+    background = background_photons*binning**2
+    peak_photons = photons_per_fiducial*2/(np.pi*w0**2)
+    read_noise = read_noise_electrons*binning
+    frames = np.empty((number_of_frames, number_of_pixels, number_of_pixels), dtype = np.uint16)
+    for k in range(number_of_frames):
+        expected = np.full((number_of_pixels, number_of_pixels), float(background))
+        for x0, y0 in centers[k]:
+            profile_x = np.exp(-2*((axis - x0)/w0)**2)
+            profile_y = np.exp(-2*((axis - y0)/w0)**2)
+            expected += peak_photons*np.outer(profile_x, profile_y)
+        electrons = rng.poisson(expected) + rng.normal(0, read_noise, expected.shape)
+        counts = np.round(electrons/conversion_factor + camera_offset)
+        frames[k] = np.clip(counts, 0, 2**16 - 1)
+    return frames, centers, rois
+
+def roi_coordinates(roi):
+    # same layout as the coordinates sent by the xy GUI: (2, nx, ny) absolute pixels
+    x1, x2, y1, y2 = roi
+    return np.array(np.meshgrid(np.arange(x1, x2), np.arange(y1, y2), indexing = 'ij'))
+
+def latency_stats(latencies_us):
+    latencies_us = np.asarray(latencies_us)
+    stats = {'calls': int(latencies_us.size), \
+             'mean_us': float(np.mean(latencies_us)), \
+             'max_us': float(np.max(latencies_us))}
+    for p in percentiles:
+        stats['p%d_us' % p] = float(np.percentile(latencies_us, p))
+    return stats
+
+def error_stats(errors_nm):
+    # errors_nm has shape (..., 2), estimated minus true position
+    errors_nm = np.asarray(errors_nm).reshape(-1, 2)
+    valid = np.all(np.isfinite(errors_nm), axis = 1)
+    errors_nm = errors_nm[valid]
+    if errors_nm.size == 0:
+        return {'valid_fraction': 0.0}
+    distance = np.hypot(errors_nm[:, 0], errors_nm[:, 1])
+    stats = {'valid_fraction': float(np.mean(valid)), \
+             'bias_x_nm': float(np.mean(errors_nm[:, 0])), \
+             'bias_y_nm': float(np.mean(errors_nm[:, 1])), \
+             'std_x_nm': float(np.std(errors_nm[:, 0])), \
+             'std_y_nm': float(np.std(errors_nm[:, 1])), \
+             'rms_nm': float(np.sqrt(np.mean(distance**2))), \
+             'p95_nm': float(np.percentile(distance, 95)), \
+             'max_nm': float(np.max(distance))}
+    return stats
+
+def benchmark_per_roi(localize, frames, centers, rois, pixel_size, warm_start = False):
+    # estimators of the xy GUI, called once per fiducial per frame
+    # they return positions in um
+    number_of_frames, number_of_fiducials = centers.shape[:2]
+    coordinates = [roi_coordinates(roi) for roi in rois]
+    fit_states = [drift.prepare_fit_state(c) for c in coordinates]
+    latencies = np.zeros((number_of_frames, number_of_fiducials))
+    errors = np.zeros((number_of_frames, number_of_fiducials, 2))
+    for k in range(number_of_frames):
+        for i, (x1, x2, y1, y2) in enumerate(rois):
+            frame_intensity = frames[k, x1:x2, y1:y2]
+            start_time = timer()
+            if warm_start:
+                x, y, _, _ = localize(frame_intensity, coordinates[i], pixel_size, pixel_size, \
+                                      fit_state = fit_states[i])
+            else:
+                x, y, _, _ = localize(frame_intensity, coordinates[i], pixel_size, pixel_size)
+            latencies[k, i] = timer() - start_time
+            errors[k, i] = np.array([x, y])*1000 - centers[k, i]*pixel_size
+    return latencies*1e6, errors
+
+def benchmark_batch(frames, centers, rois, pixel_size):
+    # batched Gaussian fit, one call per frame for all fiducials
+    number_of_frames = centers.shape[0]
+    coordinates = [roi_coordinates(roi) for roi in rois]
+    fit_states = [drift.prepare_fit_state(c) for c in coordinates]
+    latencies = np.zeros(number_of_frames)
+    errors = np.zeros(centers.shape)
+    for k in range(number_of_frames):
+        frames_intensity = [frames[k, x1:x2, y1:y2] for x1, x2, y1, y2 in rois]
+        start_time = timer()
+        x, y, _, _ = drift.fit_with_gaussian_batch(frames_intensity, coordinates, \
+                                                   pixel_size, pixel_size, fit_states = fit_states)
+        latencies[k] = timer() - start_time
+        errors[k] = np.stack((x, y), axis = 1)*1000 - centers[k]*pixel_size
+    return latencies*1e6, errors
+
+def benchmark_confocal(estimator, frames, centers, rois, pixel_size):
+    # confocal estimators work in pixels of the given image and return
+    # the column (x) and the row (y) position
+    number_of_frames, number_of_fiducials = centers.shape[:2]
+    latencies = np.zeros((number_of_frames, number_of_fiducials))
+    errors = np.zeros((number_of_frames, number_of_fiducials, 2))
+    for k in range(number_of_frames):
+        for i, (x1, x2, y1, y2) in enumerate(rois):
+            image = frames[k, x1:x2, y1:y2].astype(float)
+            start_time = timer()
+            if estimator == 'fit_with_gaussian_confocal':
+                col, row = drift.fit_with_gaussian_confocal(image, np.arange(y2 - y1), \
+                                                            np.arange(x2 - x1), confocal_threshold)
+            else:
+                col, row = drift.meas_center_of_mass_confocal(image, confocal_threshold)
+            latencies[k, i] = timer() - start_time
+            errors[k, i] = (np.array([row + x1, col + y1]) - centers[k, i])*pixel_size
+    return latencies*1e6, errors
+
+def benchmark_cross_correlation(frames, centers, rois, pixel_size):
+    # registration of the region covering all ROIs against the first frame
+    # compared with the true displacement of the fiducials
+    x1 = min(roi[0] for roi in rois)
+    x2 = max(roi[1] for roi in rois)
+    y1 = min(roi[2] for roi in rois)
+    y2 = max(roi[3] for roi in rois)
+    tracker = drift.cross_correlation_tracker(frames[0, x1:x2, y1:y2])
+    true_shifts = np.mean(centers - centers[0], axis = 1)
+    number_of_frames = centers.shape[0]
+    latencies = np.zeros(number_of_frames)
+    errors = np.zeros((number_of_frames, 2))
+    for k in range(number_of_frames):
+        start_time = timer()
+        shift = tracker.measure_shift(frames[k, x1:x2, y1:y2])
+        latencies[k] = timer() - start_time
+        errors[k] = (np.array(shift) - true_shifts[k])*pixel_size
+    return latencies*1e6, errors
+
+def run_benchmark(binnings = binning_options, number_of_frames = 200, number_of_fiducials = 8, seed = 0):
+    results = {'metadata': {'date': tm.strftime('%Y-%m-%d %H:%M:%S'), \
+                            'python': sys.version.split()[0], \
+                            'numpy': np.__version__, \
+                            'scipy': scipy.__version__, \
+                            'platform': platform.platform(), \
+                            'processor': platform.processor(), \
+                            'seed': seed, \
+                            'number_of_frames': number_of_frames, \
+                            'number_of_fiducials': number_of_fiducials, \
+                            'w0_nm': w0_nm, \
+                            'photons_per_fiducial': photons_per_fiducial, \
+                            'background_photons': background_photons, \
+                            'read_noise_electrons': read_noise_electrons, \
+                            'confocal_threshold': confocal_threshold}, \
+               'results': []}
+    for binning in binnings:
+        pixel_size = unbinned_pixel_size*binning
+        rng = np.random.default_rng(seed)
+        print('\nBinning {}x{} ({} nm pixels): simulating {} frames...'.format(binning, binning, \
+                                                                           pixel_size, number_of_frames))
+        frames, centers, rois = simulate_frames(binning, number_of_frames, number_of_fiducials, rng)
+        estimators = {}
+        estimators['fit_with_gaussian'] = \
+            benchmark_per_roi(drift.fit_with_gaussian, frames, centers, rois, pixel_size)
+        estimators['fit_with_gaussian (warm start)'] = \
+            benchmark_per_roi(drift.fit_with_gaussian, frames, centers, rois, pixel_size, warm_start = True)
+        estimators['fit_with_gaussian_batch (all fiducials)'] = \
+            benchmark_batch(frames, centers, rois, pixel_size)
+        estimators['localize_with_radial_symmetry'] = \
+            benchmark_per_roi(drift.localize_with_radial_symmetry, frames, centers, rois, pixel_size)
+        estimators['localize_with_phasor'] = \
+            benchmark_per_roi(drift.localize_with_phasor, frames, centers, rois, pixel_size)
+        estimators['fit_with_gaussian_confocal'] = \
+            benchmark_confocal('fit_with_gaussian_confocal', frames, centers, rois, pixel_size)
+        estimators['meas_center_of_mass_confocal'] = \
+            benchmark_confocal('meas_center_of_mass_confocal', frames, centers, rois, pixel_size)
+        estimators['cross_correlation_tracker (relative)'] = \
+            benchmark_cross_correlation(frames, centers, rois, pixel_size)
+        for name, (latencies, errors) in estimators.items():
+            entry = {'estimator': name, \
+                     'binning': binning, \
+                     'pixel_size_nm': pixel_size, \
+                     'roi_size_pixels': int(rois[0][1] - rois[0][0]), \
+                     'latency': latency_stats(latencies), \
+                     'error': error_stats(errors)}
+            results['results'].append(entry)
+            print('{:<42s} p50 {:9.1f} us | p99 {:9.1f} us | rms error {:7.2f} nm'.format(name, \
+                  entry['latency']['p50_us'], entry['latency']['p99_us'], entry['error'].get('rms_nm', np.nan)))
+    return results
+
+#=====================================
+
+# Main program
+
+#=====================================
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Benchmark of the drift_correction_toolbox estimators.')
+    parser.add_argument('--frames', type = int, default = 200, help = 'number of frames per binning')
+    parser.add_argument('--fiducials', type = int, default = 8, help = 'number of fiducials')
+    parser.add_argument('--binning', type = int, nargs = '+', default = binning_options, \
+                        choices = binning_options, help = 'binnings to test')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the random generator')
+    parser.add_argument('--output', type = str, default = 'drift_correction_benchmark.json', \
+                        help = 'JSON file to save the results')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.binning, args.frames, args.fiducials, args.seed)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent = 2)
+    print('\nResults saved to %s' % os.path.abspath(args.output))
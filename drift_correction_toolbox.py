@@ -13,6 +13,9 @@ import scipy.optimize as opt
 from scipy import ndimage
 import matplotlib.pyplot as plt
 import os
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import fiducial_fitting_worker as fitting_worker
 from PIL import Image
 from timeit import default_timer as timer
 
@@ -34,15 +37,36 @@ def gaussian_2D(xy_tuple, amplitude, xo, yo, w0_x, w0_y, offset):
     g = offset + amplitude*np.exp( -2*( ((x-xo)/w0_x)**2 + ((y-yo)/w0_y)**2 ) )
     return g.ravel()
 
-def fit_with_gaussian(frame_intensity, frame_coordinates, pixel_size_x_nm, pixel_size_y_nm):
+def prepare_fit_state(frame_coordinates):
+    # precompute everything that does not change between successive fits of the
+    # same ROI: flattened coordinates and bounds
+    # 'popt' stores the last solution (pixels, normalized intensity) to warm-start the next fit
+    x = np.asarray(frame_coordinates[0, :, :], dtype = float).ravel()
+    y = np.asarray(frame_coordinates[1, :, :], dtype = float).ravel()
+    fit_state = {}
+    fit_state['x'] = x
+    fit_state['y'] = y
+    fit_state['lower_bounds'] = np.array([0, np.min(x), np.min(y), 0, 0, 0])
+    fit_state['upper_bounds'] = np.array([1, np.max(x), np.max(y), 100, 100, 1])
+    fit_state['popt'] = None
+    # quality of the last fit: fitted amplitude over the rms of the residuals
+    fit_state['snr'] = np.nan
+    return fit_state
+
+def fit_with_gaussian(frame_intensity, frame_coordinates, pixel_size_x_nm, pixel_size_y_nm, \
+                      fit_state = None):
     # pixel_size should be in nm
+    # if a fit_state (see prepare_fit_state) is given, its precomputed grids and
+    # bounds are used, the fit starts from its last solution and the new one is stored
     # now, convert to um
     pixel_size_x_um = pixel_size_x_nm/1000
     pixel_size_y_um = pixel_size_y_nm/1000
     # image parameters
     number_of_pixels_x, number_of_pixels_y = frame_intensity.shape
-    x = frame_coordinates[0, :, :]
-    y = frame_coordinates[1, :, :]
+    if fit_state is None:
+        fit_state = prepare_fit_state(frame_coordinates)
+    x = fit_state['x']
+    y = fit_state['y']
     # normalize
     frame_min = np.min(frame_intensity)
     frame_max = np.max(frame_intensity)
@@ -52,15 +76,18 @@ def fit_with_gaussian(frame_intensity, frame_coordinates, pixel_size_x_nm, pixel
     ############ perform fitting ############
     # spatial coordinates are in term of pixels at this point
     # initial parameters to fit amplitude, xo, yo, wx, wy, offset
-    x_coord_max, y_coord_max = np.unravel_index(np.argmax(frame_intensity, axis = None), \
-                                                frame_intensity.shape)
-    x_coord_max += np.min(x)
-    y_coord_max += np.min(y)
-    initial_guess = [0.9, x_coord_max, y_coord_max, 5, 5, 0.1]
+    if fit_state['popt'] is None:
+        index_max = np.argmax(frame_intensity, axis = None)
+        initial_guess = [0.9, x[index_max], y[index_max], 5, 5, 0.1]
+    else:
+        initial_guess = fit_state['popt']
     # set bounds
-    all_bounds = ([0, np.min(x), np.min(y), 0, 0, 0], [1, np.max(x), np.max(y), 100, 100, 1])
+    all_bounds = (fit_state['lower_bounds'], fit_state['upper_bounds'])
     # start_time = timer()
     popt, pcov = opt.curve_fit(gaussian_2D, (x, y), data, p0 = initial_guess, bounds = all_bounds)
+    fit_state['popt'] = popt
+    residuals_rms = np.sqrt(np.mean((data - gaussian_2D((x, y), *popt))**2))
+    fit_state['snr'] = popt[0]/max(residuals_rms, np.finfo(float).tiny)
     # end_time = timer()
     # print(end_time - start_time)
     # retrieve parameters
@@ -93,6 +120,243 @@ def fit_with_gaussian(frame_intensity, frame_coordinates, pixel_size_x_nm, pixel
     # returning in um as it was multiplied by the pixel size
     return x_fitted, y_fitted, w0x_fitted, w0y_fitted
 
+def gaussian_2D_and_jacobian(x, y, params):
+    # batched version of gaussian_2D
+    # x, y have shape (N, P) and params has shape (N, 6)
+    # returns the model (N, P) and its analytic jacobian (N, P, 6)
+    amplitude, xo, yo, w0_x, w0_y, offset = [params[:, [k]] for k in range(6)]
+    dx = x - xo
+    dy = y - yo
+    exponential = np.exp( -2*( (dx/w0_x)**2 + (dy/w0_y)**2 ) )
+    amp_exp = amplitude*exponential
+    model = offset + amp_exp
+    jacobian = np.empty(x.shape + (6,))
+    jacobian[:, :, 0] = exponential
+    jacobian[:, :, 1] = 4*amp_exp*dx/w0_x**2
+    jacobian[:, :, 2] = 4*amp_exp*dy/w0_y**2
+    jacobian[:, :, 3] = 4*amp_exp*dx**2/w0_x**3
+    jacobian[:, :, 4] = 4*amp_exp*dy**2/w0_y**3
+    jacobian[:, :, 5] = 1
+    return model, jacobian
+
+def fit_with_gaussian_batch(frames_intensity, frames_coordinates, pixel_size_x_nm, pixel_size_y_nm, \
+                            max_iterations = 50, tolerance = 1e-8, fit_states = None):
+    # fit N fiducials at once with a vectorized Levenberg-Marquardt solver
+    # frames_intensity has shape (N, nx, ny), frames_coordinates has shape (N, 2, nx, ny)
+    # all ROIs must have the same size
+    # same model, normalization, initial guess and bounds as fit_with_gaussian
+    # fit_states is an optional list of N prepare_fit_state dicts, used as in fit_with_gaussian
+    # pixel_size should be in nm
+    # now, convert to um
+    pixel_size_x_um = pixel_size_x_nm/1000
+    pixel_size_y_um = pixel_size_y_nm/1000
+    frames_intensity = np.asarray(frames_intensity, dtype = float)
+    number_of_frames = frames_intensity.shape[0]
+    if fit_states is None:
+        fit_states = [prepare_fit_state(frame_coordinates) for frame_coordinates in frames_coordinates]
+    # flatten the spatial dimensions
+    data = frames_intensity.reshape(number_of_frames, -1)
+    x = np.array([fit_state['x'] for fit_state in fit_states])
+    y = np.array([fit_state['y'] for fit_state in fit_states])
+    # normalize each frame
+    frame_min = np.min(data, axis = 1, keepdims = True)
+    frame_max = np.max(data, axis = 1, keepdims = True)
+    data = ( data - frame_min ) / ( frame_max - frame_min )
+    ############ perform fitting ############
+    # spatial coordinates are in term of pixels at this point
+    # initial parameters to fit amplitude, xo, yo, wx, wy, offset
+    index_max = np.argmax(data, axis = 1)
+    params = np.zeros((number_of_frames, 6))
+    params[:, 0] = 0.9
+    params[:, 1] = x[np.arange(number_of_frames), index_max]
+    params[:, 2] = y[np.arange(number_of_frames), index_max]
+    params[:, 3] = 5
+    params[:, 4] = 5
+    params[:, 5] = 0.1
+    # warm start from the previous solutions, if any
+    for i, fit_state in enumerate(fit_states):
+        if fit_state['popt'] is not None:
+            params[i] = fit_state['popt']
+    # set bounds, widths are kept away from zero to avoid dividing by zero
+    lower_bounds = np.array([fit_state['lower_bounds'] for fit_state in fit_states])
+    upper_bounds = np.array([fit_state['upper_bounds'] for fit_state in fit_states])
+    lower_bounds[:, 3:5] = np.maximum(lower_bounds[:, 3:5], 1e-3)
+    params = np.clip(params, lower_bounds, upper_bounds)
+    # Levenberg-Marquardt iterations, one damping factor per fiducial
+    model, jacobian = gaussian_2D_and_jacobian(x, y, params)
+    residuals = data - model
+    cost = np.sum(residuals**2, axis = 1)
+    damping = np.full(number_of_frames, 1e-3)
+    active = np.ones(number_of_frames, dtype = bool)
+    identity = np.eye(6)
+    for _ in range(max_iterations):
+        JtJ = np.einsum('npi,npj->nij', jacobian, jacobian)
+        Jtr = np.einsum('npi,np->ni', jacobian, residuals)
+        # parameters sitting on a bound and pushed outwards are kept fixed
+        fixed = ((params <= lower_bounds) & (Jtr < 0)) | ((params >= upper_bounds) & (Jtr > 0))
+        free = ~fixed
+        JtJ = JtJ*free[:, :, None]*free[:, None, :] + fixed[:, :, None]*identity
+        Jtr = Jtr*free
+        diagonal = np.einsum('nii->ni', JtJ)
+        damped = JtJ + damping[:, None, None]*diagonal[:, :, None]*identity
+        # guard against singular matrices (e.g. flat ROIs)
+        damped += 1e-12*identity
+        step = np.linalg.solve(damped, Jtr[:, :, None])[:, :, 0]
+        new_params = params + step
+        # widths can at most halve or double per iteration, otherwise a step
+        # from a too wide initial guess may collapse them onto a flat model
+        # (zero gradient) with narrow spots, e.g. 4x4 binning
+        new_params[:, 3:5] = np.clip(new_params[:, 3:5], params[:, 3:5]/2, params[:, 3:5]*2)
+        new_params = np.clip(new_params, lower_bounds, upper_bounds)
+        new_model, new_jacobian = gaussian_2D_and_jacobian(x, y, new_params)
+        new_residuals = data - new_model
+        new_cost = np.sum(new_residuals**2, axis = 1)
+        improved = (new_cost < cost) & active
+        relative_change = np.abs(cost - new_cost)/np.maximum(cost, np.finfo(float).tiny)
+        # accept the step and relax damping where the cost decreased
+        params[improved] = new_params[improved]
+        jacobian[improved] = new_jacobian[improved]
+        residuals[improved] = new_residuals[improved]
+        cost[improved] = new_cost[improved]
+        damping = np.where(improved, damping/10, damping*10)
+        # a fiducial is done when the cost does not change anymore
+        # or when no step can decrease it
+        converged = (relative_change < tolerance) | (damping > 1e10)
+        active &= ~converged
+        if not np.any(active):
+            break
+    # store solutions for the next warm start and the quality of the fits
+    residuals_rms = np.maximum(np.sqrt(cost/data.shape[1]), np.finfo(float).tiny)
+    for i, fit_state in enumerate(fit_states):
+        fit_state['popt'] = params[i].copy()
+        fit_state['snr'] = params[i, 0]/residuals_rms[i]
+    # retrieve parameters
+    # map to sample size
+    x_fitted = params[:, 1]*pixel_size_x_um
+    y_fitted = params[:, 2]*pixel_size_y_um
+    w0x_fitted = params[:, 3]*pixel_size_x_um
+    w0y_fitted = params[:, 4]*pixel_size_y_um
+    # returning in um as it was multiplied by the pixel size
+    return x_fitted, y_fitted, w0x_fitted, w0y_fitted
+
+def localize_with_radial_symmetry(frame_intensity, frame_coordinates, pixel_size_x_nm, pixel_size_y_nm):
+    # non-iterative localization based on the radial symmetry of the spot
+    # see R. Parthasarathy, Nature Methods 9, 724 (2012)
+    # same inputs and outputs as fit_with_gaussian, widths are not estimated (NaN)
+    # pixel_size should be in nm
+    # now, convert to um
+    pixel_size_x_um = pixel_size_x_nm/1000
+    pixel_size_y_um = pixel_size_y_nm/1000
+    frame_intensity = np.asarray(frame_intensity, dtype = float)
+    number_of_pixels_x, number_of_pixels_y = frame_intensity.shape
+    # coordinates of the midpoints between pixels, relative to the ROI center
+    # first index is x, second index is y (same as frame_coordinates)
+    xm = np.arange(number_of_pixels_x - 1) - (number_of_pixels_x - 2)/2
+    ym = np.arange(number_of_pixels_y - 1) - (number_of_pixels_y - 2)/2
+    xm, ym = np.meshgrid(xm, ym, indexing = 'ij')
+    # gradients along the diagonals (Roberts cross) and smoothing
+    dI_du = frame_intensity[:-1, 1:] - frame_intensity[1:, :-1]
+    dI_dv = frame_intensity[:-1, :-1] - frame_intensity[1:, 1:]
+    dI_du = ndimage.uniform_filter(dI_du, size = 3)
+    dI_dv = ndimage.uniform_filter(dI_dv, size = 3)
+    gradient_squared = dI_du**2 + dI_dv**2
+    # slope of the gradient line at each midpoint, in the (x, y) frame
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        slope = (dI_dv + dI_du)/(dI_dv - dI_du)
+    slope[np.isnan(slope)] = 0
+    finite = np.isfinite(slope)
+    if not np.any(finite):
+        return np.nan, np.nan, np.nan, np.nan
+    slope[~finite] = 10*np.max(np.abs(slope[finite]))
+    intercept = ym - slope*xm
+    # weight by gradient magnitude and by the distance to the centroid
+    gradient_sum = np.sum(gradient_squared)
+    x_centroid = np.sum(gradient_squared*xm)/gradient_sum
+    y_centroid = np.sum(gradient_squared*ym)/gradient_sum
+    distance = np.sqrt((xm - x_centroid)**2 + (ym - y_centroid)**2)
+    distance[distance == 0] = np.min(distance[distance > 0], initial = 1)
+    weight = gradient_squared/distance/(slope**2 + 1)
+    # least-squares intersection of all gradient lines
+    sw = np.sum(weight)
+    smw = np.sum(slope*weight)
+    smmw = np.sum(slope**2*weight)
+    smbw = np.sum(slope*intercept*weight)
+    sbw = np.sum(intercept*weight)
+    determinant = smw**2 - smmw*sw
+    x_center = (smbw*sw - smw*sbw)/determinant
+    y_center = (smbw*smw - smmw*sbw)/determinant
+    # back to frame coordinates
+    x_center = x_center + (number_of_pixels_x - 1)/2 + frame_coordinates[0, 0, 0]
+    y_center = y_center + (number_of_pixels_y - 1)/2 + frame_coordinates[1, 0, 0]
+    # returning in um as it was multiplied by the pixel size
+    return x_center*pixel_size_x_um, y_center*pixel_size_y_um, np.nan, np.nan
+
+def localize_with_phasor(frame_intensity, frame_coordinates, pixel_size_x_nm, pixel_size_y_nm):
+    # non-iterative localization using the phase of the first Fourier coefficient
+    # see K. J. A. Martens et al., J. Chem. Phys. 148, 123311 (2018)
+    # same inputs and outputs as fit_with_gaussian, widths are not estimated (NaN)
+    # pixel_size should be in nm
+    # now, convert to um
+    pixel_size_x_um = pixel_size_x_nm/1000
+    pixel_size_y_um = pixel_size_y_nm/1000
+    frame_intensity = np.asarray(frame_intensity, dtype = float)
+    number_of_pixels_x, number_of_pixels_y = frame_intensity.shape
+    # first Fourier coefficient of the projections
+    # the constant background only contributes to the zero order
+    profile_x = np.sum(frame_intensity, axis = 1)
+    profile_y = np.sum(frame_intensity, axis = 0)
+    phasor_x = np.sum(profile_x*np.exp(-2j*np.pi*np.arange(number_of_pixels_x)/number_of_pixels_x))
+    phasor_y = np.sum(profile_y*np.exp(-2j*np.pi*np.arange(number_of_pixels_y)/number_of_pixels_y))
+    x_center = np.mod(-np.angle(phasor_x), 2*np.pi)*number_of_pixels_x/(2*np.pi)
+    y_center = np.mod(-np.angle(phasor_y), 2*np.pi)*number_of_pixels_y/(2*np.pi)
+    # back to frame coordinates
+    x_center = x_center + frame_coordinates[0, 0, 0]
+    y_center = y_center + frame_coordinates[1, 0, 0]
+    # returning in um as it was multiplied by the pixel size
+    return x_center*pixel_size_x_um, y_center*pixel_size_y_um, np.nan, np.nan
+
+def fiducial_snr(frame_intensity):
+    # quick signal-to-noise estimate of a fiducial's ROI for the methods
+    # that do not fit a model: peak above the background (median of the border)
+    # over the noise of the border pixels
+    frame_intensity = np.asarray(frame_intensity, dtype = float)
+    border = np.concatenate((frame_intensity[0, :], frame_intensity[-1, :], \
+                             frame_intensity[1:-1, 0], frame_intensity[1:-1, -1]))
+    background = np.median(border)
+    noise = max(np.std(border), np.finfo(float).tiny)
+    return (np.max(frame_intensity) - background)/noise
+
+# available engines to localize fiducials
+# all of them share the signature and outputs of fit_with_gaussian
+localization_methods = {'Gaussian fit': fit_with_gaussian,
+                        'Radial symmetry': localize_with_radial_symmetry,
+                        'Phasor': localize_with_phasor}
+
+def localize_fiducials(method, frames_intensity, frames_coordinates, pixel_size_x_nm, pixel_size_y_nm, \
+                       fit_states = None):
+    # localize a list of fiducials with any of the localization_methods
+    # returns x, y, w0x, w0y arrays in um (one element per fiducial)
+    # if all ROIs have the same size, the Gaussian fit is done in a single batch
+    # fit_states (list of prepare_fit_state dicts) is only used by the Gaussian fit
+    same_size = len(set(np.shape(frame) for frame in frames_intensity)) == 1 and \
+        all(np.shape(frame) == np.shape(coordinates)[1:] \
+            for frame, coordinates in zip(frames_intensity, frames_coordinates))
+    if method == 'Gaussian fit' and same_size:
+        return fit_with_gaussian_batch(np.array(frames_intensity), frames_coordinates, \
+                                       pixel_size_x_nm, pixel_size_y_nm, \
+                                       fit_states = fit_states)
+    localize = localization_methods[method]
+    if method == 'Gaussian fit' and fit_states is not None:
+        results = np.array([localize(frame, coordinates, pixel_size_x_nm, pixel_size_y_nm, \
+                                     fit_state = fit_state) \
+                            for frame, coordinates, fit_state in zip(frames_intensity, \
+                                                                     frames_coordinates, \
+                                                                     fit_states)])
+    else:
+        results = np.array([localize(frame, coordinates, pixel_size_x_nm, pixel_size_y_nm) \
+                            for frame, coordinates in zip(frames_intensity, frames_coordinates)])
+    return results[:, 0], results[:, 1], results[:, 2], results[:, 3]
+
 def fit_with_gaussian_confocal(confocal_image, x, y, threshold):
     # normalize image
     image_min = np.min(confocal_image)
@@ -134,6 +398,325 @@ def meas_center_of_mass_confocal(confocal_image, threshold):
     y_cm = cm_coords[0] # in pixels
     return x_cm, y_cm
 
+def robust_linear_fit(x, y, max_iterations = 20, tuning = 1.345):
+    # fit y = slope*x + intercept by iteratively reweighted least squares with
+    # Huber weights, so a few outliers (e.g. a frame taken while the stage was
+    # still moving) do not bias the result; nan points are ignored
+    # returns slope, intercept and the robust scale of the residuals (nan if it fails)
+    x = np.asarray(x, dtype = float).ravel()
+    y = np.asarray(y, dtype = float).ravel()
+    valid = np.isfinite(x) & np.isfinite(y)
+    x = x[valid]
+    y = y[valid]
+    if x.size < 3:
+        return np.nan, np.nan, np.nan
+    weights = np.ones_like(x)
+    scale = np.nan
+    for _ in range(max_iterations):
+        weights_sum = np.sum(weights)
+        x_mean = np.sum(weights*x)/weights_sum
+        y_mean = np.sum(weights*y)/weights_sum
+        sxx = np.sum(weights*(x - x_mean)**2)
+        if sxx == 0:
+            return np.nan, np.nan, np.nan
+        slope = np.sum(weights*(x - x_mean)*(y - y_mean))/sxx
+        intercept = y_mean - slope*x_mean
+        residuals = y - slope*x - intercept
+        # median absolute deviation, scaled to the std of a normal distribution
+        scale = 1.4826*np.median(np.abs(residuals - np.median(residuals)))
+        if scale == 0:
+            break
+        normalized_residuals = np.abs(residuals)/(tuning*scale)
+        new_weights = np.where(normalized_residuals <= 1, 1, 1/np.maximum(normalized_residuals, 1))
+        if np.allclose(new_weights, weights):
+            break
+        weights = new_weights
+    return slope, intercept, scale
+
+def upsampled_dft(data, upsampled_region_size, upsample_factor, axis_offsets):
+    # DFT of data evaluated only in a small upsampled region around axis_offsets
+    # done with two matrix multiplications instead of a zero-padded FFT
+    # see M. Guizar-Sicairos et al., Opt. Lett. 33, 156 (2008)
+    number_of_rows, number_of_cols = data.shape
+    row_kernel = np.exp(-2j*np.pi*(np.arange(upsampled_region_size) - axis_offsets[0])[:, None] * \
+                        np.fft.fftfreq(number_of_rows, upsample_factor)[None, :])
+    col_kernel = np.exp(-2j*np.pi*(np.arange(upsampled_region_size) - axis_offsets[1])[:, None] * \
+                        np.fft.fftfreq(number_of_cols, upsample_factor)[None, :])
+    return row_kernel @ data @ col_kernel.T
+
+#=====================================
+
+# Classes definition
+
+#=====================================
+
+class cross_correlation_tracker(object):
+    # estimates the global shift of an image with respect to a reference image
+    # using FFT cross-correlation refined with a matrix-multiply upsampled DFT
+    # the FFT of the reference is computed once in set_reference
+    def __init__(self, reference_image, upsample_factor = 20):
+        self.upsample_factor = upsample_factor
+        self.upsampled_region_size = int(np.ceil(self.upsample_factor*1.5))
+        self.dft_shift = np.fix(self.upsampled_region_size/2)
+        self.set_reference(reference_image)
+        return
+
+    def set_reference(self, reference_image):
+        reference_image = np.asarray(reference_image, dtype = float)
+        self.shape = reference_image.shape
+        self.midpoints = np.array([np.fix(axis_size/2) for axis_size in self.shape])
+        # remove the mean so the zero frequency does not dominate the correlation
+        self.reference_freq = np.fft.fft2(reference_image - np.mean(reference_image))
+        return
+
+    def measure_shift(self, image):
+        # returns the shift (in pixels) of image with respect to the reference
+        # along the first (x) and second (y) axis
+        image = np.asarray(image, dtype = float)
+        if image.shape != self.shape:
+            print('Image shape {} does not match the reference {}.'.format(image.shape, self.shape))
+            return np.nan, np.nan
+        image_freq = np.fft.fft2(image - np.mean(image))
+        image_product = self.reference_freq*image_freq.conj()
+        # coarse estimation, whole-pixel shift
+        cross_correlation = np.fft.ifft2(image_product)
+        maxima = np.array(np.unravel_index(np.argmax(np.abs(cross_correlation)), self.shape), \
+                          dtype = float)
+        shifts = maxima
+        shifts[shifts > self.midpoints] -= np.array(self.shape)[shifts > self.midpoints]
+        # refine by upsampling the cross-correlation around the coarse peak
+        if self.upsample_factor > 1:
+            shifts = np.round(shifts*self.upsample_factor)/self.upsample_factor
+            sample_region_offset = self.dft_shift - shifts*self.upsample_factor
+            cross_correlation = upsampled_dft(image_product.conj(), \
+                                              self.upsampled_region_size, \
+                                              self.upsample_factor, \
+                                              sample_region_offset).conj()
+            maxima = np.array(np.unravel_index(np.argmax(np.abs(cross_correlation)), \
+                                               cross_correlation.shape), dtype = float)
+            shifts = shifts + (maxima - self.dft_shift)/self.upsample_factor
+        # shifts is the translation that registers the image onto the reference
+        # so the displacement of the image is its opposite
+        return -shifts[0], -shifts[1]
+
+class constant_velocity_kalman(object):
+    # constant-velocity Kalman filter, one independent filter per axis
+    # state of each axis is [position, velocity] of the measured drift error
+    # process_noise is the spectral density of the (white) acceleration, in unit^2/s^3
+    # measurement_noise is the variance of a single measurement, in unit^2
+    def __init__(self, process_noise, measurement_noise, number_of_axes = 2, \
+                 initial_velocity_variance = 1.0):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.number_of_axes = number_of_axes
+        self.initial_velocity_variance = initial_velocity_variance
+        self.reset()
+        return
+
+    def reset(self):
+        self.state = np.zeros((self.number_of_axes, 2))
+        self.covariance = np.zeros((self.number_of_axes, 2, 2))
+        self.last_time = None
+        # innovation (measurement minus prediction) of every update and
+        # its normalized square (should average 1 if the noise model is right)
+        self.innovations = []
+        self.normalized_innovations_squared = []
+        return
+
+    def update(self, measurement, timestamp, control = 0):
+        # measurement is taken at timestamp (in s)
+        # control is the step applied to the measured quantity since the
+        # previous update (e.g. minus the correction sent to the piezo)
+        measurement = np.asarray(measurement, dtype = float)
+        if self.last_time is None:
+            # first measurement, start at rest
+            self.state[:, 0] = measurement
+            self.state[:, 1] = 0
+            self.covariance[:] = 0
+            self.covariance[:, 0, 0] = self.measurement_noise
+            self.covariance[:, 1, 1] = self.initial_velocity_variance
+            self.last_time = timestamp
+            return np.zeros(self.number_of_axes)
+        dt = timestamp - self.last_time
+        self.last_time = timestamp
+        # prediction
+        self.state[:, 0] += self.state[:, 1]*dt + control
+        p00 = self.covariance[:, 0, 0]
+        p01 = self.covariance[:, 0, 1]
+        p11 = self.covariance[:, 1, 1]
+        q = self.process_noise
+        new_p00 = p00 + 2*dt*p01 + dt**2*p11 + q*dt**3/3
+        new_p01 = p01 + dt*p11 + q*dt**2/2
+        new_p11 = p11 + q*dt
+        # correction
+        innovation = measurement - self.state[:, 0]
+        innovation_variance = new_p00 + self.measurement_noise
+        gain_position = new_p00/innovation_variance
+        gain_velocity = new_p01/innovation_variance
+        self.state[:, 0] += gain_position*innovation
+        self.state[:, 1] += gain_velocity*innovation
+        self.covariance[:, 0, 0] = (1 - gain_position)*new_p00
+        self.covariance[:, 0, 1] = (1 - gain_position)*new_p01
+        self.covariance[:, 1, 0] = self.covariance[:, 0, 1]
+        self.covariance[:, 1, 1] = new_p11 - gain_velocity*new_p01
+        self.innovations.append(innovation)
+        self.normalized_innovations_squared.append(innovation**2/innovation_variance)
+        return innovation
+
+    def predict(self, lead_time):
+        # estimated value lead_time seconds after the last measurement
+        return self.state[:, 0] + self.state[:, 1]*lead_time
+
+    def get_velocity(self):
+        return self.state[:, 1]
+
+    def innovation_stats(self):
+        # mean and standard deviation of the innovations and mean normalized
+        # innovation squared, per axis
+        if len(self.innovations) < 2:
+            return None
+        innovations = np.array(self.innovations)
+        nis = np.array(self.normalized_innovations_squared)
+        return {'number': innovations.shape[0], \
+                'mean': np.mean(innovations, axis = 0), \
+                'std': np.std(innovations, axis = 0), \
+                'nis': np.mean(nis, axis = 0)}
+
+class z_spot_locator(object):
+    # locates the reflection spot of the z stabilization in its ROI
+    # same result as ndimage.center_of_mass of the ROI with the pixels below
+    # threshold*max set to zero, but computed from the row and column
+    # projections of preallocated buffers (nothing is allocated per call)
+    # refinement (opt-in): None, 'parabolic' or 'gaussian' least-squares peak
+    # fit of the background-subtracted (not thresholded) projections over
+    # +/- refinement_half_width px around the center of mass, replaces it
+    # for color images only one channel is used
+    def __init__(self, shape, threshold, refinement = None, channel = 0, \
+                 refinement_half_width = 5):
+        self.threshold = threshold
+        self.refinement = refinement
+        self.refinement_half_width = refinement_half_width
+        self.window_offsets = np.arange(-refinement_half_width, refinement_half_width + 1, dtype = float)
+        self.channel = channel
+        self.allocate(shape)
+        return
+
+    def allocate(self, shape):
+        # call it when the ROI changes (done automatically on a shape mismatch)
+        self.shape = tuple(shape[:2])
+        self.mask = np.empty(self.shape, dtype = bool)
+        self.weights = np.empty(self.shape)
+        self.row_projection = np.empty(self.shape[0])
+        self.col_projection = np.empty(self.shape[1])
+        self.raw_row_projection = np.empty(self.shape[0])
+        self.raw_col_projection = np.empty(self.shape[1])
+        self.row_index = np.arange(self.shape[0], dtype = float)
+        self.col_index = np.arange(self.shape[1], dtype = float)
+        return
+
+    def locate(self, roi_image):
+        # roi_image is a view of the ROI (e.g. image[x1:x2, y1:y2]), any dtype
+        # returns the center along the first (rows) and second (cols) axis in pixels
+        # or nan, nan if the ROI is empty
+        if roi_image.ndim == 3:
+            roi_image = roi_image[:, :, self.channel]
+        if roi_image.shape != self.shape:
+            self.allocate(roi_image.shape)
+        roi_threshold = self.threshold*roi_image.max()
+        np.greater(roi_image, roi_threshold, out = self.mask)
+        np.multiply(roi_image, self.mask, out = self.weights)
+        np.sum(self.weights, axis = 1, out = self.row_projection)
+        np.sum(self.weights, axis = 0, out = self.col_projection)
+        total = np.sum(self.row_projection)
+        if total == 0:
+            return np.nan, np.nan
+        center_row = np.dot(self.row_projection, self.row_index)/total
+        center_col = np.dot(self.col_projection, self.col_index)/total
+        if self.refinement is not None:
+            np.sum(roi_image, axis = 1, out = self.raw_row_projection)
+            np.sum(roi_image, axis = 0, out = self.raw_col_projection)
+            center_row = self.refine_peak(self.raw_row_projection, center_row)
+            center_col = self.refine_peak(self.raw_col_projection, center_col)
+        return center_row, center_col
+
+    def refine_peak(self, projection, center):
+        # vertex of the parabola fitted to the projection around the center of
+        # mass (to its log, weighted by the signal, for a Gaussian peak)
+        # a single noisy pixel barely moves a fit over the whole window
+        # the center of mass is kept if the peak cannot be fitted
+        if np.isnan(center):
+            return center
+        half_width = self.refinement_half_width
+        peak = int(round(center))
+        first = max(peak - half_width, 0)
+        last = min(peak + half_width + 1, projection.shape[0])
+        if last - first < 3:
+            return center
+        x = self.window_offsets[first - peak + half_width:last - peak + half_width]
+        # the ROI is mostly background, its median is removed so the peak goes to zero
+        y = projection[first:last] - np.median(projection)
+        if self.refinement == 'gaussian':
+            positive = y > 0
+            if np.count_nonzero(positive) < 3:
+                return center
+            a, b, _ = np.polyfit(x[positive], np.log(y[positive]), 2, w = y[positive])
+        else:
+            a, b, _ = np.polyfit(x, y, 2)
+        if a >= 0:
+            return center
+        vertex = -b/(2*a)
+        if abs(vertex) > half_width:
+            return center
+        return peak + vertex
+
+class fiducial_fitting_pool(object):
+    # persistent pool of processes to localize fiducials in parallel
+    # (curve_fit callbacks hold the GIL, so threads do not help)
+    # the frame is copied once per tick into a shared memory block
+    # rois is a dict index -> (x1, x2, y1, y2, frame_coordinates)
+    def __init__(self, frame_shape, frame_dtype, rois, pixel_size_nm, method, \
+                 number_of_processes = None):
+        self.frame_shape = tuple(frame_shape)
+        self.frame_dtype = np.dtype(frame_dtype)
+        self.indexes = sorted(rois.keys())
+        if number_of_processes is None:
+            number_of_processes = min(len(self.indexes), mp.cpu_count())
+        print('Starting a pool of {} processes for fiducial fitting...'.format(number_of_processes))
+        frame_size = max(int(np.prod(self.frame_shape))*self.frame_dtype.itemsize, 1)
+        self.shared_memory = shared_memory.SharedMemory(create = True, size = frame_size)
+        self.frame = np.ndarray(self.frame_shape, dtype = self.frame_dtype, buffer = self.shared_memory.buf)
+        # the worker functions live in fiducial_fitting_worker, which spawned
+        # processes can import (spawn is the only start method on Windows)
+        # spawned workers also import the main script again, the GUI modules
+        # do not open the cameras in them (see multiprocessing.parent_process)
+        self.pool = mp.get_context('spawn').Pool(processes = number_of_processes, \
+                                                 initializer = fitting_worker.init_fitting_worker, \
+                                                 initargs = (self.shared_memory.name, \
+                                                             self.frame_shape, \
+                                                             self.frame_dtype.str, \
+                                                             rois, \
+                                                             pixel_size_nm, \
+                                                             method))
+        return
+
+    def is_compatible(self, image):
+        return image.shape == self.frame_shape and image.dtype == self.frame_dtype
+
+    def localize(self, image):
+        # returns x, y, w0x, w0y arrays in um, in the order of the ROI indexes
+        np.copyto(self.frame, image)
+        results = np.array(self.pool.map(fitting_worker.localize_shared_fiducial, self.indexes))
+        return results[:, 0], results[:, 1], results[:, 2], results[:, 3]
+
+    def close(self):
+        print('Closing the fiducial fitting pool...')
+        self.pool.close()
+        self.pool.join()
+        self.frame = None
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+        return
+
 if __name__ == '__main__':
 
     filepath = 'D:\\daily_data\\image_pco_test2022-05-31_14-08-33.tiff'
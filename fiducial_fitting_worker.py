@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Worker side of drift_correction_toolbox.fiducial_fitting_pool.
+
+The pool is created with the spawn start method, so each worker process
+imports this small module to run init_fitting_worker and
+localize_shared_fiducial. Every worker attaches once to the shared memory
+block that holds the frame and then only receives the index of the ROI to
+localize.
+"""
+
+import numpy as np
+from multiprocessing import shared_memory
+import drift_correction_toolbox as drift
+
+# state of each worker process of the fiducial_fitting_pool
+worker_shared_memory = None
+worker_frame = None
+worker_rois = None
+worker_pixel_size = None
+worker_method = None
+worker_fit_states = {}
+
+def init_fitting_worker(shared_memory_name, frame_shape, frame_dtype, rois, pixel_size_nm, method):
+    # runs once in each worker process: attach to the shared frame
+    # the frame is never pickled, workers only receive the index of the ROI
+    global worker_shared_memory, worker_frame, worker_rois, worker_pixel_size, worker_method
+    worker_shared_memory = shared_memory.SharedMemory(name = shared_memory_name)
+    worker_frame = np.ndarray(frame_shape, dtype = frame_dtype, buffer = worker_shared_memory.buf)
+    worker_rois = rois
+    worker_pixel_size = pixel_size_nm
+    worker_method = method
+    return
+
+def localize_shared_fiducial(index):
+    # localize the fiducial index using the frame in shared memory
+    x1, x2, y1, y2, frame_coordinates = worker_rois[index]
+    frame_intensity = worker_frame[x1:x2, y1:y2]
+    if worker_method == 'Gaussian fit':
+        if index not in worker_fit_states:
+            worker_fit_states[index] = drift.prepare_fit_state(frame_coordinates)
+        return drift.fit_with_gaussian(frame_intensity, frame_coordinates, \
+                                       worker_pixel_size, worker_pixel_size, \
+                                       fit_state = worker_fit_states[index])
+    localize = drift.localization_methods[worker_method]
+    return localize(frame_intensity, frame_coordinates, worker_pixel_size, worker_pixel_size)
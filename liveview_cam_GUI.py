@@ -10,13 +10,13 @@ Fribourg, Switzerland
 
 import os
 import numpy as np
+from collections import deque
 from datetime import datetime
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui
 from PyQt5.QtCore import pyqtSignal, pyqtSlot
 from pyqtgraph.dockarea import Dock, DockArea
 import thorlabs_camera_toolbox as tl_cam
-from PIL import Image
 from tkinter import filedialog
 import tkinter as tk
 import time as tm
@@ -49,6 +49,8 @@ initial_autolevel_state = True
 # initial fake image
 initial_image_np = 128*np.ones((1080, 1440, 3))
 dummy_image_np = initial_image_np
+# number of frames sent to the Frontend whose image slots are not reused
+displayed_frames_kept = 2
 
 #=====================================
 
@@ -427,7 +429,11 @@ class Backend(QtCore.QObject):
         self.x_cursor_reference = 0
         self.y_cursor_reference = 0
         self.viewTimer = QtCore.QTimer()
+        # reusable buffers for the camera frames
+        self.frame_slots = tl_cam.image_slots()
         self.image_np = initial_image_np
+        # frames sent to the Frontend, their slots are kept until newer ones are sent
+        self.displayed_frames = deque()
         self.file_path = initial_filepath
         self.counter_flag_ok = 0
         self.change_gain(False, initial_gain)
@@ -484,14 +490,15 @@ class Backend(QtCore.QObject):
         # sequence is: set mode, set exposure, get image, stop
         tl_cam.set_camera_one_picture_mode(camera)
         self.frame_time = tl_cam.set_exp_time(camera, self.exposure_time_ms)
-        image_np, image_pil, flag_ok = tl_cam.get_color_image(camera, mono_to_color_processor)
+        image_np, flag_ok = tl_cam.get_color_image_into(camera, mono_to_color_processor, self.frame_slots)
         tl_cam.stop_camera(camera)
         if flag_ok:
-            self.image_np = np.flip(image_np, axis=0) # to match piezo movement
+            self.set_image(np.flip(image_np, axis=0)) # to match piezo movement
         else:
-            self.image_np = dummy_image_np
+            self.set_image(dummy_image_np)
+            image_np = dummy_image_np
         # emit
-        self.imageSignal.emit(image_np)
+        self.send_image(image_np)
         return
     
     @pyqtSlot(bool, float)
@@ -514,13 +521,29 @@ class Backend(QtCore.QObject):
     
     def update_view(self):
         # Image update while in Live view mode
-        image_np, image_pil, flag_ok = tl_cam.get_color_image(camera, mono_to_color_processor)
+        image_np, flag_ok = tl_cam.get_color_image_into(camera, mono_to_color_processor, self.frame_slots)
         # if there's no error send image, otherwise stop livewview
         if flag_ok:
-            self.image_np = np.flip(image_np, axis=0) # to match piezo movement
+            self.set_image(np.flip(image_np, axis=0)) # to match piezo movement
         else:
             print('Displaying last taken image.')
-        self.imageSignal.emit(self.image_np)
+        self.send_image(self.image_np)
+        return
+
+    def set_image(self, image_np):
+        # new current frame, the slot of the previous one is released
+        self.frame_slots.release(self.image_np)
+        self.image_np = image_np
+        return
+
+    def send_image(self, image_np):
+        # the Frontend keeps a reference to the image to paint it, so its slot
+        # stays in use until displayed_frames_kept newer frames are sent
+        self.frame_slots.hold(image_np)
+        self.displayed_frames.append(image_np)
+        if len(self.displayed_frames) > displayed_frames_kept:
+            self.frame_slots.release(self.displayed_frames.popleft())
+        self.imageSignal.emit(image_np)
         return
     
     def stop_liveview(self):
@@ -535,7 +558,7 @@ class Backend(QtCore.QObject):
         timestr = datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
         filename = "inspec_cam_pic_" + timestr + ".jpg"
         full_filename = os.path.join(self.file_path, filename)
-        image_to_save = Image.fromarray(np.flipud(self.image_np))
+        image_to_save = tl_cam.to_pil_image(np.flipud(self.image_np))
         image_to_save.save(full_filename) 
         print('Image %s saved' % filename)
         return
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight instrumentation of the stabilization control loops.
+Each tick of a loop is timestamped at its start and at the end of every
+stage with perf_counter_ns into a fixed-size ring (no allocation in the
+hot path). Rolling percentiles per stage and the jitter of the loop period
+versus the configured tracking period are computed on demand.
+Ticks can also be dumped to a binary log (see read_loop_log).
+"""
+
+import time as tm
+import numpy as np
+
+# binary log: magic, number of columns (int64), length of the names (int64),
+# comma-separated column names, then one int64 row per tick
+log_magic = b'LOOPPROF'
+
+#=====================================
+
+# Functions definition
+
+#=====================================
+
+def read_loop_log(filename):
+    # returns the column names and the (ticks, columns) array of timestamps in ns
+    # first column is the start of the tick, a stage not executed in a tick is -1
+    with open(filename, 'rb') as file:
+        if file.read(len(log_magic)) != log_magic:
+            print('%s is not a loop log file.' % filename)
+            return None, None
+        number_of_columns, names_length = np.frombuffer(file.read(16), dtype = np.int64)
+        names = file.read(int(names_length)).decode().split(',')
+        data = np.frombuffer(file.read(), dtype = np.int64)
+    return names, data.reshape(-1, int(number_of_columns))
+
+#=====================================
+
+# Profiler Class Definition
+
+#=====================================
+
+class loop_profiler(object):
+    def __init__(self, stage_names, target_period_ms, length = 4096):
+        self.stage_names = list(stage_names)
+        self.stage_index = {name: k + 1 for k, name in enumerate(self.stage_names)}
+        self.target_period_ms = target_period_ms
+        self.length = length
+        # column 0 is the start of the tick, then the end of each stage
+        self.ring = np.full((self.length, len(self.stage_names) + 1), -1, dtype = np.int64)
+        # the tick is written to the ring when it ends, so a discarded one
+        # never overwrites a stored tick
+        self.current = np.full(len(self.stage_names) + 1, -1, dtype = np.int64)
+        self.number_of_ticks = 0
+        # ticks that found nothing to do (see discard_tick), not in the ring
+        self.discarded_ticks = 0
+        self.log_file = None
+        return
+
+    def reset(self, target_period_ms = None):
+        if target_period_ms is not None:
+            self.target_period_ms = target_period_ms
+        self.ring[:] = -1
+        self.number_of_ticks = 0
+        self.discarded_ticks = 0
+        return
+
+    def start_tick(self):
+        self.current[:] = -1
+        self.current[0] = tm.perf_counter_ns()
+        return
+
+    def mark(self, stage_name):
+        # end of a stage
+        self.current[self.stage_index[stage_name]] = tm.perf_counter_ns()
+        return
+
+    def discard_tick(self):
+        # instead of end_tick when the tick had nothing to do (e.g. no new
+        # frame), it is only counted so it does not bias the stats
+        self.current[:] = -1
+        self.discarded_ticks += 1
+        return
+
+    def end_tick(self):
+        self.ring[self.number_of_ticks % self.length] = self.current
+        self.number_of_ticks += 1
+        if self.log_file is not None:
+            self.log_file.write(self.current.tobytes())
+        return
+
+    def start_log(self, filename):
+        self.stop_log()
+        self.log_file = open(filename, 'wb')
+        names = ','.join(['tick'] + self.stage_names).encode()
+        self.log_file.write(log_magic)
+        self.log_file.write(np.array([len(self.stage_names) + 1, len(names)], dtype = np.int64).tobytes())
+        self.log_file.write(names)
+        print('Logging loop latency to %s' % filename)
+        return
+
+    def stop_log(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        return
+
+    def get_ticks(self):
+        # ticks in the ring, oldest first
+        if self.number_of_ticks < self.length:
+            return self.ring[:self.number_of_ticks]
+        return np.roll(self.ring, -(self.number_of_ticks % self.length), axis = 0)
+
+    def stats(self, percentiles = (50, 95, 99)):
+        # duration of each stage (from the end of the previous executed stage) and
+        # of the whole tick, and loop period/jitter, in ms
+        ticks = self.get_ticks()
+        stats = {}
+        if ticks.shape[0] < 2:
+            return stats
+        previous = ticks[:, 0].astype(float)
+        last = ticks[:, 0].astype(float)
+        for name in self.stage_names:
+            end = ticks[:, self.stage_index[name]].astype(float)
+            executed = end >= 0
+            if np.any(executed):
+                duration = (end[executed] - previous[executed])/1e6
+                stats[name] = dict(zip(['p%d' % p for p in percentiles], np.percentile(duration, percentiles)))
+                previous[executed] = end[executed]
+                last[executed] = end[executed]
+        total = (last - ticks[:, 0])/1e6
+        stats['total'] = dict(zip(['p%d' % p for p in percentiles], np.percentile(total, percentiles)))
+        period = np.diff(ticks[:, 0])/1e6
+        jitter = np.abs(period - self.target_period_ms)
+        stats['period'] = dict(zip(['p%d' % p for p in percentiles], np.percentile(period, percentiles)))
+        stats['jitter'] = dict(zip(['p%d' % p for p in percentiles], np.percentile(jitter, percentiles)))
+        return stats
+
+    def report(self):
+        stats = self.stats()
+        if not stats:
+            print('Not enough ticks to report the loop latency.')
+            return stats
+        print('Loop latency over the last {} ticks (target period {} ms, {} ticks discarded):'.format(min(self.number_of_ticks, self.length), \
+                                                                                                   self.target_period_ms, \
+                                                                                                   self.discarded_ticks))
+        for name, values in stats.items():
+            print('  {:<16s} '.format(name) + ' / '.join(['{} {:.2f} ms'.format(key, value) for key, value in values.items()]))
+        return stats
@@ -10,6 +10,13 @@ Fribourg, Switzerland
 
 import pco
 import numpy as np
+import threading
+import time as tm
+from datetime import datetime
+
+# the binary timestamp is written by the camera (BCD coded) into the first
+# pixels of the first row of each image, they are masked before using the image
+timestamp_pixels = 14
 
 #=====================================
 
@@ -23,6 +30,51 @@ def fancy_print(dictionary):
         print('{}: {}'.format(key, dictionary[key]))
     return
 
+def snap_roi(starting_col, starting_row, final_col, final_row, limits):
+    # smallest ROI that contains the given one and follows the rules of set_roi:
+    # width multiple of 32, height multiple of 8 and >= 64,
+    # starting col - 1 multiple of 32, starting row - 1 multiple of 8
+    # limits = [starting_col, starting_row, final_col, final_row] of a valid ROI
+    # that must contain the result (e.g. the full ROI)
+    # returns None if it is not possible
+    min_col, min_row, max_col, max_row = limits
+    starting_col = 1 + int(np.floor((max(starting_col, min_col) - 1)/32))*32
+    final_col = int(np.ceil(min(final_col, max_col)/32))*32
+    starting_row = 1 + int(np.floor((max(starting_row, min_row) - 1)/8))*8
+    final_row = int(np.ceil(min(final_row, max_row)/8))*8
+    if final_row - starting_row + 1 < 64:
+        final_row = starting_row + 63
+        if final_row > max_row:
+            final_row = max_row
+            starting_row = max_row - 63
+    if starting_col < min_col or final_col > max_col or \
+       starting_row < min_row or final_row > max_row or starting_col > final_col:
+        return None
+    return [starting_col, starting_row, final_col, final_row]
+
+def frame_identity(metadata):
+    # image number and hardware timestamp (s since epoch, camera clock) of a frame
+    # from the metadata returned by get_image
+    # the timestamp is only available if the camera stamps the images
+    # (timestamp_flag = 'binary'), otherwise it is nan
+    # the image number is None if the metadata has none
+    image_number = None
+    hardware_time = np.nan
+    if not metadata:
+        return image_number, hardware_time
+    stamp = metadata.get('timestamp')
+    if isinstance(stamp, dict):
+        image_number = stamp.get('image counter')
+        try:
+            hardware_time = datetime(int(stamp['year']), int(stamp['month']), int(stamp['day']), \
+                                     int(stamp['hour']), int(stamp['minute'])).timestamp() + \
+                            float(stamp['second'])
+        except (KeyError, TypeError, ValueError):
+            hardware_time = np.nan
+    if image_number is None:
+        image_number = metadata.get('recorder image number')
+    return image_number, hardware_time
+
 #=====================================
 
 # pco Camera Class Definition
@@ -163,11 +215,26 @@ class pco_camera(object):
     def get_image(self):
         if self.recorder_set:
             image, metadata = self.camera.image()
+            if self.timestamp_flag != 'off' and image.shape[0] > 1:
+                # replace the stamp by the pixels of the next row
+                image[0, :timestamp_pixels] = image[1, :timestamp_pixels]
             image = np.flip(image, 1)
         else:
             print('Recorder has to be configured. Run config_recorder first.')
         return image, metadata
 
+    def wait_for_new_image(self, timeout_s = 1):
+        # block until the recorder has a new image
+        # returns False on timeout or if the pco package cannot wait
+        # (then the caller has to poll get_image)
+        if not (self.recorder_set and hasattr(self.camera, 'wait_for_new_image')):
+            return False
+        try:
+            self.camera.wait_for_new_image(delay = False, timeout = timeout_s)
+        except Exception:
+            return False
+        return True
+
     def config_recorder(self, num_of_images = 4, rec_mode = 'ring buffer'):
         # minimum number of images that can be set when in ring buffer mode is 4
         print('Setting recorder parameters...')
@@ -191,6 +258,169 @@ class pco_camera(object):
 
 #=====================================
 
+# Frame grabber Class Definition
+
+#=====================================
+
+class pco_frame_grabber(object):
+    # producer thread that pulls frames from a pco_camera (already recording,
+    # see config_recorder) into a preallocated ring buffer of frames + metadata
+    # consumers ask for the newest frame they have not seen yet
+    # counters:
+    #   duplicated: camera returned the same frame again (polled faster than it produces)
+    #   dropped: frames overwritten by a newer one before any consumer took them
+    def __init__(self, camera, number_of_frames = 8):
+        self.camera = camera
+        # optional function called from the producer thread with the sequence
+        # number of every new frame (e.g. to emit a Qt signal)
+        self.frame_callback = None
+        self.number_of_frames = number_of_frames
+        self.frames = None
+        self.metadata = [None]*self.number_of_frames
+        self.sequence = np.zeros(self.number_of_frames, dtype = np.int64)
+        # image number given by the camera, -1 if unknown
+        self.image_numbers = np.full(self.number_of_frames, -1, dtype = np.int64)
+        self.timestamps = np.zeros(self.number_of_frames)
+        self.lock = threading.Lock()
+        self.new_frame_event = threading.Event()
+        self.running = False
+        self.thread = None
+        self.last_sequence = 0 # sequence number of the newest frame, 0 means no frame yet
+        self.reset_counters()
+        return
+
+    def reset_counters(self):
+        # call it when a consumer starts (e.g. when locking)
+        # frames already in the buffer are considered as seen
+        with self.lock:
+            self.last_consumed_sequence = self.last_sequence
+            self.frames_acquired = 0
+            self.frames_duplicated = 0
+            self.frames_dropped = 0
+        return
+
+    def get_counters(self):
+        return self.frames_acquired, self.frames_duplicated, self.frames_dropped
+
+    def get_frame_period(self):
+        # median time between consecutive new frames in the ring buffer, in s
+        # it is the actual frame period (exposure, readout and delays included)
+        # returns nan if there are less than 2 frames since the last allocation
+        with self.lock:
+            stored = self.sequence > 0
+            sequence = self.sequence[stored]
+            timestamps = self.timestamps[stored]
+        if sequence.size < 2:
+            return np.nan
+        order = np.argsort(sequence)
+        periods = np.diff(timestamps[order])/np.diff(sequence[order])
+        return np.median(periods)
+
+    def allocate(self, shape, dtype):
+        # (re)allocate the ring buffer, only when the ROI or binning change
+        print('Allocating frame ring buffer of {} frames of {} pixels...'.format(self.number_of_frames, shape))
+        self.frames = np.zeros((self.number_of_frames,) + tuple(shape), dtype = dtype)
+        self.sequence[:] = 0
+        self.image_numbers[:] = -1
+        return
+
+    def start(self, polling_period_ms):
+        # polling faster than the exposure time reduces the latency
+        # the repeated frames are detected and discarded
+        if self.running:
+            return
+        self.polling_period = max(polling_period_ms, 1)/1000 # in s
+        self.reset_counters()
+        self.running = True
+        self.thread = threading.Thread(target = self.acquire_frames, daemon = True)
+        self.thread.start()
+        return
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        self.thread = None
+        print('Frame grabber stopped. Frames acquired: {}, duplicated: {}, dropped: {}'.format(self.frames_acquired, \
+                                                                                            self.frames_duplicated, \
+                                                                                            self.frames_dropped))
+        return
+
+    def acquire_frames(self):
+        # wait for each new recorder image if the camera allows it, otherwise poll
+        while self.running:
+            start_time = tm.perf_counter()
+            new_image_bool = self.camera.wait_for_new_image(timeout_s = max(10*self.polling_period, 0.5))
+            if not self.running:
+                break
+            try:
+                image, metadata = self.camera.get_image()
+            except Exception as error:
+                print('Frame grabber could not get an image from the camera:', error)
+                self.running = False
+                break
+            self.store_frame(image, metadata)
+            elapsed_time = tm.perf_counter() - start_time
+            if not new_image_bool and elapsed_time < self.polling_period:
+                tm.sleep(self.polling_period - elapsed_time)
+        return
+
+    def store_frame(self, image, metadata):
+        image_number, _ = frame_identity(metadata)
+        if image_number is None:
+            image_number = -1
+        with self.lock:
+            if self.frames is None or self.frames.shape[1:] != image.shape or self.frames.dtype != image.dtype:
+                self.allocate(image.shape, image.dtype)
+            elif self.last_sequence > 0:
+                last_index = self.last_sequence % self.number_of_frames
+                last_image_number = self.image_numbers[last_index]
+                if image_number >= 0 and last_image_number >= 0:
+                    # the camera numbers its images
+                    duplicated = image_number == last_image_number
+                else:
+                    # sCMOS noise makes two different frames never identical
+                    duplicated = np.array_equal(self.frames[last_index], image)
+                if duplicated:
+                    self.frames_duplicated += 1
+                    return
+                if self.last_consumed_sequence < self.last_sequence:
+                    self.frames_dropped += 1
+            self.last_sequence += 1
+            index = self.last_sequence % self.number_of_frames
+            np.copyto(self.frames[index], image)
+            self.metadata[index] = metadata
+            self.sequence[index] = self.last_sequence
+            self.image_numbers[index] = image_number
+            self.timestamps[index] = tm.perf_counter()
+            self.frames_acquired += 1
+            sequence = self.last_sequence
+        self.new_frame_event.set()
+        if self.frame_callback is not None:
+            self.frame_callback(sequence)
+        return
+
+    def get_newest_frame(self, out = None, only_unseen = True):
+        # copy the newest frame into out (allocated if None)
+        # only_unseen = False peeks at the newest frame (e.g. for display)
+        # without marking it as consumed
+        # returns frame, metadata, sequence number and acquisition time (perf_counter, in s)
+        # returns None, None, 0, nan if there is no new frame since the last call
+        with self.lock:
+            if self.last_sequence == 0 or (only_unseen and self.last_sequence == self.last_consumed_sequence):
+                return None, None, 0, np.nan
+            index = self.last_sequence % self.number_of_frames
+            if out is None or out.shape != self.frames.shape[1:] or out.dtype != self.frames.dtype:
+                out = np.empty_like(self.frames[index])
+            np.copyto(out, self.frames[index])
+            if only_unseen:
+                self.last_consumed_sequence = self.last_sequence
+                self.new_frame_event.clear()
+            return out, self.metadata[index], self.last_sequence, self.timestamps[index]
+
+#=====================================
+
 # Main program
 
 #=====================================
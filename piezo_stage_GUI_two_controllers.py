@@ -12,8 +12,18 @@ Fribourg, Switzerland
 from pyqtgraph.Qt import QtCore, QtGui
 from PyQt5.QtCore import pyqtSignal, pyqtSlot
 from pyqtgraph.dockarea import DockArea, Dock
-import piezostage_toolbox as piezoTool
 import time as tm
+from timeit import default_timer as timer
+from collections import deque
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# set True to use the simulated controllers (no hardware, no Kinesis dlls)
+simulate_piezo = False
+if simulate_piezo:
+    import piezostage_simulator_toolbox as piezoTool
+else:
+    import piezostage_toolbox as piezoTool
 
 #=====================================
 
@@ -29,6 +39,29 @@ piezo_stage_xy = piezoTool.BPC303(deviceID_BPC303)
 piezo_stage_z = piezoTool.BPC301(deviceID_BPC301)
 # time period used to update stage position
 initial_updatePosition_period = 500 # in ms
+# move_xyz only sends the axes whose target differs from the last commanded
+# position by more than this
+position_tolerance = 0.0005 # in um
+# delay of the (optional) read of the position after move_xyz
+readback_delay = 500 # in ms, settling time
+# motion completion (see wait_for_settling)
+# a move is complete when all axes stay within settling_tolerance of their
+# targets for settling_dwell s
+# the position read is the value polled by Kinesis every 10 ms (see
+# piezostage_toolbox.channel_polling_period), the dwell spans several polls
+settling_tolerance = 0.010 # in um
+settling_dwell = 0.030 # in s
+settling_timeout = 0.5 # in s
+settling_poll_period = 0.002 # in s
+# position publishing (see poll_position)
+# the position is read from the controllers every updatePosition_period ms,
+# every fast_updatePosition_period ms while jogging (until jog_hold_time s
+# after the last manual move), and while a stabilization lock is running the
+# controllers are not read, the commanded positions are published instead
+# every lock_updatePosition_period ms
+fast_updatePosition_period = 100 # in ms
+lock_updatePosition_period = 2000 # in ms
+jog_hold_time = 2 # in s
 # set True if you want to perform zero the stage during initialization
 zeroing_flag = False
 
@@ -391,6 +424,16 @@ class Backend(QtCore.QObject):
         super().__init__(*args, **kwargs)
         self.piezo_stage_xy = piezo_stage_xy
         self.piezo_stage_z = piezo_stage_z
+        # thread used to command the xy controller while the z one is commanded
+        self.move_executor = ThreadPoolExecutor(max_workers = 1)
+        # settle times of the last moves (see wait_for_settling)
+        self.settle_times = deque(maxlen = 1000)
+        self.settling_timeouts = 0
+        # last published position [x, y, z] (see poll_position)
+        self.position_snapshot = [None, None, None]
+        self.snapshot_time = 0
+        self.last_jog_time = 0
+        self.active_locks = set()
         self.initialize_piezo()
         # set timer to update lasers status
         self.updatePosition_period = updatePosition_period
@@ -438,8 +481,78 @@ class Backend(QtCore.QObject):
         x_pos = round(x_pos, 3)
         y_pos = round(y_pos, 3)
         z_pos = round(z_pos, 3)
+        self.position_snapshot = [x_pos, y_pos, z_pos]
+        self.snapshot_time = timer()
         self.read_pos_signal.emit([x_pos, y_pos, z_pos])
         return x_pos, y_pos, z_pos
+
+    @pyqtSlot()
+    def poll_position(self):
+        """
+        Publish the position on every updateTimer timeout. The controllers
+        are not read while a stabilization lock is running.
+        """
+        if self.active_locks:
+            self.update_snapshot()
+            self.read_pos_signal.emit(list(self.position_snapshot))
+        else:
+            self.read_position()
+        self.adapt_polling_period()
+        return
+
+    def adapt_polling_period(self):
+        if self.active_locks:
+            period = lock_updatePosition_period
+        elif timer() - self.last_jog_time < jog_hold_time:
+            period = fast_updatePosition_period
+        else:
+            period = self.updatePosition_period
+        if self.updateTimer.interval() != period:
+            self.updateTimer.setInterval(period)
+        return
+
+    def update_snapshot(self):
+        # snapshot from the commanded (shadow) positions, no controller read
+        commanded_positions = [self.piezo_stage_xy.commanded_position['x'], \
+                               self.piezo_stage_xy.commanded_position['y'], \
+                               self.piezo_stage_z.commanded_position['z']]
+        for i, position in enumerate(commanded_positions):
+            if position is not None:
+                self.position_snapshot[i] = round(position, 3)
+        self.snapshot_time = timer()
+        return
+
+    def get_position_snapshot(self):
+        """
+        Returns the last published position [x, y, z] (updated after every
+        move). The controllers are only read if the position is unknown.
+        """
+        if None in self.position_snapshot:
+            self.read_position()
+        return list(self.position_snapshot)
+
+    @pyqtSlot(str, bool)
+    def set_stabilization_lock(self, lock_name, locked):
+        """
+        Stabilization modules (xy, z) report when their lock is running, so
+        the position is not read from the controllers meanwhile
+        """
+        if locked:
+            self.active_locks.add(lock_name)
+        else:
+            self.active_locks.discard(lock_name)
+        self.adapt_polling_period()
+        return
+
+    @pyqtSlot(str, float)
+    def jog(self, axis, distance):
+        """
+        Manual move, the position is polled faster for jog_hold_time s
+        """
+        self.last_jog_time = timer()
+        self.move_relative(axis, distance)
+        self.adapt_polling_period()
+        return
     
     # @pyqtSlot()
     # def set_reference(self):
@@ -467,6 +580,7 @@ class Backend(QtCore.QObject):
             self.piezo_stage_z.move_relative(axis, distance)
         else:
             print('Cannot do \"move relative\". Axis should be x, y or z.')
+        self.update_snapshot()
         # check piezo_toolbox.py\response_time function
         # after running it, it's clear that 0.5 s is a suitable settling time
         # uncomment for debbuging
@@ -485,16 +599,99 @@ class Backend(QtCore.QObject):
     @pyqtSlot(list)
     def move_absolute(self, position):
         """
-        Moves the stage to an absolute position.
+        Moves the stage to an absolute position and reads it back.
         """
-        # first x, then y, and last z
         # print("Setting Position:", position)
-        self.piezo_stage_xy.set_position(x = position[0], \
-                                         y = position[1], \
-                                         z = 0)
-        self.piezo_stage_z.set_position(z = position[2])
+        self.move_xyz(position)
         self.read_position() 
         return
+
+    @pyqtSlot(list)
+    def move_xyz(self, position, readback = False):
+        """
+        Moves the stage to an absolute position [x, y, z] without reading it.
+        Only the axes whose target changed are sent and both controllers are
+        commanded at the same time. If readback is True the position is read
+        (and emitted) readback_delay ms later.
+        """
+        xy_targets = {}
+        for axis, target in zip(('x', 'y'), position[0:2]):
+            if self.is_new_target(self.piezo_stage_xy, axis, target):
+                xy_targets[axis] = float(target)
+        z_target = float(position[2])
+        move_z = self.is_new_target(self.piezo_stage_z, 'z', z_target)
+        if xy_targets and move_z:
+            xy_move = self.move_executor.submit(self.piezo_stage_xy.set_position, **xy_targets)
+            self.piezo_stage_z.set_position(z = z_target)
+            xy_move.result()
+        elif xy_targets:
+            self.piezo_stage_xy.set_position(**xy_targets)
+        elif move_z:
+            self.piezo_stage_z.set_position(z = z_target)
+        self.update_snapshot()
+        if readback:
+            QtCore.QTimer.singleShot(readback_delay, self.read_position)
+        return
+
+    def wait_for_settling(self, position, tolerance = settling_tolerance, \
+                          dwell = settling_dwell, timeout = settling_timeout):
+        """
+        Blocks until the stage is within tolerance of position [x, y, z] (None
+        to ignore an axis) during dwell s, or until timeout s have passed.
+        Returns the settle time in s (time to enter the tolerance band) or None
+        if it timed out.
+        """
+        axes_to_check = []
+        for axis, target in zip(('x', 'y', 'z'), position):
+            if target is not None:
+                piezo_stage = self.piezo_stage_z if axis == 'z' else self.piezo_stage_xy
+                axes_to_check.append((piezo_stage, axis, float(target)))
+        start_time = timer()
+        inside_since = None
+        while True:
+            now = timer()
+            inside = True
+            for piezo_stage, axis, target in axes_to_check:
+                if abs(piezo_stage.get_axis_position(axis) - target) > tolerance:
+                    inside = False
+                    break
+            if not inside:
+                inside_since = None
+            elif inside_since is None:
+                inside_since = now
+            if inside_since is not None and now - inside_since >= dwell:
+                settle_time = inside_since - start_time
+                self.settle_times.append(settle_time)
+                return settle_time
+            if now - start_time > timeout:
+                # counted quietly, warned only once until the next report
+                if self.settling_timeouts == 0:
+                    print('Warning! Stage did not settle within {:.0f} ms. ' \
+                          'Further timeouts are only counted.'.format(timeout*1000))
+                self.settling_timeouts += 1
+                return None
+            tm.sleep(settling_poll_period)
+
+    def report_settling_stats(self):
+        # settle time statistics of the moves since the last report
+        if len(self.settle_times) == 0:
+            if self.settling_timeouts > 0:
+                print('Stage did not settle in {} moves.'.format(self.settling_timeouts))
+                self.settling_timeouts = 0
+            return
+        settle_times = np.array(self.settle_times)*1000 # to ms
+        print('Settle time over {} moves: median {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms, timeouts {}'.format( \
+              len(settle_times), np.median(settle_times), np.percentile(settle_times, 95), \
+              np.max(settle_times), self.settling_timeouts))
+        self.settle_times.clear()
+        self.settling_timeouts = 0
+        return
+
+    def is_new_target(self, piezo_stage, axis, target):
+        commanded_position = piezo_stage.commanded_position[axis]
+        if commanded_position is None:
+            return True
+        return abs(commanded_position - target) > position_tolerance
     
     @pyqtSlot(bool)
     def switch_feedback_loop_mode(self, close_flag):
@@ -525,6 +722,7 @@ class Backend(QtCore.QObject):
     def close_backend(self, main_app = True):
         print('Stopping updater (QtTimer)...')
         self.updateTimer.stop()
+        self.move_executor.shutdown(wait = True)
         if main_app:
             print('Shutting down piezo stage...')
             self.piezo_stage_xy.shutdown()
@@ -537,7 +735,7 @@ class Backend(QtCore.QObject):
 
     def make_connections(self, frontend):
         frontend.read_pos_button_signal.connect(self.read_position)
-        frontend.move_signal.connect(self.move_relative)
+        frontend.move_signal.connect(self.jog)
         # frontend.set_reference_signal.connect(self.set_reference)
         frontend.zeroing_signal.connect(self.do_zeroing)
         frontend.go_to_pos_signal.connect(self.move_absolute)
@@ -563,7 +761,7 @@ if __name__ == '__main__':
     workerThread = QtCore.QThread()
     # move worker and its timers to a different thread (avoids GUI freezing)
     worker.updateTimer.moveToThread(workerThread)
-    worker.updateTimer.timeout.connect(worker.read_position)
+    worker.updateTimer.timeout.connect(worker.poll_position)
     worker.moveToThread(workerThread)
 
     # start timer when thread has started
@@ -14,9 +14,15 @@ Fribourg, Switzerland
 from pyqtgraph.Qt import QtCore, QtGui
 from PyQt5.QtCore import pyqtSignal, pyqtSlot
 from pyqtgraph.dockarea import DockArea, Dock
-import piezostage_toolbox as piezoTool
 import time as tm
 
+# set True to use the simulated controllers (no hardware, no Kinesis dlls)
+simulate_piezo = False
+if simulate_piezo:
+    import piezostage_simulator_toolbox as piezoTool
+else:
+    import piezostage_toolbox as piezoTool
+
 #=====================================
 
 # Initialize stage
@@ -301,6 +307,7 @@ class Backend(QtCore.QObject):
         self.updatePosition_period = updatePosition_period
         self.updateTimer = QtCore.QTimer()
         self.updateTimer.setInterval(self.updatePosition_period) # in ms
+        self.updateTimer_was_active = False
         return
     
     def initialize_piezo(self):
@@ -388,6 +395,19 @@ class Backend(QtCore.QObject):
         self.piezo_stage_xy.set_close_loop(close_flag)
         return
     
+    @pyqtSlot(str, bool)
+    def set_stabilization_lock(self, lock_name, locked):
+        """
+        The position is not read from the controller while the stabilization
+        lock is running
+        """
+        if locked:
+            self.updateTimer_was_active = self.updateTimer.isActive()
+            self.updateTimer.stop()
+        elif self.updateTimer_was_active:
+            self.updateTimer.start()
+        return
+
     def run(self):
         self.updateTimer.start()
         return
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated BPC303 and BPC301 Benchtop Piezo Controllers. The classes have
+the same methods as the ones of piezostage_toolbox but they do not need the
+Thorlabs .NET Kinesis assemblies, so the piezo GUIs, the stabilization loops
+and the scans of pyLock/pyTrap can run (and be benchmarked) without hardware.
+Select them with the simulate_piezo flag of the piezo GUI modules.
+
+Model of each axis:
+- every call to the controller blocks for command_latency s and a new
+  target is applied command_latency s after it was sent
+- the stage follows the target with a first-order response (time constant
+  settling_tau s) and is limited to the travel range
+- targets are quantized to the resolution of the DAC (position_resolution)
+- the position read has gaussian noise (position_noise, std in µm)
+
+"""
+
+from time import sleep
+import numpy as np
+from timeit import default_timer as timer
+
+# same shadow (commanded) position parameters as piezostage_toolbox
+initial_resync_interval = 10 # in s, None to resync only on demand
+settling_time = 0.5 # in s
+
+# model parameters
+command_latency = 0.001 # in s, per call to the controller
+settling_tau = 0.005 # in s, time constant of the closed loop
+position_resolution = 20/2**16 # in µm, 16 bit over the travel range
+position_noise = 0.002 # in µm, std dev of the position read
+travel_range = (0, 20) # in µm
+
+#=====================================
+
+# Functions definition
+
+#=====================================
+
+def list_devices():
+    """Return a list of Kinesis serial numbers"""
+    return print(['71260444', '41401114'])
+
+#=====================================
+
+# Simulated axis class definition
+
+#=====================================
+
+class simulated_axis(object):
+    """
+    First-order model of a closed-loop piezo axis. Targets are applied
+    after command_latency s and the position relaxes towards them with a
+    time constant settling_tau.
+    """
+    def __init__(self, position = 0.0, seed = None):
+        self.reference_position = position
+        self.reference_time = timer()
+        self.target = position
+        self.pending_targets = []
+        self.rng = np.random.default_rng(seed)
+        return
+
+    def command(self, target):
+        target = min(max(target, travel_range[0]), travel_range[1])
+        target = round(target/position_resolution)*position_resolution
+        self.pending_targets.append((timer() + command_latency, target))
+        return
+
+    def __update(self, now):
+        # apply the targets whose latency has elapsed
+        while self.pending_targets and self.pending_targets[0][0] <= now:
+            apply_time, target = self.pending_targets.pop(0)
+            self.reference_position = self.__position_at(apply_time)
+            self.reference_time = apply_time
+            self.target = target
+        return
+
+    def __position_at(self, t):
+        decay = np.exp(-(t - self.reference_time)/settling_tau)
+        return self.target + (self.reference_position - self.target)*decay
+
+    def read(self):
+        now = timer()
+        self.__update(now)
+        return self.__position_at(now) + self.rng.normal(0, position_noise)
+
+    def reset(self):
+        self.pending_targets = []
+        self.reference_position = 0.0
+        self.reference_time = timer()
+        self.target = 0.0
+        return
+
+#=====================================
+
+# Simulated Piezo Stage classes definition
+
+#=====================================
+
+class simulated_piezo_controller(object):
+    """
+    Base class of the simulated controllers. Keeps a simulated axis and the
+    commanded (shadow) position for each axis of axis_chan_mapping.
+    """
+    name = 'simulated controller'
+
+    def __init__(self, deviceID, axis_chan_mapping, resync_interval = initial_resync_interval):
+        self.deviceID = deviceID
+        self.isconnected = False
+        self.axis_chan_mapping = axis_chan_mapping
+        self.axes = tuple(axis_chan_mapping.keys())
+        self.resync_interval = resync_interval
+        self.simulated_axes = {axis: simulated_axis(position = 10.0) for axis in self.axes}
+        self.commanded_position = {axis: None for axis in self.axes}
+        self.last_command_time = {axis: 0 for axis in self.axes}
+        self.last_resync_time = {axis: 0 for axis in self.axes}
+        return
+
+    def connect(self):
+        print("\nConnecting to %s (simulated):" % self.name)
+        self.isconnected = True
+        for axis in self.axes:
+            print("\t- connecting channel %d (%s axis) --> done" % (self.axis_chan_mapping[axis], axis))
+        return
+
+    def identify(self, axis = None):
+        print("Identifying %s (simulated) --> done" % self.name)
+        return
+
+    def set_close_loop(self, yes):
+        print("Setting control mode to %s loop (simulated)\n" % ("closed" if yes else "open"))
+        for axis in self.axes:
+            self.commanded_position[axis] = None
+        return
+
+    def _zero_axis(self, axis):
+        if axis in self.axes:
+            print("\t- zeroing channel %d (%s axis)..." % (self.axis_chan_mapping[axis], axis))
+            self.simulated_axes[axis].reset()
+            self.commanded_position[axis] = None
+        else:
+            print("\t- axis invalid)")
+        return
+
+    def _set_axis_position(self, axis, pos):
+        if axis in self.axes:
+            sleep(command_latency)
+            self.simulated_axes[axis].command(float(pos))
+            self.commanded_position[axis] = float(pos)
+            self.last_command_time[axis] = timer()
+        else:
+            print("\t- axis invalid)")
+        return
+
+    def get_axis_position(self, axis):
+        """
+        Method returning the position (float, in µm) of an specific axis/channel
+        """
+        if axis in self.axes:
+            sleep(command_latency)
+            position_float = float(self.simulated_axes[axis].read())
+        else:
+            print('Error! Axis {} doesn\'t exist. Axis can only be {}.'.format(axis, ', '.join(self.axes)))
+            position_float = None
+        return position_float
+
+    def resync(self, axis = "all"):
+        axes = self.axes if axis == "all" else (axis,)
+        for ax in axes:
+            position = self.get_axis_position(ax)
+            if position is not None:
+                self.commanded_position[ax] = position
+                self.last_resync_time[ax] = timer()
+        return
+
+    def get_commanded_position(self, axis):
+        if axis not in self.axes:
+            print('Error! Axis {} doesn\'t exist. Axis can only be {}.'.format(axis, ', '.join(self.axes)))
+            return None
+        now = timer()
+        if self.commanded_position[axis] is None:
+            self.resync(axis)
+        elif self.resync_interval is not None and \
+             now - self.last_resync_time[axis] > self.resync_interval and \
+             now - self.last_command_time[axis] > settling_time:
+            self.resync(axis)
+        return self.commanded_position[axis]
+
+    def move_relative(self, axis, step):
+        actual_position = self.get_commanded_position(axis)
+        if actual_position is None:
+            return
+        self._set_axis_position(axis, actual_position + step)
+        return
+
+    def get_info(self):
+        return "Controller:\n%s %s (simulated)\n" % (self.name, self.deviceID)
+
+    def shutdown(self):
+        print("Shutting %s down (simulated):" % self.name)
+        self.isconnected = False
+        print("\t- done\n")
+        return
+
+class BPC303(simulated_piezo_controller):
+    """
+    Simulated BPC303 3 channel Benchtop Piezo Controller
+    """
+    name = 'BPC303'
+
+    def __init__(self, deviceID, axis_chan_mapping={'x': 1, 'y': 2, 'z': 3}, \
+                 resync_interval = initial_resync_interval):
+        super().__init__(deviceID, axis_chan_mapping, resync_interval)
+        return
+
+    def zero(self, axis="all"):
+        print("Performing Set Zero:")
+        if axis == "all":
+            for ax in self.axes:
+                self._zero_axis(ax)
+        else:
+            self._zero_axis(axis)
+        print('\nReady.')
+        return
+
+    def set_position(self, x=None, y=None, z=None):
+        pos = {"x": x, "y": y, "z": z}
+        for axis, pos in pos.items():
+            if pos is not None:
+                self._set_axis_position(axis, pos)
+        return
+
+class BPC301(simulated_piezo_controller):
+    """
+    Simulated BPC301 single channel Benchtop Piezo Controller
+    """
+    name = 'BPC301'
+
+    def __init__(self, deviceID, axis_chan_mapping={'z': 1}, \
+                 resync_interval = initial_resync_interval):
+        super().__init__(deviceID, axis_chan_mapping, resync_interval)
+        return
+
+    def zero(self):
+        print("Performing Set Zero:")
+        self._zero_axis('z')
+        print('\nReady.')
+        return
+
+    def set_position(self, z=None):
+        if z is not None:
+            self._set_axis_position('z', z)
+        return
+
+#=====================================
+
+# Main program
+
+#=====================================
+#%%
+if __name__ == "__main__":
+    # step response of a simulated axis
+    piezo_stage_z = BPC301('41401114')
+    piezo_stage_z.connect()
+    piezo_stage_z.set_position(z = 10)
+    sleep(0.1)
+    start_time = timer()
+    piezo_stage_z.move_relative('z', 0.100)
+    for i in range(10):
+        print('{:.4f} s  {:.4f} um'.format(timer() - start_time, piezo_stage_z.get_axis_position('z')))
+        sleep(0.002)
+    piezo_stage_z.shutdown()
@@ -61,6 +61,17 @@ from Thorlabs.MotionControl.DeviceManagerCLI import DeviceNotReadyException #ana
 import Thorlabs.MotionControl.GenericPiezoCLI.Piezo as Piezo #analysis:ignore
 from Thorlabs.MotionControl.Benchtop.PiezoCLI import BenchtopPiezo #analysis:ignore
 
+# the last commanded position of each axis is kept by the classes (shadow
+# position) and relative moves are computed from it, without reading the
+# controller before every SetPosition
+# the shadow is resynchronized with the controller every resync_interval s,
+# but only if the axis has not been commanded during the last settling_time s
+initial_resync_interval = 10 # in s, None to resync only on demand
+settling_time = 0.5 # in s, see response_time
+# period of the status polling of each channel, GetPosition returns the last
+# polled value, so it limits how fast the settling of a move can be followed
+channel_polling_period = 10 # in ms
+
 #=====================================
 
 # Functions definition
@@ -95,10 +106,13 @@ class BPC303:
     attribute controller -- controller instance (from Thorlabs .NET dll)
     attributes xchannel, ychannel and zchannel -- channel instances
         (from Thorlabs .NET dll)
+    attribute commanded_position -- last position (in µm) sent to each axis,
+        None if unknown (shadow of the controller state)
     method __init__(self, deviceID, axis_chan_mappign) --
     method connect(self) -- initializes the physical instrument
     """
-    def __init__(self, deviceID, axis_chan_mapping={'x': 1, 'y': 2, 'z': 3}):
+    def __init__(self, deviceID, axis_chan_mapping={'x': 1, 'y': 2, 'z': 3}, \
+                 resync_interval = initial_resync_interval):
         """
         Method creating a BPC303 instance and setting up the connection to the
         device with device ID. Also creates the attributes self.deviceID,
@@ -108,6 +122,10 @@ class BPC303:
         self.deviceID = deviceID
         self.isconnected = False
         self.axis_chan_mapping = axis_chan_mapping
+        self.resync_interval = resync_interval
+        self.commanded_position = {"x": None, "y": None, "z": None}
+        self.last_command_time = {"x": 0, "y": 0, "z": 0}
+        self.last_resync_time = {"x": 0, "y": 0, "z": 0}
         if (self.deviceID in DeviceManagerCLI.GetDeviceList().ToArray()):
             self.controller = BenchtopPiezo.CreateBenchtopPiezo(self.deviceID)
         else:
@@ -147,7 +165,7 @@ class BPC303:
                 except:
                     print('Timout: channel was not initialized.')
                     raise
-            channel.StartPolling(100)
+            channel.StartPolling(channel_polling_period)
             channel.EnableDevice()
             print(" done" if channel.IsConnected else "failed")
         return
@@ -178,6 +196,7 @@ class BPC303:
         for axis in ("x", "y", "z"):
             channel = self.__get_chan(axis)
             channel.SetPositionControlMode(mode)
+            self.commanded_position[axis] = None
             sleep(0.3)
         return
     
@@ -207,6 +226,7 @@ class BPC303:
             print("\t- zeroing channel %d (%s axis)..." % (channelno, axis), end="")
             channel = self.__get_chan(axis)
             channel.SetZero()
+            self.commanded_position[axis] = None
         else:
             print("\t- axis invalid)")
         return
@@ -234,12 +254,45 @@ class BPC303:
             # print("\t- moving %s axis piezo to %.3f um -->" % (axis, pos), end="")
             channel = self.__get_chan(axis)
             channel.SetPosition(Decimal(pos))
+            self.commanded_position[axis] = float(pos)
+            self.last_command_time[axis] = timer()
             # uncomment for debugging
             # print(" done")
         else:
             print("\t- axis invalid)")
         return
 
+    def resync(self, axis="all"):
+        """
+        Method setting the commanded (shadow) position of all axes or of a
+        single one to the position read from the controller
+        """
+        axes = ("x", "y", "z") if axis == "all" else (axis,)
+        for ax in axes:
+            position = self.get_axis_position(ax)
+            if position is not None:
+                self.commanded_position[ax] = position
+                self.last_resync_time[ax] = timer()
+        return
+
+    def get_commanded_position(self, axis):
+        """
+        Method returning the last commanded position (float, in µm) of an axis.
+        The controller is only read if the position is unknown or if it has
+        not been resynchronized for resync_interval s
+        """
+        if axis not in ("x", "y", "z"):
+            print('Error! Axis {} doesn\'t exist. Axis can only be x, y or z.'.format(axis))
+            return None
+        now = timer()
+        if self.commanded_position[axis] is None:
+            self.resync(axis)
+        elif self.resync_interval is not None and \
+             now - self.last_resync_time[axis] > self.resync_interval and \
+             now - self.last_command_time[axis] > settling_time:
+            self.resync(axis)
+        return self.commanded_position[axis]
+
     def get_axis_position(self, axis):
         """
         Method returning the position (float, in µm) of an specific axis/channel
@@ -257,9 +310,12 @@ class BPC303:
     def move_relative(self, axis, step):
         """
         Method setting the relative position in µm if the channel is in
-        Closed Loop mode
+        Closed Loop mode. The step is added to the last commanded position
+        (see get_commanded_position)
         """
-        actual_position = self.get_axis_position(axis)
+        actual_position = self.get_commanded_position(axis)
+        if actual_position is None:
+            return
         new_position = actual_position + step
         # uncomment for debugging
         # print("\t- piezo moving %.3f um on axis %s" % (step, axis))
@@ -401,10 +457,13 @@ class BPC301:
         to the physical instrument
     attribute controller -- controller instance (from Thorlabs .NET dll)
     attributes zchannel -- channel instances (from Thorlabs .NET dll)
+    attribute commanded_position -- last position (in µm) sent to the axis,
+        None if unknown (shadow of the controller state)
     method __init__(self, deviceID, axis_chan_mappign) --
     method connect(self) -- initializes the physical instrument
     """
-    def __init__(self, deviceID, axis_chan_mapping={'z': 1}):
+    def __init__(self, deviceID, axis_chan_mapping={'z': 1}, \
+                 resync_interval = initial_resync_interval):
     
         """
         Method creating a BPC301 instance and setting up the connection to the
@@ -415,6 +474,10 @@ class BPC301:
         self.deviceID = deviceID
         self.isconnected = False
         self.axis_chan_mapping = axis_chan_mapping
+        self.resync_interval = resync_interval
+        self.commanded_position = {"z": None}
+        self.last_command_time = {"z": 0}
+        self.last_resync_time = {"z": 0}
         if (self.deviceID in DeviceManagerCLI.GetDeviceList().ToArray()):
             self.controller = BenchtopPiezo.CreateBenchtopPiezo(self.deviceID)
         else:
@@ -453,7 +516,7 @@ class BPC301:
             except:
                 print('Timout: channel was not initialized.')
                 raise
-        channel.StartPolling(100)
+        channel.StartPolling(channel_polling_period)
         channel.EnableDevice()
         print(" done" if channel.IsConnected else "failed")
         return
@@ -479,6 +542,7 @@ class BPC301:
         print(mode, '\n')
         channel = self.__get_chan()
         channel.SetPositionControlMode(mode)
+        self.commanded_position["z"] = None
         sleep(0.3)
         return
     
@@ -501,6 +565,7 @@ class BPC301:
         print("\t- zeroing channel %d (%s axis)..." % (channelno, axis), end="")
         channel = self.__get_chan()
         channel.SetZero()
+        self.commanded_position[axis] = None
         return
     
     def set_position(self, z=None): 
@@ -526,12 +591,43 @@ class BPC301:
             # print("\t- moving %s axis piezo to %.3f um -->" % (axis, pos), end="")
             channel = self.__get_chan()
             channel.SetPosition(Decimal(pos))
+            self.commanded_position["z"] = float(pos)
+            self.last_command_time["z"] = timer()
             # uncomment for debugging
             # print(" done")
         else:
             print("\t- axis invalid)")
         return
 
+    def resync(self, axis="z"):
+        """
+        Method setting the commanded (shadow) position to the position read
+        from the controller
+        """
+        position = self.get_axis_position("z")
+        if position is not None:
+            self.commanded_position["z"] = position
+            self.last_resync_time["z"] = timer()
+        return
+
+    def get_commanded_position(self, axis):
+        """
+        Method returning the last commanded position (float, in µm) of the axis.
+        The controller is only read if the position is unknown or if it has
+        not been resynchronized for resync_interval s
+        """
+        if axis not in ("z"):
+            print('Error! Axis {} doesn\'t exist. Axis can only be z.'.format(axis))
+            return None
+        now = timer()
+        if self.commanded_position["z"] is None:
+            self.resync()
+        elif self.resync_interval is not None and \
+             now - self.last_resync_time["z"] > self.resync_interval and \
+             now - self.last_command_time["z"] > settling_time:
+            self.resync()
+        return self.commanded_position["z"]
+
     def get_axis_position(self, axis):
         """
         Method returning the position (float, in µm) of an specific axis/channel
@@ -549,9 +645,12 @@ class BPC301:
     def move_relative(self, axis, step):
         """
         Method setting the relative position in µm if the channel is in
-        Closed Loop mode
+        Closed Loop mode. The step is added to the last commanded position
+        (see get_commanded_position)
         """
-        actual_position = self.get_axis_position(axis)
+        actual_position = self.get_commanded_position(axis)
+        if actual_position is None:
+            return
         new_position = actual_position + step
         # uncomment for debugging
         # print("\t- piezo moving %.3f um on axis %s" % (step, axis))
@@ -188,7 +188,11 @@ if __name__ == '__main__':
     # move the timers of the z and its main worker
     worker.zWorker.trackingTimer.moveToThread(workerThread)
     worker.zWorker.viewTimer.moveToThread(workerThread)
+    worker.zWorker.calibrationTimer.moveToThread(workerThread)
     worker.zWorker.moveToThread(workerThread)
+    # connect timer after moving it
+    # configure the connection to allow queued executions to avoid interruption of previous calls
+    worker.zWorker.calibrationTimer.timeout.connect(worker.zWorker.calibration_step, QtCore.Qt.QueuedConnection)
     # move the main worker
     worker.moveToThread(workerThread)
 
@@ -52,6 +52,12 @@ xy_tuple = (xv, yv)
 gaussian_example_spot = drift.gaussian_2D(xy_tuple, 1, 0.8, 1.5, 1, 1, 0)
 initial_confocal_image_np = gaussian_example_spot.reshape((initial_scan_range_pixels_xy, initial_scan_range_pixels_xy))
 initial_scan_step_time = 25 # in ms
+# wait for the stage to settle at every pixel of the confocal scan (see
+# wait_for_settling of the piezo module), off by default because it blocks
+# the scan; when on, a pixel waits at most pixel_settling_timeout s and no
+# dwell is required (a pixel step is much smaller than the scan moves)
+settle_each_pixel = False
+pixel_settling_timeout = 0.05 # in s
 initial_threshold = 0.8 # to filter the confocal image and find the CM
 initial_confocal_filepath = 'D:\\daily_data\\confocal_data' # save in SSD for fast and daily use
 initial_confocal_filename = 'confocal_scan'
@@ -724,7 +730,7 @@ class Backend(QtCore.QObject):
         return
 
     def update_position(self):
-        self.x_pos, self.y_pos, self.z_pos = self.piezoWorker.read_position()
+        self.x_pos, self.y_pos, self.z_pos = self.piezoWorker.get_position_snapshot()
         return
 
     ############ Z SCAN ############
@@ -771,7 +777,7 @@ class Backend(QtCore.QObject):
         # print('z:', self.z_scan_array)
         # move to scan's origin
         self.piezoWorker.move_absolute([self.x_pos, self.y_pos, self.z0])
-        tm.sleep(0.25) # wait to settle (in seconds)
+        self.piezoWorker.wait_for_settling([self.x_pos, self.y_pos, self.z0])
         # allocate profile and counter
         self.z_traces = np.zeros((self.number_of_points_z_scan, self.scan_range_pixels_z))
         self.z_profile = np.zeros((self.scan_range_pixels_z))
@@ -790,6 +796,7 @@ class Backend(QtCore.QObject):
         self.laserControlWorker.shutterTrappingLaser(False)
         print('\nz scan stopped at {}'.format(timer()))
         print('Total time scanning: {:.3f} s'.format(self.total_time))
+        self.piezoWorker.report_settling_stats()
         # close z's APD task 
         self.apdTraceWorker.disarm_confocal_task() # it's called confocal but is the same!
         # move before exiting the function
@@ -815,8 +822,8 @@ class Backend(QtCore.QObject):
             if self.counter_z_steps < self.scan_range_pixels_z:
                 current_z_pos = self.z_scan_array[self.counter_z_steps]
                 # print(self.counter_z_steps, current_z_pos)
-                self.piezoWorker.move_absolute([self.x_pos, self.y_pos, current_z_pos])
-                tm.sleep(0.005) # wait to settle (in seconds)
+                self.piezoWorker.move_xyz([self.x_pos, self.y_pos, current_z_pos])
+                self.piezoWorker.wait_for_settling([None, None, current_z_pos])
                 # acquire first
                 point_trace_data = self.apdTraceWorker.acquire_confocal_trace()
                 point_trace_data_apd = point_trace_data[0]
@@ -910,7 +917,7 @@ class Backend(QtCore.QObject):
         self.create_position_grid()        
         # move to scan's origin
         self.piezoWorker.move_absolute([self.x0, self.y0, self.z_pos])
-        tm.sleep(0.25) # wait to settle (in seconds)
+        self.piezoWorker.wait_for_settling([self.x0, self.y0, self.z_pos])
         # prepare APD for signal acquisition during the scan
         scan_step_time_seconds = self.scan_step_time/1000 # to s
         self.number_of_points_confocal = self.apdTraceWorker.arm_for_confocal(scan_step_time_seconds)
@@ -953,6 +960,7 @@ class Backend(QtCore.QObject):
         self.laserControlWorker.shutterTrappingLaser(False)
         print('\nConfocal scan stopped at {}'.format(timer()))
         print('Total time scanning: {:.3f} s'.format(self.total_time))
+        self.piezoWorker.report_settling_stats()
         # close confocal's APD task 
         self.apdTraceWorker.disarm_confocal_task()
         # move before exiting the function
@@ -993,7 +1001,10 @@ class Backend(QtCore.QObject):
                     current_x_pos = self.x_scan_array[x_index]
                     current_y_pos = self.y_scan_array[y_index]
                     # print(y_index, x_index, current_x_pos, current_y_pos)
-                    self.piezoWorker.move_absolute([current_x_pos, current_y_pos, self.z_pos])
+                    self.piezoWorker.move_xyz([current_x_pos, current_y_pos, self.z_pos])
+                    if settle_each_pixel:
+                        self.piezoWorker.wait_for_settling([current_x_pos, current_y_pos, None], \
+                                                           dwell = 0, timeout = pixel_settling_timeout)
                     # acquire first
                     pixel_data = self.apdTraceWorker.acquire_confocal_trace()
                     pixel_apd_data = pixel_data[0]
@@ -1182,7 +1193,7 @@ if __name__ == '__main__':
     worker.piezoWorker.updateTimer.moveToThread(workerThread)
     worker.piezoWorker.moveToThread(workerThread)
     # connect timer after moving it
-    worker.piezoWorker.updateTimer.timeout.connect(worker.piezoWorker.read_position)
+    worker.piezoWorker.updateTimer.timeout.connect(worker.piezoWorker.poll_position)
 
     # move the timers of the xy and its main worker
     worker.xyWorker.viewTimer.moveToThread(workerThread)
@@ -1200,11 +1211,13 @@ if __name__ == '__main__':
     # move the timers of the z and its main worker
     worker.zWorker.trackingTimer.moveToThread(workerThread)
     worker.zWorker.viewTimer.moveToThread(workerThread)
+    worker.zWorker.calibrationTimer.moveToThread(workerThread)
     worker.zWorker.moveToThread(workerThread)
     # connect timers after moving them
     # configure the connection to allow queued executions to avoid interruption of previous calls
     worker.zWorker.viewTimer.timeout.connect(worker.zWorker.update_view, QtCore.Qt.QueuedConnection)
     worker.zWorker.trackingTimer.timeout.connect(worker.zWorker.call_pid, QtCore.Qt.QueuedConnection) 
+    worker.zWorker.calibrationTimer.timeout.connect(worker.zWorker.calibration_step, QtCore.Qt.QueuedConnection)
 
     # move APD tranmission signal and its timers worker 
     worker.apdTraceWorker.acquireTimer.moveToThread(workerThread)
@@ -11,8 +11,10 @@ Fribourg, Switzerland
 import os
 import sys
 import time
+import threading
 from PIL import Image as pil
 import numpy as np
+from ctypes import POINTER, c_int, c_ubyte, c_ushort
 
 # add DLLs folder to environment
 absolute_path_to_file_directory = os.path.dirname(os.path.abspath(__file__))
@@ -24,7 +26,7 @@ mono_serial_number_str = '16433'
 color_serial_number_str = '16263'
 
 # import Thorlabs SDK dll
-from thorlabs_tsi_sdk.tl_camera import TLCameraSDK, TLCamera
+from thorlabs_tsi_sdk.tl_camera import TLCameraSDK, TLCamera, _frame_available_callback_type
 from thorlabs_tsi_sdk.tl_camera_enums import SENSOR_TYPE
 from thorlabs_tsi_sdk.tl_mono_to_color_processor import MonoToColorProcessorSDK
 
@@ -161,6 +163,37 @@ def set_gain(camera, gain):
     print('Current Gain is', camera.gain)
     return
 
+def get_full_roi(camera):
+    # largest sensor ROI (upper_left_x, upper_left_y, lower_right_x, lower_right_y) in pixels
+    roi_range = camera.roi_range
+    return roi_range.upper_left_x_pixels_min, roi_range.upper_left_y_pixels_min, \
+        roi_range.lower_right_x_pixels_max, roi_range.lower_right_y_pixels_max
+
+def get_roi(camera):
+    roi = camera.roi
+    return roi.upper_left_x_pixels, roi.upper_left_y_pixels, \
+        roi.lower_right_x_pixels, roi.lower_right_y_pixels
+
+def set_roi(camera, upper_left_x, upper_left_y, lower_right_x, lower_right_y):
+    # sensor ROI in pixels (x is the column, y the row), corners included
+    # the camera has to be disarmed (see stop_camera)
+    # the corners are clipped to the allowed range and the camera may round them,
+    # returns the ROI actually set or None if it could not be set
+    roi_range = camera.roi_range
+    upper_left_x = int(np.clip(upper_left_x, roi_range.upper_left_x_pixels_min, roi_range.upper_left_x_pixels_max))
+    upper_left_y = int(np.clip(upper_left_y, roi_range.upper_left_y_pixels_min, roi_range.upper_left_y_pixels_max))
+    lower_right_x = int(np.clip(lower_right_x, roi_range.lower_right_x_pixels_min, roi_range.lower_right_x_pixels_max))
+    lower_right_y = int(np.clip(lower_right_y, roi_range.lower_right_y_pixels_min, roi_range.lower_right_y_pixels_max))
+    print('Setting camera ROI...')
+    try:
+        camera.roi = (upper_left_x, upper_left_y, lower_right_x, lower_right_y)
+    except Exception as error:
+        print('Camera ROI could not be set:', error)
+        return None
+    roi = get_roi(camera)
+    print('Camera ROI set to', roi)
+    return roi
+
 def get_camera_param(camera):
     return camera.sensor_width_pixels, camera.sensor_height_pixels, \
        camera.sensor_pixel_width_um, camera.sensor_pixel_height_um
@@ -184,6 +217,83 @@ def get_mono_image(camera):
     return mono_image, mono_image_pil, flag_ok
 
 
+def set_frame_available_callback(camera, function):
+    # the SDK calls function(image, frame_count) from its own thread for every new frame
+    # image is only valid during the call, copy it if needed
+    # has to be set while the camera is disarmed, frames are not available anymore
+    # with get_pending_frame_or_null while it is set
+    image_height_pixels = camera.image_height_pixels
+    image_width_pixels = camera.image_width_pixels
+    def frame_available(sender, image_buffer, frame_count, metadata, metadata_size_in_bytes, context):
+        image = np.ctypeslib.as_array(image_buffer, shape = (image_height_pixels, image_width_pixels))
+        function(image, frame_count)
+        return
+    # keep a reference, otherwise the C callback is garbage collected
+    camera._current_frame_available_callback = _frame_available_callback_type(frame_available)
+    error_code = camera._sdk.tl_camera_set_frame_available_callback(camera._camera, \
+                                                                    camera._current_frame_available_callback, \
+                                                                    None)
+    if error_code != 0:
+        print('Frame available callback could not be set. Error code', error_code)
+        camera._current_frame_available_callback = None
+        return False
+    print('Frame available callback set.')
+    return True
+
+def clear_frame_available_callback(camera):
+    # back to polling with get_pending_frame_or_null, camera has to be disarmed
+    error_code = camera._sdk.tl_camera_set_frame_available_callback(camera._camera, \
+                                                                    _frame_available_callback_type(), \
+                                                                    None)
+    camera._current_frame_available_callback = None
+    if error_code != 0:
+        print('Frame available callback could not be cleared. Error code', error_code)
+        return False
+    return True
+
+def get_mono_image_into(camera, slots):
+    # fast path of get_mono_image for loops: the frame is copied into the next
+    # buffer of slots (see image_slots), nothing is allocated and no PIL image is
+    # built (use to_pil_image when it is needed)
+    frame = camera.get_pending_frame_or_null()
+    if frame is None:
+        print("\nTimeout reached during polling. None image returned.")
+        return None, False
+    image = slots.fill(frame.image_buffer)
+    if image is None:
+        print("\nAll image slots are in use. Frame dropped.")
+        return None, False
+    return image, True
+
+def get_color_image_into(camera, mono_to_color_processor, slots):
+    # fast path of get_color_image, same as get_mono_image_into
+    # the SDK writes the 24 bpp image directly into the next buffer of slots
+    frame = camera.get_pending_frame_or_null()
+    if frame is None:
+        print("\nTimeout reached during polling. None image returned.")
+        return None, False
+    image_height_pixels, image_width_pixels = frame.image_buffer.shape
+    color_image = slots.next_slot((image_height_pixels, image_width_pixels, 3), np.uint8)
+    if color_image is None:
+        print("\nAll image slots are in use. Frame dropped.")
+        return None, False
+    error_code = mono_to_color_processor._sdk.tl_mono_to_color_transform_to_24(mono_to_color_processor._mono_to_color_processor_handle, \
+                                                                             frame.image_buffer.ctypes.data_as(POINTER(c_ushort)), \
+                                                                             c_int(image_width_pixels), \
+                                                                             c_int(image_height_pixels), \
+                                                                             color_image.ctypes.data_as(POINTER(c_ubyte)))
+    if error_code != 0:
+        print('Could not transform image to 24 bpp. Error code', error_code)
+        slots.release(color_image)
+        return None, False
+    return color_image, True
+
+def to_pil_image(image_np):
+    # PIL image of a frame, only when needed (e.g. to save it)
+    if image_np.ndim == 3:
+        return pil.fromarray(image_np, mode = 'RGB')
+    return pil.fromarray(image_np)
+
 def get_color_image(camera, mono_to_color_processor):
     color_cam_sensor_width_pixels, color_cam_sensor_height_pixels, \
        sensor_pixel_width_um, sensor_pixel_height_um = get_camera_param(camera)
@@ -256,6 +366,85 @@ def dispose_all(mono_cam_flag, mono_cam, color_cam_flag, color_cam, \
 
 #=====================================
 
+# Classes Definitions
+
+#=====================================
+
+class image_slots(object):
+    # ring of reusable image buffers for get_mono_image_into/get_color_image_into
+    # a filled slot is in use until its consumer calls release (hold adds one
+    # more user, e.g. the Frontend displaying it), busy slots are skipped and
+    # when all of them are busy the new frame is dropped instead, so an image
+    # that is still displayed or processed is never overwritten while the next
+    # one is acquired (e.g. from the frame available callback)
+    # 4 slots by default: the one being acquired, the one being processed and
+    # the two last frames sent to the Frontend (the GUIs keep two, see
+    # displayed_frames_kept), since the display can lag one frame behind
+    def __init__(self, number_of_slots = 4):
+        if number_of_slots < 2:
+            print('At least 2 image slots are needed. Using 2.')
+            number_of_slots = 2
+        self.slots = [None]*number_of_slots
+        self.users = [0]*number_of_slots
+        self.index = 0
+        self.dropped_frames = 0
+        # slots are taken in the camera SDK thread and released in the GUI ones
+        self.lock = threading.Lock()
+        return
+
+    def next_slot(self, shape, dtype):
+        # free buffer to be filled, (re)allocated only when the image size changes
+        # returns None (frame dropped) if all slots are in use
+        with self.lock:
+            number_of_slots = len(self.slots)
+            for step in range(1, number_of_slots + 1):
+                index = (self.index + step) % number_of_slots
+                if self.users[index] == 0:
+                    break
+            else:
+                self.dropped_frames += 1
+                return None
+            self.index = index
+            self.users[index] = 1
+        slot = self.slots[index]
+        if slot is None or slot.shape != tuple(shape) or slot.dtype != dtype:
+            slot = np.empty(shape, dtype = dtype)
+            self.slots[index] = slot
+        return slot
+
+    def fill(self, image):
+        slot = self.next_slot(image.shape, image.dtype)
+        if slot is None:
+            return None
+        np.copyto(slot, image)
+        return slot
+
+    def find_slot(self, image):
+        # index of the slot holding image (or a view of it, e.g. flipped)
+        if image is None:
+            return None
+        for index, slot in enumerate(self.slots):
+            if slot is not None and np.may_share_memory(slot, image):
+                return index
+        return None
+
+    def hold(self, image):
+        index = self.find_slot(image)
+        if index is not None:
+            with self.lock:
+                self.users[index] += 1
+        return
+
+    def release(self, image):
+        # images that are not in a slot (e.g. dummy images) are ignored
+        index = self.find_slot(image)
+        if index is not None:
+            with self.lock:
+                self.users[index] = max(self.users[index] - 1, 0)
+        return
+
+#=====================================
+
 # Main program
 
 #=====================================
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming recorder of image sequences (e.g. the ROI video of the xy
+stabilization module). Frames are written as pages of a BigTIFF file by a
+background thread, so memory use does not grow with the recording length
+and stopping a recording does not wait for the data to be saved (unless
+asked to, e.g. when closing).
+"""
+
+import queue
+import threading
+import numpy as np
+import tifffile as tiff
+
+#=====================================
+
+# Recorder Class Definition
+
+#=====================================
+
+class tiff_video_recorder(object):
+    def __init__(self, full_filename, max_queued_frames = 512):
+        # frames waiting to be written are kept in a bounded queue
+        # if the disk cannot keep up, new frames are dropped (and counted)
+        # instead of blocking the acquisition
+        self.full_filename = full_filename
+        self.queue = queue.Queue(maxsize = max_queued_frames)
+        self.stop_event = threading.Event()
+        self.frames_written = 0
+        self.frames_dropped = 0
+        # not a daemon, the interpreter waits for the queued frames to be
+        # written before exiting (a killed writer would truncate the file)
+        self.thread = threading.Thread(target = self.write_frames, daemon = False)
+        self.thread.start()
+        return
+
+    def append(self, frame):
+        # the frame is copied, the caller can reuse its buffer
+        if self.stop_event.is_set():
+            return
+        try:
+            self.queue.put_nowait(np.array(frame, copy = True))
+        except queue.Full:
+            self.frames_dropped += 1
+        return
+
+    def write_frames(self):
+        # all frames go to the same series of a BigTIFF file (no 4 GB limit)
+        with tiff.TiffWriter(self.full_filename, bigtiff = True) as writer:
+            while not (self.stop_event.is_set() and self.queue.empty()):
+                try:
+                    frame = self.queue.get(timeout = 0.1)
+                except queue.Empty:
+                    continue
+                writer.write(frame, contiguous = True, photometric = 'minisblack')
+                self.frames_written += 1
+        print('Video {} closed. Frames written: {}, dropped: {}'.format(self.full_filename, \
+                                                                       self.frames_written, \
+                                                                       self.frames_dropped))
+        return
+
+    def stop(self, wait = False):
+        # returns immediately, queued frames are written in the background
+        self.stop_event.set()
+        if wait:
+            self.thread.join()
+        return
+
+    def is_writing(self):
+        return self.thread.is_alive()
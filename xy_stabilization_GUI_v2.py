@@ -11,6 +11,7 @@ Fribourg, Switzerland
 import os
 import sys
 import numpy as np
+import multiprocessing as mp
 from datetime import datetime
 from timeit import default_timer as timer
 import pyqtgraph as pg
@@ -28,6 +29,8 @@ from concurrent.futures import ThreadPoolExecutor
 
 import pco_camera_toolbox as pco
 import drift_correction_toolbox as drift
+import video_recorder_toolbox as video
+import loop_profiler_toolbox as profiler
 
 #=====================================
 
@@ -35,9 +38,18 @@ import drift_correction_toolbox as drift
 
 #=====================================
 
-cam = pco.pco_camera()
-# cam = pco.pco_camera(debug = 'verbose', timestamp_flag = 'on')
-# cam = pco.pco_camera(debug = 'extra verbose', timestamp_flag = 'on')
+# images are stamped by the camera (image number and hardware time, in the
+# first pixels of each image) to identify frames and build the drift time axis
+# binary only, the ASCII stamp would be drawn into the image
+# (the binary stamp pixels are masked by pco_camera.get_image)
+# the worker processes of the fiducial fitting pool (see fiducial_fitting_worker)
+# import the main script again, only the main process opens the camera
+if mp.parent_process() is None:
+    cam = pco.pco_camera(timestamp_flag = 'binary')
+    # cam = pco.pco_camera(debug = 'verbose', timestamp_flag = 'binary')
+    # cam = pco.pco_camera(debug = 'extra verbose', timestamp_flag = 'binary')
+else:
+    cam = None
 initial_binning = 4
 initial_pixel_size = 260 # in nm (with 4x4 binning)
 initial_exp_time = 150.0 # in ms
@@ -54,6 +66,32 @@ tempTimer_update = 10000 # in ms
 initial_tracking_period = 200 # in ms
 initial_box_size = 11 # always odd number pixels
 initial_number_of_boxes = 8
+initial_localization_method = 'Gaussian fit' # see drift.localization_methods
+# per-fiducial localization engines plus global image registration of the fiducials' region
+tracking_methods = list(drift.localization_methods.keys()) + ['Cross-correlation']
+# fit the fiducials in a pool of processes (the pool is started when locking)
+initial_parallel_fitting = False
+# while locked, read from the camera only the region covering the fiducials
+initial_lock_mode_readout = False
+# time to wait for the first frame after changing the camera ROI
+# (a few exposure times, but never more than readout_change_timeout)
+readout_change_exposures = 5
+readout_change_timeout = 2 # in s
+# save the timestamps of every stage of the tracking loop (binary file, see loop_profiler_toolbox)
+save_loop_latency_log = False
+# track on every new camera frame instead of using the tracking period
+initial_frame_driven_tracking = False
+initial_frame_decimation = 1 # use 1 out of N frames
+# fit only the best fiducials (highest SNR) that fit in this time per tick
+initial_latency_budget = 0 # in ms, 0 fits all fiducials
+# fiducials outside the best ones that are fitted each tick, in turns
+fiducial_rotation_slots = 1
+# estimate the drift with a constant-velocity Kalman filter per axis and
+# correct the error predicted for the moment the piezo move takes effect
+initial_kalman_filter = False
+kalman_process_noise = 1e-8 # in um^2/s^3, spectral density of the drift acceleration
+kalman_measurement_noise = 2.5e-5 # in um^2, variance of the averaged error (5 nm std)
+piezo_response_time = 0.010 # in s, from sending a move until it takes effect
 driftbox_length = 10.0 # in seconds
 initial_box_size_to_record = 31 # always odd number pixels
 intensitybox_length = 10.0 # in seconds
@@ -107,6 +145,12 @@ class Frontend(QtGui.QFrame):
     dataIntensityROISignal = pyqtSignal(np.ndarray, bool)
     pidParamChangedSignal = pyqtSignal(bool, list)
     correctionThresholdChangedSignal = pyqtSignal(float)
+    localizationMethodChangedSignal = pyqtSignal(str)
+    parallelFittingSignal = pyqtSignal(bool)
+    lockModeReadoutSignal = pyqtSignal(bool)
+    trackingTriggerSignal = pyqtSignal(bool, int)
+    kalmanFilterSignal = pyqtSignal(bool)
+    latencyBudgetSignal = pyqtSignal(float)
     
     def __init__(self, piezo_frontend, show_piezo_subGUI = True, main_app = True, \
                  connect_to_piezo_module = True, *args, **kwargs):
@@ -284,6 +328,41 @@ class Frontend(QtGui.QFrame):
             "QPushButton:pressed { background-color: red; }"
             "QPushButton::checked { background-color: orange; }")
 
+        # localization method
+        localization_method_label = QtGui.QLabel('Localization method:')
+        self.localization_method_list = QtGui.QComboBox()
+        self.localization_method_list.addItems(tracking_methods)
+        self.localization_method_list.setCurrentText(initial_localization_method)
+        self.localization_method_list.setToolTip('Gaussian fit also retrieves the width. Radial symmetry and Phasor are non-iterative (faster).\n' \
+                                                 'Cross-correlation registers the region covering all ROIs (no isolated beads needed).\n' \
+                                                 'Can only be changed while unlocked.')
+        self.localization_method_list.currentTextChanged.connect(self.localization_method_changed)
+        
+        # parallel fitting
+        self.parallel_fitting_tickbox = QtGui.QCheckBox('Parallel fitting (processes)')
+        self.parallel_fitting_tickbox.setChecked(initial_parallel_fitting)
+        self.parallel_fitting_tickbox.setToolTip('Localize each fiducial in a separate process. Worth it for many fiducials or large ROIs.\n' \
+                                                 'The pool of processes starts when locking (takes a few seconds).\n' \
+                                                 'Can only be changed while unlocked.')
+        self.parallel_fitting_tickbox.stateChanged.connect(self.parallel_fitting_changed)
+        
+        # lock-mode readout
+        self.lock_mode_readout_tickbox = QtGui.QCheckBox('Lock-mode readout')
+        self.lock_mode_readout_tickbox.setChecked(initial_lock_mode_readout)
+        self.lock_mode_readout_tickbox.setToolTip('While locked, the camera ROI is reduced to the region covering all fiducials\' ROIs (faster readout).\n' \
+                                                  'The full ROI is restored when unlocking. Requires the live view.\n' \
+                                                  'Can only be changed while unlocked.')
+        self.lock_mode_readout_tickbox.stateChanged.connect(self.lock_mode_readout_changed)
+
+        # latency budget
+        self.latency_budget_label = QtGui.QLabel('Latency budget (ms):')
+        self.latency_budget_value = QtGui.QLineEdit(str(initial_latency_budget))
+        self.latency_budget_value.setValidator(QtGui.QDoubleValidator(0, 10000, 1))
+        self.latency_budget_value.setToolTip('Time allowed to localize fiducials per tick. Only the fiducials with the best SNR\n' \
+                                             'that fit in it are used, the others are fitted in turns. 0 uses all fiducials.\n' \
+                                             'Not used by the parallel fitting nor by the cross-correlation.')
+        self.latency_budget_value.editingFinished.connect(self.latency_budget_changed)
+
         # tracking period
         self.tracking_period_label = QtGui.QLabel('Tracking period (s):')
         self.tracking_period_value = QtGui.QLineEdit(str(initial_tracking_period/1000))
@@ -291,6 +370,18 @@ class Frontend(QtGui.QFrame):
         self.tracking_period_value.setToolTip('Period to measure fiducial markers\' position.')
         self.tracking_period_value.editingFinished.connect(self.tracking_period_changed_check)
         
+        # frame-driven tracking
+        self.frame_driven_tickbox = QtGui.QCheckBox('Track every new frame')
+        self.frame_driven_tickbox.setChecked(initial_frame_driven_tracking)
+        self.frame_driven_tickbox.setToolTip('Run the tracking once per new camera frame instead of using the tracking period.\n' \
+                                             'Can only be changed while unlocked.')
+        self.frame_driven_tickbox.stateChanged.connect(self.tracking_trigger_changed)
+        self.frame_decimation = initial_frame_decimation
+        self.frame_decimation_value = QtGui.QLineEdit(str(self.frame_decimation))
+        self.frame_decimation_value.setValidator(QtGui.QIntValidator(1, 1000))
+        self.frame_decimation_value.setToolTip('Decimation: use 1 out of N new frames.')
+        self.frame_decimation_value.editingFinished.connect(self.tracking_trigger_changed)
+        
         # drift threshold
         self.correction_threshold_label = QtGui.QLabel('Drift threshold (μm):')
         self.correction_threshold_value = QtGui.QLineEdit(str(initial_correction_threshold))
@@ -308,6 +399,12 @@ class Frontend(QtGui.QFrame):
         
         # PID parameters
         self.pid_label = QtGui.QLabel('PID parameters')
+        self.kalman_filter_tickbox = QtGui.QCheckBox('Predictive (Kalman)')
+        self.kalman_filter_tickbox.setChecked(initial_kalman_filter)
+        self.kalman_filter_tickbox.setToolTip('Estimate drift position and velocity with a Kalman filter and correct the error\n' \
+                                              'predicted for the moment the piezo move takes effect. Allows longer tracking periods.\n' \
+                                              'Can only be changed while unlocked.')
+        self.kalman_filter_tickbox.stateChanged.connect(self.kalman_filter_changed)
         self.kp_label = QtGui.QLabel('K_proportional:')
         self.kp_value = QtGui.QLineEdit(str(initial_kp))
         self.kp_value.editingFinished.connect(self.pid_param_changed_check)
@@ -407,26 +504,35 @@ class Frontend(QtGui.QFrame):
         layout_fiducials.addWidget(self.create_ROIs_button,         2, 0, 1, 2)
         layout_fiducials.addWidget(self.lock_ROIs_button,         3, 0, 1, 2)
         layout_fiducials.addWidget(self.correct_drift_button,         4, 0, 1, 2)
-        layout_fiducials.addWidget(self.tracking_period_label,         5, 0)
-        layout_fiducials.addWidget(self.tracking_period_value,         5, 1)
-        layout_fiducials.addWidget(self.correction_threshold_label,         6, 0)
-        layout_fiducials.addWidget(self.correction_threshold_value,         6, 1)
-        layout_fiducials.addWidget(self.pid_label,         7, 0)
-        layout_fiducials.addWidget(self.kp_label,         8, 0)
-        layout_fiducials.addWidget(self.kp_value,         8, 1)
-        layout_fiducials.addWidget(self.ki_label,         9, 0)
-        layout_fiducials.addWidget(self.ki_value,         9, 1)
-        layout_fiducials.addWidget(self.kd_label,         10, 0)
-        layout_fiducials.addWidget(self.kd_value,         10, 1)
+        layout_fiducials.addWidget(localization_method_label,         5, 0)
+        layout_fiducials.addWidget(self.localization_method_list,         5, 1)
+        layout_fiducials.addWidget(self.parallel_fitting_tickbox,         6, 0, 1, 2)
+        layout_fiducials.addWidget(self.lock_mode_readout_tickbox,         7, 0, 1, 2)
+        layout_fiducials.addWidget(self.latency_budget_label,         8, 0)
+        layout_fiducials.addWidget(self.latency_budget_value,         8, 1)
+        layout_fiducials.addWidget(self.tracking_period_label,         9, 0)
+        layout_fiducials.addWidget(self.tracking_period_value,         9, 1)
+        layout_fiducials.addWidget(self.frame_driven_tickbox,         10, 0)
+        layout_fiducials.addWidget(self.frame_decimation_value,         10, 1)
+        layout_fiducials.addWidget(self.correction_threshold_label,         11, 0)
+        layout_fiducials.addWidget(self.correction_threshold_value,         11, 1)
+        layout_fiducials.addWidget(self.pid_label,         12, 0)
+        layout_fiducials.addWidget(self.kalman_filter_tickbox,         12, 1)
+        layout_fiducials.addWidget(self.kp_label,         13, 0)
+        layout_fiducials.addWidget(self.kp_value,         13, 1)
+        layout_fiducials.addWidget(self.ki_label,         14, 0)
+        layout_fiducials.addWidget(self.ki_value,         14, 1)
+        layout_fiducials.addWidget(self.kd_label,         15, 0)
+        layout_fiducials.addWidget(self.kd_value,         15, 1)
         # save drift
-        layout_fiducials.addWidget(self.savedrift_tickbox,      11, 0, 2, 2)
+        layout_fiducials.addWidget(self.savedrift_tickbox,      16, 0, 2, 2)
         # Record a fragment of the sensor
-        layout_fiducials.addWidget(self.create_ROI_to_record_button,      13, 0, 1, 2)
-        layout_fiducials.addWidget(roi_to_record_size_label,              14, 0)
-        layout_fiducials.addWidget(self.roi_to_record_size_value,         14, 1)
-        layout_fiducials.addWidget(self.record_ROI_button,         15, 0, 1, 2)
+        layout_fiducials.addWidget(self.create_ROI_to_record_button,      18, 0, 1, 2)
+        layout_fiducials.addWidget(roi_to_record_size_label,              19, 0)
+        layout_fiducials.addWidget(self.roi_to_record_size_value,         19, 1)
+        layout_fiducials.addWidget(self.record_ROI_button,         20, 0, 1, 2)
         # save intensity
-        layout_fiducials.addWidget(self.save_intensity_ROI_tickbox,      16, 0, 2, 2)
+        layout_fiducials.addWidget(self.save_intensity_ROI_tickbox,      21, 0, 2, 2)
 
         # Place layouts and boxes
         dockArea = DockArea()
@@ -483,6 +589,38 @@ class Frontend(QtGui.QFrame):
             self.correctionThresholdChangedSignal.emit(self.correction_threshold)
         return
     
+    def localization_method_changed(self, selected_method):
+        self.localizationMethodChangedSignal.emit(selected_method)
+        return
+
+    def parallel_fitting_changed(self):
+        self.parallelFittingSignal.emit(self.parallel_fitting_tickbox.isChecked())
+        return
+
+    def lock_mode_readout_changed(self):
+        self.lockModeReadoutSignal.emit(self.lock_mode_readout_tickbox.isChecked())
+        return
+
+    def kalman_filter_changed(self):
+        self.kalmanFilterSignal.emit(self.kalman_filter_tickbox.isChecked())
+        return
+
+    def latency_budget_changed(self):
+        self.latencyBudgetSignal.emit(float(self.latency_budget_value.text()))
+        return
+
+    def tracking_trigger_changed(self):
+        decimation_text = self.frame_decimation_value.text()
+        if decimation_text.isdigit() and int(decimation_text) > 0:
+            self.frame_decimation = int(decimation_text)
+        else:
+            # empty or invalid decimation (e.g. the tick box was toggled while
+            # editing it), keep the current one
+            self.frame_decimation_value.setText(str(self.frame_decimation))
+        self.trackingTriggerSignal.emit(self.frame_driven_tickbox.isChecked(), \
+                                        self.frame_decimation)
+        return
+
     def create_ROIs(self):
         # create ROIs for the fiducial markers
         self.number_of_fiducials = int(self.number_of_fiducials_value.text())
@@ -546,6 +684,12 @@ class Frontend(QtGui.QFrame):
         if self.lock_ROIs_button.isChecked():
             if self.create_ROIs_button.isChecked():
                 self.driftPlot.clear()
+                self.localization_method_list.setEnabled(False)
+                self.parallel_fitting_tickbox.setEnabled(False)
+                self.lock_mode_readout_tickbox.setEnabled(False)
+                self.frame_driven_tickbox.setEnabled(False)
+                self.frame_decimation_value.setEnabled(False)
+                self.kalman_filter_tickbox.setEnabled(False)
                 self.lockAndTrackSignal.emit(True)
                 self.data_ROI = {}
                 self.coord_ROI = {}
@@ -556,6 +700,12 @@ class Frontend(QtGui.QFrame):
                 print('Warning! Lock and Track can only be used if fiducials\' ROIs have been created.')
         else:
             self.lockAndTrackSignal.emit(False)
+            self.localization_method_list.setEnabled(True)
+            self.parallel_fitting_tickbox.setEnabled(True)
+            self.lock_mode_readout_tickbox.setEnabled(True)
+            self.frame_driven_tickbox.setEnabled(True)
+            self.frame_decimation_value.setEnabled(True)
+            self.kalman_filter_tickbox.setEnabled(True)
             if self.savedrift_bool:
                 self.savedriftSignal.emit()
             self.xy_fiducials.clear()
@@ -774,6 +924,12 @@ class Frontend(QtGui.QFrame):
         # remove lock and track
         self.lock_ROIs_button.setChecked(False)
         self.lockAndTrackSignal.emit(False)
+        self.localization_method_list.setEnabled(True)
+        self.parallel_fitting_tickbox.setEnabled(True)
+        self.lock_mode_readout_tickbox.setEnabled(True)
+        self.frame_driven_tickbox.setEnabled(True)
+        self.frame_decimation_value.setEnabled(True)
+        self.kalman_filter_tickbox.setEnabled(True)
         self.xy_fiducials.clear()
         # remove live acquisition
         self.liveViewSignal.emit(False, 0) # the exposure time is not relevant
@@ -824,6 +980,8 @@ class Backend(QtCore.QObject):
     sendFittedDataSignal = pyqtSignal(dict, np.ndarray, float)
     sendRecordedIntensityDataSignal = pyqtSignal(float, float)
     filePathSignal = pyqtSignal(str)
+    # emitted by the frame grabber thread, queued to this thread
+    newFrameSignal = pyqtSignal(int)
     
     def __init__(self, piezo, piezo_backend, connect_to_piezo_module = True, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -834,11 +992,24 @@ class Backend(QtCore.QObject):
         self.tempTimer = QtCore.QTimer()
         self.image_np = None
         self.roi_frame = None
+        # frames are pulled from the camera in a producer thread
+        # the tracker takes the newest frame it has not seen yet
+        self.frame_grabber = pco.pco_frame_grabber(cam)
+        self.tracking_frame = None
+        self.skipped_ticks = 0
+        # timestamps of each stage of call_pid
+        self.loop_profiler = profiler.loop_profiler(['frame', 'localization', 'error', 'pid', 'piezo'], \
+                                                    self.tracking_period)
+        self.frame_driven_tracking = initial_frame_driven_tracking
+        self.frame_decimation = initial_frame_decimation
+        self.frame_driven_lock = False
+        self.newFrameSignal.connect(self.new_frame_available)
         self.binning = initial_binning
         self.pixel_size = initial_pixel_size
         self.exposure_time_ms = initial_exp_time
         self.file_path = initial_filepath
         self.recordingTimer = QtCore.QTimer()
+        self.roi_video_recorder = None
         self.trackingTimer = QtCore.QTimer()
         self.recording_period = initial_exp_time
         self.tracking_period = initial_tracking_period
@@ -847,8 +1018,33 @@ class Backend(QtCore.QObject):
         self.int_correction = np.array([0, 0])
         self.dev_correction = np.array([0, 0])
         self.last_error_avg = np.array([0, 0])
+        # drift estimator, fed with the averaged error and the corrections sent
+        self.kalman_filter = initial_kalman_filter
+        self.drift_estimator = drift.constant_velocity_kalman(kalman_process_noise, \
+                                                              kalman_measurement_noise)
+        self.applied_correction = np.zeros(2)
+        self.last_fitted_image_number = None
+        self.first_hardware_time = None
+        self.time_base = 'software'
         self.pid_param_list = [initial_kp, initial_ki, initial_kd]
         self.correct_drift_flag = False
+        self.localization_method = initial_localization_method
+        # per-fiducial fit state (grids, bounds and last solution) to warm-start the fits
+        self.fit_states = {}
+        self.centers = {}
+        self.parallel_fitting = initial_parallel_fitting
+        self.fitting_pool = None
+        # fit only the best fiducials that fit in the latency budget (see select_fiducials)
+        self.latency_budget_ms = initial_latency_budget
+        self.fiducial_scores = {}
+        self.fit_cost_ms = np.nan # per fiducial, moving average
+        self.rotation_index = 0
+        self.roi_list = initial_roi_list
+        self.lock_mode_readout = initial_lock_mode_readout
+        # camera ROI used while locked, None when reading the full ROI
+        self.readout_roi_list = None
+        # readout pixel = full ROI pixel + offset (along each axis of image_np)
+        self.readout_offset = np.array([0, 0])
         cam.set_binning(self.binning)
         cam.set_roi(initial_roi_list[0], \
                     initial_roi_list[1], \
@@ -861,6 +1057,8 @@ class Backend(QtCore.QObject):
     @pyqtSlot(bool, list)    
     def change_roi(self, livebool, roi_list):
         print('\nROI changed to', roi_list)
+        self.roi_list = roi_list
+        self.invalidate_fit_states()
         if livebool:
             self.stop_liveview()
             cam.set_roi(roi_list[0], roi_list[1], roi_list[2], roi_list[3])
@@ -886,6 +1084,7 @@ class Backend(QtCore.QObject):
         print('\nBinning changed to %d x %d' % (binning, binning))
         self.binning = binning # is int
         self.pixel_size = pixel_size
+        self.invalidate_fit_states()
         if livebool:
             self.stop_liveview()
             cam.set_binning(self.binning)
@@ -898,7 +1097,9 @@ class Backend(QtCore.QObject):
     def change_tracking_period(self, lockbool, new_tracking_period):
         print('\nTracking period changed to {:.3f} s.'.format(new_tracking_period/1000))
         self.tracking_period = new_tracking_period
-        if lockbool:
+        if lockbool and not self.frame_driven_lock:
+            self.tracking_period_seconds = self.tracking_period/1000
+            self.loop_profiler.reset(self.tracking_period)
             print('Restarting QtTimer...')
             self.trackingTimer.stop()
             self.trackingTimer.start(self.tracking_period)
@@ -910,14 +1111,80 @@ class Backend(QtCore.QObject):
                                                                         pid_param_list[1], \
                                                                         pid_param_list[2]))
         self.pid_param_list = pid_param_list
-        if lockbool:
+        if lockbool and not self.frame_driven_lock:
             print('Restarting QtTimer...')
             self.trackingTimer.stop()
             self.trackingTimer.start(self.tracking_period)
         return
     
+    @pyqtSlot(str)
+    def change_localization_method(self, new_localization_method):
+        print('\nLocalization method changed to %s.' % new_localization_method)
+        self.localization_method = new_localization_method
+        return
+
+    @pyqtSlot(bool)
+    def change_parallel_fitting(self, parallel_bool):
+        self.parallel_fitting = parallel_bool
+        if self.parallel_fitting:
+            print('\nFiducials will be fitted in parallel processes.')
+        else:
+            print('\nFiducials will be fitted in the main process.')
+        return
+
+    @pyqtSlot(bool)
+    def change_kalman_filter(self, kalman_bool):
+        self.kalman_filter = kalman_bool
+        if self.kalman_filter:
+            print('\nDrift will be predicted with a Kalman filter.')
+        else:
+            print('\nDrift will be corrected with the measured error.')
+        return
+
+    @pyqtSlot(bool, int)
+    def change_tracking_trigger(self, frame_driven_bool, decimation):
+        self.frame_driven_tracking = frame_driven_bool
+        self.frame_decimation = max(decimation, 1)
+        if self.frame_driven_tracking:
+            print('\nTracking on 1 out of {} new frames.'.format(self.frame_decimation))
+        else:
+            print('\nTracking every {:.3f} s.'.format(self.tracking_period/1000))
+        return
+
+    @pyqtSlot(int)
+    def new_frame_available(self, sequence):
+        # frame-driven tracking: call_pid once per new frame (or every N frames)
+        if not self.frame_driven_lock:
+            return
+        self.frames_since_last_tick += 1
+        if self.frames_since_last_tick >= self.frame_decimation:
+            self.frames_since_last_tick = 0
+            # the frame rate changes with the readout ROI, keep the PID period updated
+            self.tracking_period_seconds = self.frame_driven_period()/1000
+            self.call_pid()
+        return
+
+    def frame_driven_period(self):
+        # period of the frame-driven loop in ms, from the measured frame period
+        # the exposure time is only used until two frames have been received
+        frame_period_ms = self.frame_grabber.get_frame_period()*1000
+        if np.isnan(frame_period_ms):
+            frame_period_ms = self.exposure_time_ms
+        return frame_period_ms*self.frame_decimation
+
+    @pyqtSlot(bool)
+    def change_lock_mode_readout(self, readout_bool):
+        self.lock_mode_readout = readout_bool
+        if self.lock_mode_readout:
+            print('\nCamera ROI will be reduced to the fiducials while locked.')
+        else:
+            print('\nFull camera ROI will be read while locked.')
+        return
+
     @pyqtSlot(bool)
     def start_stop_tracking(self, trackbool):
+        # the piezo position is not polled while locked
+        self.piezoWorker.set_stabilization_lock('xy', trackbool)
         if trackbool:
             print('\nLocking and tracking fiducials...')
             # initiating variables...
@@ -928,16 +1195,68 @@ class Backend(QtCore.QObject):
             self.int_correction = 0
             self.dev_correction = 0
             self.last_error_avg = 0
+            self.drift_estimator.reset()
+            self.applied_correction = np.zeros(2)
+            # frame identity, see pco.frame_identity
+            self.last_fitted_image_number = None
+            self.first_hardware_time = None
+            self.time_base = 'software'
             # t0 initial time
             self.start_tracking_time = timer()
             # ask for ROI data and coordinates
             self.get_fiducials_data()
-            # start timer
-            self.trackingTimer.start(self.tracking_period)
+            # count frames from now on
+            self.frame_grabber.reset_counters()
+            self.skipped_ticks = 0
+            if self.frame_driven_tracking:
+                # the PID runs at the frame rate divided by the decimation
+                loop_period = self.frame_driven_period()
+            else:
+                loop_period = self.tracking_period
+            self.tracking_period_seconds = loop_period/1000
+            self.loop_profiler.reset(loop_period)
+            if save_loop_latency_log:
+                timestr = datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
+                filename = "loop_latency_xy_" + timestr + ".bin"
+                self.loop_profiler.start_log(os.path.join(self.file_path, filename))
+            if self.frame_driven_tracking:
+                # each new frame of the grabber triggers the tracking
+                self.frames_since_last_tick = 0
+                self.frame_driven_lock = True
+                self.frame_grabber.frame_callback = self.newFrameSignal.emit
+            else:
+                # start timer
+                self.trackingTimer.start(self.tracking_period)
             self.time_since_epoch = tm.time()
         else:
             self.trackingTimer.stop()
+            self.frame_driven_lock = False
+            self.frame_grabber.frame_callback = None
             print('\nUnlocking...')
+            self.stop_fitting_pool()
+            self.restore_readout()
+            acquired, duplicated, dropped = self.frame_grabber.get_counters()
+            print('Frames acquired: {}, duplicated: {}, dropped: {}. Ticks without new frame: {}'.format(acquired, \
+                                                                                                     duplicated, \
+                                                                                                     dropped, \
+                                                                                                     self.skipped_ticks))
+            self.loop_profiler.report()
+            self.loop_profiler.stop_log()
+            if self.kalman_filter:
+                self.report_innovation_stats()
+        return
+
+    def report_innovation_stats(self):
+        stats = self.drift_estimator.innovation_stats()
+        if stats is None:
+            print('Not enough measurements to report the Kalman innovations.')
+            return
+        print('Kalman innovations over {} measurements:'.format(stats['number']))
+        for k, axis in enumerate(['x', 'y']):
+            print('  {}: mean {:.1f} nm / std {:.1f} nm / NIS {:.2f}'.format(axis, \
+                                                                         stats['mean'][k]*1000, \
+                                                                         stats['std'][k]*1000, \
+                                                                         stats['nis'][k]))
         return
     
     @pyqtSlot(bool)
@@ -949,8 +1268,8 @@ class Backend(QtCore.QObject):
             self.recorded_timestamp = np.nan
             self.recorded_intensity_to_save = []
             self.recorded_timeaxis_to_save = []
-            # allocate ROI frame
-            self.roi_video_to_save = []
+            # the ROI video is streamed to disk, the file is created with the first frame
+            self.roi_video_recorder = None
             # t0 initial time
             self.start_recording_time = timer()
             # ask for ROI coordinates and size
@@ -961,6 +1280,7 @@ class Backend(QtCore.QObject):
         else:
             self.recordingTimer.stop()
             print('\nStop recording the ROI intensity...')
+            self.stop_roi_video_recorder()
         return
 
     def get_recording_roi_data(self):
@@ -988,6 +1308,14 @@ class Backend(QtCore.QObject):
             self.y1[i] = int(self.frame_coordinates[i][1,0,0])
             self.y2[i] = int(self.frame_coordinates[i][1,0,-1]) + 1
             # then frame_intensity is self.image_np[x1:x2, y1:y2]
+        # new ROIs, previous solutions are not valid anymore
+        self.invalidate_fit_states()
+        if self.lock_mode_readout:
+            self.shrink_readout()
+        if self.localization_method == 'Cross-correlation':
+            self.set_registration_reference()
+        elif self.parallel_fitting:
+            self.start_fitting_pool()
         print('\nFinding initial coordinates...')
         self.initial_centers, _ = self.fit_fiducials()
         print('Done.')
@@ -1011,7 +1339,7 @@ class Backend(QtCore.QObject):
         x2 = self.x_roi_intensity_2
         y1 = self.y_roi_intensity_1
         y2 = self.y_roi_intensity_2
-        self.roi_frame = np.array(self.image_np[x1:x2, y1:y2], dtype='uint16')
+        self.roi_frame = np.array(self.get_full_frame()[x1:x2, y1:y2], dtype='uint16')
         # calculate integrated intensity
         self.recorded_intensity = np.sum(self.roi_frame)
         self.recorded_timestamp = timer() - self.start_recording_time
@@ -1021,59 +1349,128 @@ class Backend(QtCore.QObject):
         if self.save_recorded_intensity_data:
             self.recorded_timeaxis_to_save.append(self.recorded_timestamp)
             self.recorded_intensity_to_save.append(self.recorded_intensity)
-            self.roi_video_to_save.append(self.roi_frame)
-        # print((sys.getsizeof(self.roi_video_to_save)/1024))
+            if self.roi_video_recorder is None:
+                timestr = datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
+                filename = "roi_video_" + timestr + ".tiff"
+                self.roi_video_filename = os.path.join(self.file_path, filename)
+                self.roi_video_recorder = video.tiff_video_recorder(self.roi_video_filename)
+            # transposed to keep the orientation of the videos saved before
+            self.roi_video_recorder.append(self.roi_frame.T)
+        return
+
+    def stop_roi_video_recorder(self, wait = False):
+        # by default does not wait, pending frames are written in the background
+        # wait = True when closing, so the file is complete before exiting
+        if self.roi_video_recorder is not None:
+            self.roi_video_recorder.stop(wait = wait)
         return
 
     def call_pid(self):
         error = {}
-        centers, timeaxis = self.fit_fiducials()
+        self.loop_profiler.start_tick()
+        # newest frame not fitted yet, copied into the tracking buffer
+        frame, metadata, sequence, frame_time = self.frame_grabber.get_newest_frame(out = self.tracking_frame)
+        if frame is None:
+            # no new frame since the last tick, nothing to correct
+            self.skipped_ticks += 1
+            self.loop_profiler.discard_tick()
+            return
+        image_number, hardware_time = pco.frame_identity(metadata)
+        if image_number is not None and image_number == self.last_fitted_image_number:
+            # same camera image as in the previous tick, fitting it again is useless
+            self.skipped_ticks += 1
+            self.loop_profiler.discard_tick()
+            return
+        self.tracking_frame = frame
+        self.loop_profiler.mark('frame')
+        selection = self.select_fiducials()
+        if selection is None:
+            fitted_fiducials = None
+            averaged_fiducials = range(self.number_of_fiducials)
+        else:
+            # only the best ones are used to measure the drift
+            best, rotated = selection
+            fitted_fiducials = sorted(best + rotated)
+            averaged_fiducials = best
+        centers, timeaxis = self.fit_fiducials(self.tracking_frame, fitted_fiducials)
+        self.last_fitted_image_number = image_number
+        self.loop_profiler.mark('localization')
         timestamp = timeaxis[0]
+        if not np.isnan(hardware_time):
+            # time axis from the camera clock, referred to the first tracked frame
+            if self.first_hardware_time is None:
+                self.first_hardware_time = hardware_time
+                self.first_frame_timestamp = timestamp
+            timestamp = self.first_frame_timestamp + hardware_time - self.first_hardware_time
+            self.time_base = 'camera'
         # print(self.centers_previous)
         # print(centers)
         error_x_sum = 0
         error_y_sum = 0
-        for i in range(self.number_of_fiducials):
+        for i in averaged_fiducials:
             error_y = self.initial_centers[i][0] - centers[i][0]
             error_x = self.initial_centers[i][1] - centers[i][1]
             error[i] = [error_x, error_y]
             # print(error_x, error_y)
             error_x_sum += error_x
             error_y_sum += error_y
-        error_x_avg = error_x_sum/self.number_of_fiducials
-        error_y_avg = error_y_sum/self.number_of_fiducials
+        error_x_avg = error_x_sum/len(averaged_fiducials)
+        error_y_avg = error_y_sum/len(averaged_fiducials)
         error_avg = np.array([error_x_avg, error_y_avg])
+        if self.kalman_filter:
+            # the correction sent in the previous tick has moved the error
+            self.drift_estimator.update(error_avg, timestamp, control = -self.applied_correction)
+            self.applied_correction = np.zeros(2)
         # uncomment for debugging
         # print('\n err_x %.0f nm / err_y %.0f nm' % (error_x_avg*1000, error_y_avg*1000))
         # send position of all fiducials to Frontend
         # first line is to check that all fiducials drift in the same way
         # be aware that if uncommented you should change the signal type slot also
         # self.sendFittedDataSignal.emit(centers, error, timeaxis)
+        if self.readout_roi_list is not None:
+            # display positions on the full ROI
+            offset_um = self.readout_offset*self.pixel_size/1000
+            centers = {i: centers[i] - offset_um for i in centers}
         self.sendFittedDataSignal.emit(centers, error_avg, timestamp)
         # store data to save drift vs time when the Lock and Track option is released
         if self.save_drift_data:
             self.timeaxis_to_save.append(timestamp)
             self.errors_to_save.append(error_avg)
+        self.loop_profiler.mark('error')
         # now correct drift if button is checked
         if self.correct_drift_flag:
+            if self.kalman_filter:
+                # error expected when the move takes effect: time elapsed since
+                # the frame was acquired plus the response of the piezo
+                lead_time = tm.perf_counter() - frame_time + piezo_response_time
+                error_to_correct = self.drift_estimator.predict(lead_time)
+            else:
+                error_to_correct = error_avg
             # PID calculation
             # assign parameters
             kp = self.pid_param_list[0]
             ki = self.pid_param_list[1]
             kd = self.pid_param_list[2]
             # proportional term
-            self.prop_correction = kp*error_avg
+            self.prop_correction = kp*error_to_correct
             # integral term
-            self.int_correction = self.int_correction + ki*error_avg*self.tracking_period_seconds
+            self.int_correction = self.int_correction + ki*error_to_correct*self.tracking_period_seconds
             # derivative term
             self.dev_correction = self.dev_correction + \
-                kd*(error_avg - self.last_error_avg)/self.tracking_period_seconds
-            self.last_error_avg = error_avg
+                kd*(error_to_correct - self.last_error_avg)/self.tracking_period_seconds
+            self.last_error_avg = error_to_correct
             # calculate correction in um
             correction = self.prop_correction + self.int_correction + self.dev_correction
+            self.loop_profiler.mark('pid')
             # call function to correct
-            self.correct_drift(error_avg, correction)
+            self.applied_correction = self.correct_drift(error_to_correct, correction)
+            self.loop_profiler.mark('piezo')
+        self.loop_profiler.end_tick()
         return
+
+    def get_loop_latency(self):
+        # rolling percentiles of each stage of call_pid and loop jitter, in ms
+        return self.loop_profiler.stats()
     
     def fit_single_fiducial(self, index):
         x1 = self.x1[index]
@@ -1084,26 +1481,264 @@ class Backend(QtCore.QObject):
         x_fitted, \
         y_fitted, \
         w0x_fitted, \
-        w0y_fitted = drift.fit_with_gaussian(frame_intensity, \
-                                             self.frame_coordinates[index], \
-                                             self.pixel_size, \
-                                             self.pixel_size)
-        self.centers[index] = np.array([x_fitted, y_fitted])
+        w0y_fitted = drift.localize_fiducials(self.localization_method, \
+                                              [frame_intensity], \
+                                              [self.frame_coordinates[index]], \
+                                              self.pixel_size, \
+                                              self.pixel_size, \
+                                              fit_states = [self.get_fit_state(index)])
+        self.centers[index] = np.array([x_fitted[0], y_fitted[0]])
         self.timeaxis[index] = timer() - self.start_tracking_time
         return
 
-    def fit_fiducials(self):
+    def set_registration_reference(self):
+        # the reference is the region covering all fiducials' ROIs in the current frame
+        self.union_x1 = min(self.x1.values())
+        self.union_x2 = max(self.x2.values())
+        self.union_y1 = min(self.y1.values())
+        self.union_y2 = max(self.y2.values())
+        reference_frame = self.image_np[self.union_x1:self.union_x2, self.union_y1:self.union_y2]
+        self.registration = drift.cross_correlation_tracker(reference_frame)
+        # centers of the ROIs, in um, only used to display the drift on the image
+        pixel_size_um = self.pixel_size/1000
+        self.reference_centers = {}
+        for i in range(self.number_of_fiducials):
+            self.reference_centers[i] = np.array([np.mean(self.frame_coordinates[i][0]), \
+                                                  np.mean(self.frame_coordinates[i][1])])*pixel_size_um
+        return
+
+    def register_fiducials(self, image):
+        # all fiducials share the global shift of the registered region
+        current_frame = image[self.union_x1:self.union_x2, self.union_y1:self.union_y2]
+        shift_x, shift_y = self.registration.measure_shift(current_frame)
+        pixel_size_um = self.pixel_size/1000
+        shift = np.array([shift_x, shift_y])*pixel_size_um
+        timestamp = timer() - self.start_tracking_time
+        for i in range(self.number_of_fiducials):
+            self.centers[i] = self.reference_centers[i] + shift
+            self.timeaxis[i] = timestamp
+        return self.centers, self.timeaxis
+
+    def get_fit_state(self, index):
+        # fit state is created on demand and reused between successive fits
+        # so each fit starts from the previous solution
+        if index not in self.fit_states:
+            self.fit_states[index] = drift.prepare_fit_state(self.frame_coordinates[index])
+        return self.fit_states[index]
+
+    def invalidate_fit_states(self):
+        # call it when ROIs, binning or pixel size change
+        self.fit_states = {}
+        # scores and fitting cost have to be measured again
+        self.fiducial_scores = {}
+        self.fit_cost_ms = np.nan
+        self.rotation_index = 0
+        return
+
+    def select_fiducials(self):
+        # fiducials to fit in this tick when there is a latency budget
+        # returns None (fit all) or the best ones (highest SNR) that fit in the
+        # budget and fiducial_rotation_slots of the others taken in turns,
+        # so their positions and scores stay up to date
+        N = self.number_of_fiducials
+        if self.latency_budget_ms <= 0 or np.isnan(self.fit_cost_ms) or \
+           self.localization_method == 'Cross-correlation' or self.fitting_pool is not None:
+            return None
+        number_of_best = max(int(self.latency_budget_ms/self.fit_cost_ms) - fiducial_rotation_slots, 1)
+        if number_of_best + fiducial_rotation_slots >= N:
+            return None
+        # fiducials never scored go first
+        scores = np.array([self.fiducial_scores.get(i, np.inf) for i in range(N)])
+        scores[np.isnan(scores)] = -np.inf
+        ranking = np.argsort(-scores, kind = 'stable')
+        best = sorted(ranking[:number_of_best])
+        others = sorted(ranking[number_of_best:])
+        rotated = [others[(self.rotation_index + k) % len(others)] for k in range(fiducial_rotation_slots)]
+        self.rotation_index += fiducial_rotation_slots
+        return best, rotated
+
+    @pyqtSlot(float)
+    def change_latency_budget(self, latency_budget_ms):
+        self.latency_budget_ms = latency_budget_ms
+        if self.latency_budget_ms > 0:
+            print('\nLatency budget set to {:.1f} ms per tick.'.format(self.latency_budget_ms))
+        else:
+            print('\nAll fiducials will be fitted every tick.')
+        return
+
+    def start_fitting_pool(self):
+        # the pool lives during the whole lock session
+        # ROIs, pixel size and method are sent once to each worker process
+        self.stop_fitting_pool()
+        if self.image_np is None:
+            print('No image available. Fiducials will be fitted in the main process.')
+            return
+        rois = {}
+        for i in range(self.number_of_fiducials):
+            rois[i] = (self.x1[i], self.x2[i], self.y1[i], self.y2[i], self.frame_coordinates[i])
+        self.fitting_pool = drift.fiducial_fitting_pool(self.image_np.shape, \
+                                                        self.image_np.dtype, \
+                                                        rois, \
+                                                        self.pixel_size, \
+                                                        self.localization_method)
+        return
+
+    def shrink_readout(self):
+        # reduce the camera ROI to the bounding box of the fiducials' ROIs
+        # snapped to the pco alignment rules, and remap the ROIs to it
+        # image_np is the camera image flipped along the columns:
+        # axis 0 runs along the rows and axis 1 along the columns in reverse order
+        if not self.viewTimer.isActive():
+            print('Lock-mode readout requires the live view. Reading the full ROI.')
+            return
+        starting_col, starting_row, final_col, final_row = self.roi_list
+        x1 = min(self.x1.values())
+        x2 = max(self.x2.values())
+        y1 = min(self.y1.values())
+        y2 = max(self.y2.values())
+        bounding_box = [final_col - y2 + 1, starting_row + x1, final_col - y1, starting_row + x2 - 1]
+        readout_roi_list = pco.snap_roi(*bounding_box, self.roi_list)
+        if readout_roi_list is None or readout_roi_list == list(self.roi_list):
+            print('Fiducials\' ROIs cannot be read with a smaller camera ROI. Reading the full ROI.')
+            return
+        print('\nLock-mode readout: camera ROI reduced to', readout_roi_list)
+        self.full_frame_shape = self.image_np.shape
+        self.full_frame_dtype = self.image_np.dtype
+        self.stop_liveview()
+        cam.set_roi(*readout_roi_list)
+        self.start_liveview(self.exposure_time_ms)
+        readout_shape = (readout_roi_list[3] - readout_roi_list[1] + 1, readout_roi_list[2] - readout_roi_list[0] + 1)
+        if not self.wait_for_frame(readout_shape):
+            # keep the full ROI, the indexes were not remapped yet
+            print('Lock-mode readout failed. Reading the full ROI.')
+            self.stop_liveview()
+            cam.set_roi(*self.roi_list)
+            self.start_liveview(self.exposure_time_ms)
+            self.wait_for_frame(self.full_frame_shape)
+            return
+        self.readout_roi_list = readout_roi_list
+        self.readout_offset = np.array([starting_row - readout_roi_list[1], readout_roi_list[2] - final_col])
+        self.remap_rois(self.readout_offset)
+        return
+
+    def remap_rois(self, offset):
+        # shift the fiducials' ROIs by offset (rows, columns of image_np)
+        for i in range(self.number_of_fiducials):
+            self.x1[i] += offset[0]
+            self.x2[i] += offset[0]
+            self.y1[i] += offset[1]
+            self.y2[i] += offset[1]
+            self.frame_coordinates[i] = self.frame_coordinates[i] + offset[:, None, None]
+        return
+
+    def restore_readout(self):
+        # back to the full camera ROI after a lock-mode readout
+        if self.readout_roi_list is None:
+            return
+        print('Restoring camera ROI to', self.roi_list)
+        # ROIs back to full ROI coordinates
+        self.remap_rois(-self.readout_offset)
+        self.readout_roi_list = None
+        self.readout_offset = np.array([0, 0])
+        self.invalidate_fit_states()
+        self.stop_liveview()
+        cam.set_roi(*self.roi_list)
+        self.start_liveview(self.exposure_time_ms)
+        self.wait_for_frame(self.full_frame_shape)
+        return
+
+    def wait_for_frame(self, shape):
+        # wait until the frame grabber delivers a frame with the new shape
+        timeout = min(readout_change_timeout, \
+                      readout_change_exposures*self.exposure_time_ms/1000 + 0.2) # in s
+        start_time = timer()
+        while timer() - start_time < timeout:
+            image, metadata, sequence, frame_time = self.frame_grabber.get_newest_frame(only_unseen = False)
+            if image is not None and image.shape == tuple(shape):
+                self.image_np = image
+                return True
+            tm.sleep(0.01)
+        print('Warning! No frame of {} pixels received after changing the camera ROI.'.format(shape))
+        return False
+
+    def get_full_frame(self):
+        # image_np on the full ROI, outside the lock-mode readout pixels are zero
+        if self.readout_roi_list is None:
+            return self.image_np
+        full_frame = np.zeros(self.full_frame_shape, dtype = self.full_frame_dtype)
+        number_of_rows, number_of_cols = self.image_np.shape
+        x1 = -self.readout_offset[0]
+        y1 = -self.readout_offset[1]
+        full_frame[x1:x1 + number_of_rows, y1:y1 + number_of_cols] = self.image_np
+        return full_frame
+
+    def stop_fitting_pool(self):
+        if self.fitting_pool is not None:
+            self.fitting_pool.close()
+            self.fitting_pool = None
+        return
+
+    def fit_fiducials(self, image = None, indexes = None):
+        # image defaults to the last displayed frame
+        # indexes of the fiducials to fit (default all), the others keep their previous center
+        if image is None:
+            image = self.image_np
+        if indexes is None:
+            indexes = list(range(self.number_of_fiducials))
+        previous_centers = self.centers
         self.centers = {}
         self.timeaxis = {}
+        if self.localization_method == 'Cross-correlation':
+            return self.register_fiducials(image)
         # find centers for all fiducials
-        # the for loop with a single thread is faster that parallelization with ThreadPoolExecutor 
+        # the for loop with a single thread is faster that parallelization with ThreadPoolExecutor
         # single threaded time in average is below 90 ms
         # multihreaded time in average is around 100 ms
+        # the batched Gaussian fit solves all ROIs at once (few ms for 10+ fiducials)
+        # Radial symmetry and Phasor take a few µs per ROI
         # start_time = tm.time()
         # with ThreadPoolExecutor(max_workers = 8) as executor:
             # results = executor.map(self.fit_single_fiducial, list_of_fiducials)
+        if self.fitting_pool is not None and self.fitting_pool.is_compatible(image):
+            # each worker process keeps its own fit states
+            x_fitted, \
+            y_fitted, \
+            w0x_fitted, \
+            w0y_fitted = self.fitting_pool.localize(image)
+            indexes = list(range(self.number_of_fiducials))
+        else:
+            start_time = tm.perf_counter()
+            frames_intensity = [image[self.x1[i]:self.x2[i], self.y1[i]:self.y2[i]] \
+                                for i in indexes]
+            frames_coordinates = [self.frame_coordinates[i] for i in indexes]
+            fit_states = [self.get_fit_state(i) for i in indexes]
+            x_fitted, \
+            y_fitted, \
+            w0x_fitted, \
+            w0y_fitted = drift.localize_fiducials(self.localization_method, \
+                                                  frames_intensity, \
+                                                  frames_coordinates, \
+                                                  self.pixel_size, \
+                                                  self.pixel_size, \
+                                                  fit_states = fit_states)
+            # moving average of the time to localize one fiducial
+            fit_cost_ms = (tm.perf_counter() - start_time)*1000/len(indexes)
+            if np.isnan(self.fit_cost_ms):
+                self.fit_cost_ms = fit_cost_ms
+            else:
+                self.fit_cost_ms = 0.8*self.fit_cost_ms + 0.2*fit_cost_ms
+            # rank fiducials by the quality of their fit
+            for k, i in enumerate(indexes):
+                if self.localization_method == 'Gaussian fit':
+                    self.fiducial_scores[i] = fit_states[k]['snr']
+                else:
+                    self.fiducial_scores[i] = drift.fiducial_snr(frames_intensity[k])
+        timestamp = timer() - self.start_tracking_time
         for i in range(self.number_of_fiducials):
-            self.fit_single_fiducial(i)
+            self.centers[i] = previous_centers.get(i)
+            self.timeaxis[i] = timestamp
+        for k, i in enumerate(indexes):
+            self.centers[i] = np.array([x_fitted[k], y_fitted[k]])
         # end_time = tm.time()
         # print(f'Single-threaded time: {end_time - start_time:.3f} s')
         # print(f'Multi-threaded time: {end_time - start_time:.3f} s')
@@ -1115,15 +1750,19 @@ class Backend(QtCore.QObject):
         error_y = float(error[1])
         correction_x = float(correction[0])
         correction_y = float(correction[1])
+        # returns the correction actually sent to the piezo, in um
+        applied_correction = np.zeros(2)
         # use the worker to send the instructions
         # only if the drift correction is larger than a threshold
         if abs(error_x) > self.correction_threshold:
             # print('correction x %.0f nm ' % (correction_x*1000))
             self.piezoWorker.move_relative('x', correction_x)
+            applied_correction[0] = correction_x
         if abs(error_y) > self.correction_threshold:
             # print('correction y %.0f nm' % (correction_y*1000))
             self.piezoWorker.move_relative('y', correction_y)
-        return
+            applied_correction[1] = correction_y
+        return applied_correction
     
     @pyqtSlot(bool, float)
     def take_picture(self, livebool, exposure_time_ms):
@@ -1153,16 +1792,22 @@ class Backend(QtCore.QObject):
         self.exposure_time_ms = exposure_time_ms # in ms, is float
         cam.set_exp_time(self.exposure_time_ms)
         cam.config_recorder()
+        # poll the camera twice per exposure, repeated frames are discarded
+        self.frame_grabber.start(self.exposure_time_ms/2)
         self.viewTimer.start(round(self.exposure_time_ms)) # ms
         return
             
     def update_view(self):
         # Image update while in Live view mode
-        self.image_np, metadata = cam.get_image()
+        # the camera is read by the frame grabber, just take its newest frame
+        image, metadata, sequence, frame_time = self.frame_grabber.get_newest_frame(only_unseen = False)
+        if image is None:
+            return
+        self.image_np = image
         # stop sending the image to the frontend (no liveview available)
         # when the stabilization is ON. It is not needed actually
         if not self.correct_drift_flag:
-            self.imageSignal.emit(self.image_np)
+            self.imageSignal.emit(self.get_full_frame())
         return
     
     def update_temp(self):
@@ -1185,6 +1830,7 @@ class Backend(QtCore.QObject):
     
     def stop_liveview(self):
         print('\nLive view stopped at', datetime.now())
+        self.frame_grabber.stop()
         cam.stop()
         self.viewTimer.stop()
         return
@@ -1204,7 +1850,14 @@ class Backend(QtCore.QObject):
         filename = "drift_curve_xy_" + timestr + ".dat"
         full_filename = os.path.join(self.file_path, filename)
         # save
+        # the analysis scripts read time_since_epoch and tracking_period from the
+        # first two header lines, new fields go after the existing ones
         header_txt = 'time_since_epoch %s s\ntracking_period %i s\ntime x_avg_error y_avg_error\ns um um' % (str(self.time_since_epoch), self.tracking_period)
+        # time_base is camera if the time axis comes from the hardware timestamps
+        header_txt += '\ntime_base %s' % self.time_base
+        stats = self.drift_estimator.innovation_stats()
+        if self.kalman_filter and stats is not None:
+            header_txt += '\nkalman_innovation_std %.4f %.4f um\nkalman_nis %.2f %.2f' % (tuple(stats['std']) + tuple(stats['nis']))
         np.savetxt(full_filename, data_to_save, fmt='%.3f', header=header_txt)
         print('Drift curve %s saved' % filename)
         return
@@ -1227,17 +1880,9 @@ class Backend(QtCore.QObject):
         header_txt = 'time_since_epoch %s s\nexposure_time %i ms\ntime intensity\ns au' % (str(self.time_since_epoch_for_roi), int(self.exposure_time_ms))
         np.savetxt(full_filename, data_to_save, fmt="%.3f", header=header_txt)
         print('ROI intensity curve %s saved' % filename)
-        # now save video
-        # print(self.roi_video_to_save[0])
-        # print(self.roi_video_to_save[0].shape)
-        roi_video_nparray = np.swapaxes(np.dstack(self.roi_video_to_save), 2, 0)
-        # create filename
-        timestr = datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
-        filename = "roi_video_" + timestr + ".tiff"
-        full_filename = os.path.join(self.file_path, filename)
-        # save
-        tiff.imwrite(full_filename, roi_video_nparray)
-        print('ROI video %s saved' % filename)
+        # the video has been streamed to disk while recording
+        if self.roi_video_recorder is not None:
+            print('ROI video saved as %s' % self.roi_video_filename)
         return
     
     @pyqtSlot(bool)
@@ -1257,7 +1902,7 @@ class Backend(QtCore.QObject):
         timestr = datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
         filename = "image_pco_" + timestr + ".tiff"
         full_filename = os.path.join(self.file_path, filename)
-        image_to_save = Image.fromarray(self.image_np)
+        image_to_save = Image.fromarray(self.get_full_frame())
         image_to_save.save(full_filename) 
         print('Image %s saved' % filename)
         return
@@ -1277,10 +1922,19 @@ class Backend(QtCore.QObject):
     @pyqtSlot(bool)
     def close_backend(self, main_app = True):
         print('Stopping pco camera...')
+        self.frame_grabber.stop()
         cam.stop()
         print('Stopping QtTimers...')
         self.viewTimer.stop()
         self.tempTimer.stop()
+        self.trackingTimer.stop()
+        self.stop_fitting_pool()
+        self.readout_roi_list = None
+        self.recordingTimer.stop()
+        self.stop_roi_video_recorder(wait = True)
+        self.loop_profiler.stop_log()
+        self.frame_driven_lock = False
+        self.frame_grabber.frame_callback = None
         if main_app:
             self.piezoWorker.updateTimer.stop()
             print('Shutting down piezo stage...')
@@ -1310,6 +1964,12 @@ class Backend(QtCore.QObject):
         frontend.dataIntensityROISignal.connect(self.receive_intensity_roi)
         frontend.pidParamChangedSignal.connect(self.new_pid_params)
         frontend.correctionThresholdChangedSignal.connect(self.correction_threshold_changed)
+        frontend.localizationMethodChangedSignal.connect(self.change_localization_method)
+        frontend.parallelFittingSignal.connect(self.change_parallel_fitting)
+        frontend.lockModeReadoutSignal.connect(self.change_lock_mode_readout)
+        frontend.trackingTriggerSignal.connect(self.change_tracking_trigger)
+        frontend.kalmanFilterSignal.connect(self.change_kalman_filter)
+        frontend.latencyBudgetSignal.connect(self.change_latency_budget)
         if self.connect_to_piezo_module:
             frontend.piezoWidget.make_connections(self.piezoWorker)
         return
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Read and update the z calibration parameters file.
+
+The default parameters (z_calibration_parameters.txt) are tracked by git.
+The automatic calibration writes its result to a local copy
+(z_calibration_parameters_local.txt, ignored by git), which is read instead
+of the default one when it exists.
+"""
+import os
+
+param_z_calib_default_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'z_calibration_parameters.txt')
+param_z_calib_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'z_calibration_parameters_local.txt')
+
+def read_z_calibration_params_file(filename, default_filename = param_z_calib_default_filename):
+    # returns None if there is no calibration file
+    # the default file is read if filename has not been written yet
+    if not os.path.exists(filename) and default_filename is not None:
+        filename = default_filename
+    try:
+        with open(filename, 'r') as file:
+            content = file.read()
+    except FileNotFoundError:
+        print(f"Warning: z calibration file '{filename}' not found")
+        return None
+    data_section = content.split("### INPUT MODIFY BELOW THIS LINE ###")[1]
+
+    # Parse the variables into a dictionary
+    config = {}
+    for line in data_section.split('\n'):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            if '=' in line:
+                key, value = line.split('=', 1)
+                config[key.strip()] = value.strip()
+    conversion_factor = float(config['conversion_factor'])
+    print('\nz calibration parameters are:')
+    print(config)
+    return conversion_factor
+
+def update_z_calibration_params_file(filename, conversion_factor=None, \
+                                     default_filename = param_z_calib_default_filename):
+    # the default file is the template if filename has not been written yet
+    try:
+        if os.path.exists(filename) or default_filename is None:
+            template_filename = filename
+        else:
+            template_filename = default_filename
+        with open(template_filename, 'r') as file:
+            lines = file.readlines()
+
+        # Find the header line index
+        header_index = -1
+        for i, line in enumerate(lines):
+            if "### INPUT MODIFY BELOW THIS LINE ###" in line:
+                header_index = i
+                break
+
+        if header_index == -1:
+            raise ValueError("Header not found in file")
+
+        # Modify lines after the header
+        for i in range(header_index + 1, len(lines)):
+            line = lines[i].strip()
+            if not line or line.startswith('#'):
+                continue
+
+            if conversion_factor is not None and line.startswith('conversion_factor ='):
+                lines[i] = f"conversion_factor = {str(conversion_factor)}\n"
+
+        # Write back to the file
+        with open(filename, 'w') as file:
+            file.writelines(lines)
+
+        print("File updated successfully!")
+
+    except FileNotFoundError:
+        print(f"Error: File '{filename}' not found")
+    except Exception as e:
+        print(f"Error: {e}")
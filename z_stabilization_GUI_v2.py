@@ -11,21 +11,26 @@ Fribourg, Switzerland
 
 import os
 import numpy as np
+import multiprocessing as mp
+from collections import deque
 from datetime import datetime
 from timeit import default_timer as timer
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui
 from PyQt5.QtCore import pyqtSignal, pyqtSlot
 from pyqtgraph.dockarea import Dock, DockArea
-from PIL import Image
 from tkinter import filedialog
 import tkinter as tk
 import time as tm
 import piezo_stage_z_GUI # it uses the single-channel piezo controller
 import viewbox_tools
-from scipy import ndimage
 # from PyQt5.QtWidgets import QFrame
 import thorlabs_camera_toolbox as tl_cam
+import loop_profiler_toolbox as profiler
+import drift_correction_toolbox as drift
+from z_calibration_auxiliaries import read_z_calibration_params_file, \
+                                      update_z_calibration_params_file, \
+                                      param_z_calib_filename
 
 #=====================================
 
@@ -33,13 +38,20 @@ import thorlabs_camera_toolbox as tl_cam
 
 #=====================================
 
-camera_constructor = tl_cam.load_Thorlabs_SDK_cameras()
-mono_cam, \
-mono_cam_flag, \
-mono_cam_sensor_width_pixels, \
-mono_cam_sensor_height_pixels, \
-mono_cam_sensor_pixel_width_um, \
-mono_cam_sensor_pixel_height_um = tl_cam.init_Thorlabs_mono_camera(camera_constructor)
+# the worker processes of the fiducial fitting pool (see fiducial_fitting_worker)
+# import the main script again, only the main process opens the camera
+if mp.parent_process() is None:
+    camera_constructor = tl_cam.load_Thorlabs_SDK_cameras()
+    mono_cam, \
+    mono_cam_flag, \
+    mono_cam_sensor_width_pixels, \
+    mono_cam_sensor_height_pixels, \
+    mono_cam_sensor_pixel_width_um, \
+    mono_cam_sensor_pixel_height_um = tl_cam.init_Thorlabs_mono_camera(camera_constructor)
+else:
+    camera_constructor = mono_cam = mono_cam_flag = None
+    mono_cam_sensor_width_pixels = mono_cam_sensor_height_pixels = None
+    mono_cam_sensor_pixel_width_um = mono_cam_sensor_pixel_height_um = None
 
 camera = mono_cam
 pixel_size_um = mono_cam_sensor_pixel_width_um
@@ -48,9 +60,22 @@ initial_filename = 'image_z_drift'
 # initial fake image
 initial_image_np = 128*np.ones((1080, 1440, 3))
 dummy_image_np = initial_image_np
+# number of frames sent to the Frontend whose image slots are not reused
+displayed_frames_kept = 2
+# number of frame arrivals used to measure the frame period (frame-driven tracking)
+frame_period_window = 8
 # timing parameterss
 initial_tracking_period = 200 # in ms
 initial_exp_time = 100 # in ms
+# save the timestamps of every stage of the tracking loop (binary file, see loop_profiler_toolbox)
+save_loop_latency_log = False
+# track on every new camera frame (frame available callback) instead of using the tracking period
+initial_frame_driven_tracking = False
+initial_frame_decimation = 1 # use 1 out of N frames
+# while locked, read from the sensor only a window around the reflection ROI
+# (requires the live view, the full sensor is read again when unlocking)
+initial_lock_mode_readout = False
+readout_margin = 16 # in px, around the reflection ROI
 driftbox_length = 10.0 # in s
 initial_gain = 0 # int
 
@@ -63,6 +88,9 @@ initial_horizontal_size = 1200
 # for center of mass estimation, float between 0.00 and 1.00
 # above 0.1 works better due to stray light from the NIR despite the filters
 initial_threshold = 0.8
+# peak fit of the spot projections around the center of mass: None (center of
+# mass only), 'parabolic' or 'gaussian' (see drift_correction_toolbox.z_spot_locator)
+spot_refinement = None
 
 # PID constants
 # tested with a 200 ms tracking period
@@ -84,6 +112,18 @@ initial_correction_threshold = 0.000
 # conversion factor is 0.0245 (take the absolute value)
 # initial_conversion_factor = 0.0257 # um/px
 initial_conversion_factor = 0.0257 # um/px
+# the last automatic calibration (see Backend.start_calibration) overrides it
+calibrated_conversion_factor = read_z_calibration_params_file(param_z_calib_filename)
+if calibrated_conversion_factor is not None:
+    initial_conversion_factor = calibrated_conversion_factor
+
+# automatic calibration of the conversion factor
+# the piezo is stepped through these offsets (relative to the current position)
+# and the reflection is measured in several frames at each step
+calibration_offsets = list(np.linspace(-0.5, 0.5, 11)) # in um
+calibration_frames_per_step = 5
+calibration_settling_time = 300 # in ms, after each step
+calibration_timeout = 2000 # in ms, without new frames
 
 #=====================================
 
@@ -110,6 +150,9 @@ class Frontend(QtGui.QFrame):
     stabilizationStatusChangedSignal = pyqtSignal(bool)
     conversionFactorChangedSignal = pyqtSignal(float)
     correctionThresholdChangedSignal = pyqtSignal(float)
+    trackingTriggerSignal = pyqtSignal(bool, int)
+    lockModeReadoutSignal = pyqtSignal(bool)
+    calibrateSignal = pyqtSignal(np.ndarray)
     
     def __init__(self, piezo_frontend, show_piezo_subGUI = True, main_app = True, \
                  connect_to_piezo_module = True, *args, **kwargs):
@@ -224,6 +267,26 @@ class Frontend(QtGui.QFrame):
         self.tracking_period_value.setToolTip('Period to measure fiducial markers\' position.')
         self.tracking_period_value.editingFinished.connect(self.tracking_period_changed_check)
         
+        # frame-driven tracking
+        self.frame_driven_tickbox = QtGui.QCheckBox('Track every new frame')
+        self.frame_driven_tickbox.setChecked(initial_frame_driven_tracking)
+        self.frame_driven_tickbox.setToolTip('Run the tracking once per new camera frame instead of using the tracking period.\n' \
+                                             'Live view is restarted if running. Can only be changed while unlocked.')
+        self.frame_driven_tickbox.stateChanged.connect(self.tracking_trigger_changed)
+        self.frame_decimation = initial_frame_decimation
+        self.frame_decimation_value = QtGui.QLineEdit(str(self.frame_decimation))
+        self.frame_decimation_value.setValidator(QtGui.QIntValidator(1, 1000))
+        self.frame_decimation_value.setToolTip('Decimation: use 1 out of N new frames.')
+        self.frame_decimation_value.editingFinished.connect(self.tracking_trigger_changed)
+        
+        # lock-mode readout
+        self.lock_mode_readout_tickbox = QtGui.QCheckBox('Lock-mode readout')
+        self.lock_mode_readout_tickbox.setChecked(initial_lock_mode_readout)
+        self.lock_mode_readout_tickbox.setToolTip('While locked, the sensor is read only around the reflection ROI (faster readout).\n' \
+                                                  'The full sensor is read again when unlocking. Requires the live view.\n' \
+                                                  'Can only be changed while unlocked.')
+        self.lock_mode_readout_tickbox.stateChanged.connect(self.lock_mode_readout_changed)
+        
         # stabilize
         self.stabilize_z_button = QtGui.QPushButton('Stabilize z position')
         self.stabilize_z_button.setToolTip('Stabilize sample in z axis.')
@@ -285,6 +348,10 @@ class Frontend(QtGui.QFrame):
         self.conversion_value = QtGui.QLineEdit(str(initial_conversion_factor))
         self.conversion_value.editingFinished.connect(self.conversion_factor_changed)
         self.conversion_factor = initial_conversion_factor
+        self.calibrate_button = QtGui.QPushButton('Calibrate conversion factor')
+        self.calibrate_button.setToolTip('Step the z piezo around the current position and fit the displacement of the reflection.\n' \
+                                         'Requires the live view and the ROI. The result is saved for the next sessions.')
+        self.calibrate_button.clicked.connect(self.calibrate)
 
         # drift threshold
         self.correction_threshold_label = QtGui.QLabel('Drift threshold (μm):')
@@ -359,21 +426,25 @@ class Frontend(QtGui.QFrame):
         layout_zLock.addWidget(self.lock_z_position_button,         7, 0, 1, 2)
         layout_zLock.addWidget(self.conversion_label,         8, 0)
         layout_zLock.addWidget(self.conversion_value,         8, 1)
-        layout_zLock.addWidget(self.tracking_period_label,         9, 0)
-        layout_zLock.addWidget(self.tracking_period_value,         9, 1)
-        layout_zLock.addWidget(self.stabilize_z_button,         10, 0, 1, 2)
-        layout_zLock.addWidget(self.correction_threshold_label,         11, 0)
-        layout_zLock.addWidget(self.correction_threshold_value,         11, 1)
-        layout_zLock.addWidget(self.pid_label,         12, 0)
-        layout_zLock.addWidget(self.kp_label,         13, 0)
-        layout_zLock.addWidget(self.kp_value,         13, 1)
-        layout_zLock.addWidget(self.ki_label,         14, 0)
-        layout_zLock.addWidget(self.ki_value,         14, 1)
-        layout_zLock.addWidget(self.kd_label,         15, 0)
-        layout_zLock.addWidget(self.kd_value,         15, 1)
+        layout_zLock.addWidget(self.calibrate_button,         9, 0, 1, 2)
+        layout_zLock.addWidget(self.tracking_period_label,         10, 0)
+        layout_zLock.addWidget(self.tracking_period_value,         10, 1)
+        layout_zLock.addWidget(self.frame_driven_tickbox,         11, 0)
+        layout_zLock.addWidget(self.frame_decimation_value,         11, 1)
+        layout_zLock.addWidget(self.lock_mode_readout_tickbox,         12, 0, 1, 2)
+        layout_zLock.addWidget(self.stabilize_z_button,         13, 0, 1, 2)
+        layout_zLock.addWidget(self.correction_threshold_label,         14, 0)
+        layout_zLock.addWidget(self.correction_threshold_value,         14, 1)
+        layout_zLock.addWidget(self.pid_label,         15, 0)
+        layout_zLock.addWidget(self.kp_label,         16, 0)
+        layout_zLock.addWidget(self.kp_value,         16, 1)
+        layout_zLock.addWidget(self.ki_label,         17, 0)
+        layout_zLock.addWidget(self.ki_value,         17, 1)
+        layout_zLock.addWidget(self.kd_label,         18, 0)
+        layout_zLock.addWidget(self.kd_value,         18, 1)
         
         # save drift
-        layout_zLock.addWidget(self.savedrift_tickbox,      16, 0, 2, 2)
+        layout_zLock.addWidget(self.savedrift_tickbox,      19, 0, 2, 2)
         
         # Place layouts and boxes
         dockArea = DockArea()
@@ -413,6 +484,26 @@ class Frontend(QtGui.QFrame):
             self.conversionFactorChangedSignal.emit(self.conversion_factor)
         return
 
+    def calibrate(self):
+        if not self.create_ROI_button.isChecked():
+            print('Warning! Calibration can only be done if the ROI has been created.')
+            return
+        if self.lock_z_position_button.isChecked():
+            print('Warning! Unlock before calibrating.')
+            return
+        _, coord_ROI = self.roi.getArrayRegion(self.image, \
+                                               self.img, \
+                                               axis = (1, 0), \
+                                               returnMappedCoords = True)
+        self.calibrateSignal.emit(coord_ROI)
+        return
+
+    @pyqtSlot(float)
+    def conversion_factor_calibrated(self, conversion_factor):
+        self.conversion_factor = conversion_factor
+        self.conversion_value.setText('{:.5f}'.format(conversion_factor))
+        return
+
     def threshold_changed_check(self):
         threshold = float(self.intensity_threshold_value.text())
         if threshold != self.threshold:
@@ -566,6 +657,9 @@ class Frontend(QtGui.QFrame):
             if self.create_ROI_button.isChecked():
                 self.roi_changed_check()
                 self.driftPlot.clear()
+                self.frame_driven_tickbox.setEnabled(False)
+                self.frame_decimation_value.setEnabled(False)
+                self.lock_mode_readout_tickbox.setEnabled(False)
                 self.lockAndTrackSignal.emit(True)
                 N = int(driftbox_length*1000/self.tracking_period)
                 self.error_to_plot = np.zeros(N)
@@ -574,10 +668,29 @@ class Frontend(QtGui.QFrame):
                 print('Warning! Lock and Track can only be used if the ROI has been created.')
         else:
             self.lockAndTrackSignal.emit(False)
+            self.frame_driven_tickbox.setEnabled(True)
+            self.frame_decimation_value.setEnabled(True)
+            self.lock_mode_readout_tickbox.setEnabled(True)
             if self.savedrift_bool:
                 self.savedriftSignal.emit()
             self.z_reflection.clear()
         return
+
+    def lock_mode_readout_changed(self):
+        self.lockModeReadoutSignal.emit(self.lock_mode_readout_tickbox.isChecked())
+        return
+
+    def tracking_trigger_changed(self):
+        decimation_text = self.frame_decimation_value.text()
+        if decimation_text.isdigit() and int(decimation_text) > 0:
+            self.frame_decimation = int(decimation_text)
+        else:
+            # empty or invalid decimation (e.g. the tick box was toggled while
+            # editing it), keep the current one
+            self.frame_decimation_value.setText(str(self.frame_decimation))
+        self.trackingTriggerSignal.emit(self.frame_driven_tickbox.isChecked(), \
+                                        self.frame_decimation)
+        return
     
     def retrieve_reflection_data(self):
         (self.data_ROI, \
@@ -654,6 +767,9 @@ class Frontend(QtGui.QFrame):
         # remove lock and track
         self.lock_z_position_button.setChecked(False)
         self.lockAndTrackSignal.emit(False)
+        self.frame_driven_tickbox.setEnabled(True)
+        self.frame_decimation_value.setEnabled(True)
+        self.lock_mode_readout_tickbox.setEnabled(True)
         self.z_reflection.clear()
         # remove live acquisition
         self.liveViewSignal.emit(False, 0) # the exposure time is not relevant
@@ -686,6 +802,7 @@ class Frontend(QtGui.QFrame):
         backend.sendFittedDataSignal.connect(self.receive_cm_data)
         backend.liveview_stopped_signal.connect(self.liveview_stopped)
         backend.liveview_started_signal.connect(self.liveview_started)
+        backend.conversionFactorCalibratedSignal.connect(self.conversion_factor_calibrated)
         if self.connect_to_piezo_module:
             backend.piezoWorker.make_connections(self.piezoWidget)
         return
@@ -701,9 +818,12 @@ class Backend(QtCore.QObject):
     imageSignal = pyqtSignal(np.ndarray)
     filePathSignal = pyqtSignal(str)
     getReflectionDataSignal = pyqtSignal()
+    conversionFactorCalibratedSignal = pyqtSignal(float)
     sendFittedDataSignal = pyqtSignal(np.ndarray, np.ndarray, float)
     liveview_stopped_signal = pyqtSignal()
     liveview_started_signal = pyqtSignal()
+    # emitted from the camera SDK thread, queued to this thread
+    newFrameSignal = pyqtSignal(np.ndarray)
     
     def __init__(self, piezo_z, piezo_backend, connect_to_piezo_module = True, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -711,10 +831,17 @@ class Backend(QtCore.QObject):
         self.piezo_stage_z = piezo_z
         self.piezoWorker = piezo_backend
         self.viewTimer = QtCore.QTimer()
+        # reusable buffers for the camera frames
+        self.frame_slots = tl_cam.image_slots()
         self.image_np = initial_image_np
+        # frames sent to the Frontend, their slots are kept until newer ones are sent
+        self.displayed_frames = deque()
         self.trackingTimer = QtCore.QTimer()
         self.tracking_period = initial_tracking_period
         self.threshold = initial_threshold
+        # buffers are reallocated when the ROI changes
+        self.spot_locator = drift.z_spot_locator((initial_vertical_size, initial_horizontal_size), \
+                                                 self.threshold, refinement = spot_refinement)
         self.file_path = initial_filepath
         self.pid_param_list = [initial_kp, initial_ki, initial_kd]
         self.stabilization_flag = False
@@ -724,6 +851,29 @@ class Backend(QtCore.QObject):
         self.exposure_time_ms = initial_exp_time
         self.correction_threshold = initial_correction_threshold
         self.time_since_epoch = '0'
+        # timestamps of each stage of call_pid
+        self.loop_profiler = profiler.loop_profiler(['center of mass', 'error', 'pid', 'piezo'], \
+                                                    self.tracking_period)
+        # period used by the PID, in ms
+        self.pid_period = self.tracking_period
+        self.frame_driven_tracking = initial_frame_driven_tracking
+        self.frame_decimation = initial_frame_decimation
+        self.lock_mode_readout = initial_lock_mode_readout
+        self.frame_callback_set = False
+        self.frame_driven_lock = False
+        # frame count and arrival time of the last frames of the callback
+        self.frame_arrivals = deque(maxlen = frame_period_window)
+        self.newFrameSignal.connect(self.new_frame_available)
+        # sensor ROI while locked, None means full sensor
+        self.readout_roi = None
+        self.readout_offset = np.array([0, 0]) # rows, cols
+        self.readout_shape = None
+        # new frames counter, to know when the next frame has arrived
+        self.frame_counter = 0
+        # automatic calibration (see start_calibration), one step per timeout
+        self.calibrationTimer = QtCore.QTimer()
+        self.calibrationTimer.setSingleShot(True)
+        self.calibration_running = False
         return
     
     @pyqtSlot(bool, float)    
@@ -746,14 +896,14 @@ class Backend(QtCore.QObject):
             self.stop_liveview()
         tl_cam.set_camera_one_picture_mode(camera)
         self.frame_time = tl_cam.set_exp_time(camera, self.exposure_time_ms)
-        image_np, image_pil, flag_ok = tl_cam.get_mono_image(camera)
+        image_np, flag_ok = tl_cam.get_mono_image_into(camera, self.frame_slots)
         tl_cam.stop_camera(camera)
         if flag_ok:
-            self.image_np = image_np
+            self.set_image(image_np)
         else:
-            self.image_np = dummy_image_np
+            self.set_image(dummy_image_np)
         # emit
-        self.imageSignal.emit(self.image_np)
+        self.send_image()
         return            
         
     @pyqtSlot(bool, float)
@@ -767,6 +917,11 @@ class Backend(QtCore.QObject):
 
     def start_liveview(self, exposure_time_ms):
         print('\nLive view started at', datetime.now())
+        # the frame period changes with the exposure time and the readout ROI
+        self.frame_arrivals.clear()
+        if self.frame_driven_tracking:
+            # frames are pushed by the camera instead of polled
+            self.frame_callback_set = tl_cam.set_frame_available_callback(camera, self.frame_received)
         tl_cam.set_camera_continuous_mode(camera)
         self.exposure_time_ms = exposure_time_ms # in ms, is float
         self.frame_time = tl_cam.set_exp_time(camera, self.exposure_time_ms)
@@ -777,21 +932,44 @@ class Backend(QtCore.QObject):
     
     def update_view(self):
         # Image update while in Live view mode
-        image_np, image_pil, flag_ok = tl_cam.get_mono_image(camera)
-        # if there's no error send image, otherwise stop livewview
-        if flag_ok:
-            self.image_np = image_np
-        else:
-            print('Displaying last taken image.')
+        # with the frame available callback image_np is already the newest frame
+        if not self.frame_callback_set:
+            image_np, flag_ok = tl_cam.get_mono_image_into(camera, self.frame_slots)
+            # if there's no error send image, otherwise stop livewview
+            if flag_ok:
+                self.set_image(image_np)
+                self.frame_counter += 1
+            else:
+                print('Displaying last taken image.')
         # stop sending the image to the frontend (no liveview available)
         # when the stabilization is ON. It is not needed actually
-        if not self.stabilization_flag:
-            self.imageSignal.emit(self.image_np)
+        # nor while the lock-mode readout is active (frames are a small window)
+        if not self.stabilization_flag and self.readout_roi is None:
+            self.send_image()
+        return
+
+    def set_image(self, image_np):
+        # new current frame, the slot of the previous one is released
+        self.frame_slots.release(self.image_np)
+        self.image_np = image_np
+        return
+
+    def send_image(self):
+        # the Frontend keeps a reference to the image to paint it, so its slot
+        # stays in use until displayed_frames_kept newer frames are sent
+        self.frame_slots.hold(self.image_np)
+        self.displayed_frames.append(self.image_np)
+        if len(self.displayed_frames) > displayed_frames_kept:
+            self.frame_slots.release(self.displayed_frames.popleft())
+        self.imageSignal.emit(self.image_np)
         return
         
     def stop_liveview(self):
         print('\nLive view stopped at', datetime.now())
         tl_cam.stop_camera(camera)
+        if self.frame_callback_set:
+            tl_cam.clear_frame_available_callback(camera)
+            self.frame_callback_set = False
         self.viewTimer.stop()
         self.liveview_stopped_signal.emit()
         return
@@ -800,14 +978,79 @@ class Backend(QtCore.QObject):
     def change_tracking_period(self, lockbool, new_tracking_period):
         print('Tracking period changed to {:.3f} s.'.format(new_tracking_period/1000))
         self.tracking_period = new_tracking_period
-        if lockbool:
+        if lockbool and not self.frame_driven_lock:
+            self.pid_period = self.tracking_period
+            self.loop_profiler.reset(self.tracking_period)
             print('Restarting QtTimer...')
             self.trackingTimer.stop()
             self.trackingTimer.start(self.tracking_period)
         return
     
+    def frame_received(self, image, frame_count):
+        # runs in the camera SDK thread, image is only valid during this call
+        # it is copied into a free slot, if there is none (this thread is more
+        # than a few frames behind) the frame is dropped
+        self.frame_arrivals.append((frame_count, tm.perf_counter()))
+        frame = self.frame_slots.fill(image)
+        if frame is None:
+            return
+        self.newFrameSignal.emit(frame)
+        return
+
+    @pyqtSlot(np.ndarray)
+    def new_frame_available(self, frame):
+        self.set_image(frame)
+        self.frame_counter += 1
+        # frame-driven tracking: call_pid once per new frame (or every N frames)
+        if self.frame_driven_lock:
+            self.frames_since_last_tick += 1
+            if self.frames_since_last_tick >= self.frame_decimation:
+                self.frames_since_last_tick = 0
+                # the frame rate changes with the readout ROI, keep the PID period updated
+                self.pid_period = self.frame_driven_period()
+                self.call_pid()
+        return
+
+    def frame_driven_period(self):
+        # period of the frame-driven loop in ms, from the measured frame period
+        # the camera frame time is only used until two frames have been received
+        arrivals = np.array(self.frame_arrivals)
+        frame_period_ms = self.frame_time
+        if arrivals.shape[0] >= 2:
+            frame_counts = np.diff(arrivals[:, 0])
+            arrival_times = np.diff(arrivals[:, 1])
+            valid = frame_counts > 0
+            if np.any(valid):
+                frame_period_ms = np.median(arrival_times[valid]/frame_counts[valid])*1000
+        return frame_period_ms*self.frame_decimation
+
+    @pyqtSlot(bool)
+    def change_lock_mode_readout(self, readout_bool):
+        self.lock_mode_readout = readout_bool
+        if self.lock_mode_readout:
+            print('\nSensor readout will be reduced to the reflection ROI while locked.')
+        else:
+            print('\nFull sensor will be read while locked.')
+        return
+
+    @pyqtSlot(bool, int)
+    def change_tracking_trigger(self, frame_driven_bool, decimation):
+        self.frame_driven_tracking = frame_driven_bool
+        self.frame_decimation = max(decimation, 1)
+        if self.frame_driven_tracking:
+            print('Tracking on 1 out of {} new frames.'.format(self.frame_decimation))
+        else:
+            print('Tracking every {:.3f} s.'.format(self.tracking_period/1000))
+        # the frame available callback can only be changed while the camera is disarmed
+        if self.viewTimer.isActive() and self.frame_driven_tracking != self.frame_callback_set:
+            self.stop_liveview()
+            self.start_liveview(self.exposure_time_ms)
+        return
+
     def call_pid(self):
+        self.loop_profiler.start_tick()
         center, timestamp = self.calculate_center_of_mass()
+        self.loop_profiler.mark('center of mass')
         error_x_px = self.initial_center[0] - center[0]
         error_y_px = self.initial_center[1] - center[1]
         error_px =  np.array([error_x_px, error_y_px])
@@ -818,6 +1061,7 @@ class Backend(QtCore.QObject):
         if self.save_drift_data:
             self.timeaxis_to_save.append(timestamp)
             self.errors_to_save.append(error)
+        self.loop_profiler.mark('error')
         # now correct drift if button is checked
         if self.stabilization_flag:
             # PID calculation
@@ -828,17 +1072,24 @@ class Backend(QtCore.QObject):
             # proportional term
             self.prop_correction = kp*error
             # integral term
-            self.int_correction = self.int_correction + ki*error*self.tracking_period
+            self.int_correction = self.int_correction + ki*error*self.pid_period
             # derivative term
             self.dev_correction = self.dev_correction + \
-                kd*(error - self.last_error)/self.tracking_period
+                kd*(error - self.last_error)/self.pid_period
             self.last_error = error
             # calculate correction in um
             correction = self.prop_correction + self.int_correction + self.dev_correction
+            self.loop_profiler.mark('pid')
             # call function to correct
             self.correct_drift(error, correction)
+            self.loop_profiler.mark('piezo')
+        self.loop_profiler.end_tick()
         return
 
+    def get_loop_latency(self):
+        # rolling percentiles of each stage of call_pid and loop jitter, in ms
+        return self.loop_profiler.stats()
+
     def correct_drift(self, error, correction):
         # y axis will be ignored cause the setup uses only lateral shifts
         # make float32 to avoid crashing the module
@@ -857,6 +1108,8 @@ class Backend(QtCore.QObject):
 
     @pyqtSlot(bool)
     def start_stop_tracking(self, trackbool):
+        # the piezo position is not polled while locked
+        self.piezoWorker.set_stabilization_lock('z', trackbool)
         if trackbool:
             print('Locking and tracking z reflection...')
             # initiating variables
@@ -871,11 +1124,33 @@ class Backend(QtCore.QObject):
             self.start_tracking_time = timer()
             # ask for ROI data and coordinates
             self.get_reflection_data()
-            # start timer
-            self.trackingTimer.start(self.tracking_period)
+            if self.frame_driven_tracking and not self.frame_callback_set:
+                print('Frame-driven tracking requires the live view. Using the tracking period.')
+            frame_driven_bool = self.frame_driven_tracking and self.frame_callback_set
+            if frame_driven_bool:
+                # the PID runs at the frame rate divided by the decimation
+                # updated on every tick, the readout ROI may still change
+                self.pid_period = self.frame_driven_period()
+            else:
+                self.pid_period = self.tracking_period
+            self.loop_profiler.reset(self.pid_period)
+            if save_loop_latency_log:
+                timestr = datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
+                filename = "loop_latency_z_" + timestr + ".bin"
+                self.loop_profiler.start_log(os.path.join(self.file_path, filename))
+            if frame_driven_bool:
+                self.frames_since_last_tick = 0
+                self.frame_driven_lock = True
+            else:
+                # start timer
+                self.trackingTimer.start(self.tracking_period)
         else:
             self.trackingTimer.stop()
+            self.frame_driven_lock = False
             print('Unlocking...')
+            self.restore_readout()
+            self.loop_profiler.report()
+            self.loop_profiler.stop_log()
         return
     
     def get_reflection_data(self):
@@ -885,24 +1160,167 @@ class Backend(QtCore.QObject):
     @pyqtSlot(np.ndarray, bool)
     def receive_roi_data(self, roi_coordinates, append_drift_bool):
         self.save_drift_data = append_drift_bool
+        self.set_roi_indexes(roi_coordinates)
+        print('Finding initial coordinates...')
+        self.initial_center, _ = self.calculate_center_of_mass()
+        print('Done.')
+        if self.lock_mode_readout:
+            self.shrink_readout()
+        return
+
+    def set_roi_indexes(self, roi_coordinates):
         # set indexes for ROI
         self.x1 = int(roi_coordinates[0,0,0])
         self.x2 = int(roi_coordinates[0,-1,0]) + 1
         self.y1 = int(roi_coordinates[1,0,0])
         self.y2 = int(roi_coordinates[1,0,-1]) + 1
         # then frame_intensity is self.image_np[x1:x2, y1:y2]
-        print('Finding initial coordinates...')
-        self.initial_center, _ = self.calculate_center_of_mass()
-        print('Done.')
+        self.spot_locator.allocate((self.x2 - self.x1, self.y2 - self.y1))
+        return
+
+    @pyqtSlot(np.ndarray)
+    def start_calibration(self, roi_coordinates):
+        # steps the piezo through calibration_offsets and measures the reflection
+        # in calibration_frames_per_step new frames at each step
+        # it runs step by step on calibrationTimer, so the thread is never blocked
+        if self.calibration_running:
+            print('Calibration already running.')
+            return
+        if not self.viewTimer.isActive():
+            print('Calibration requires the live view.')
+            return
+        if self.trackingTimer.isActive() or self.frame_driven_lock:
+            print('Unlock before calibrating.')
+            return
+        print('\nCalibrating the conversion factor...')
+        self.set_roi_indexes(roi_coordinates)
+        self.calibration_offsets = np.array(calibration_offsets)
+        self.calibration_centers = np.full((len(self.calibration_offsets), calibration_frames_per_step), np.nan)
+        self.calibration_step_index = 0
+        self.calibration_frame_index = 0
+        self.calibration_position = 0
+        self.calibration_running = True
+        self.move_calibration_piezo(self.calibration_offsets[0])
+        self.calibration_last_frame = self.frame_counter
+        self.calibration_wait_start = timer()
+        self.calibrationTimer.start(calibration_settling_time)
+        return
+
+    def move_calibration_piezo(self, offset):
+        # offset relative to the position before the calibration, in um
+        self.piezoWorker.move_relative('z', float(offset - self.calibration_position))
+        self.calibration_position = offset
+        return
+
+    def calibration_step(self):
+        # measure the newest frame, then wait for the next frame or move to the next step
+        if not self.calibration_running:
+            return
+        if self.frame_counter == self.calibration_last_frame:
+            if (timer() - self.calibration_wait_start)*1000 > calibration_timeout:
+                print('No new frames. Calibration aborted.')
+                self.stop_calibration()
+                return
+            self.calibrationTimer.start(max(1, round(self.frame_time/4)))
+            return
+        self.calibration_last_frame = self.frame_counter
+        self.calibration_wait_start = timer()
+        if self.image_np.ndim == 2 and self.image_np.shape[0] >= self.x2 and self.image_np.shape[1] >= self.y2:
+            cm_y, cm_x = self.spot_locator.locate(self.image_np[self.x1:self.x2, self.y1:self.y2])
+            self.calibration_centers[self.calibration_step_index, self.calibration_frame_index] = cm_x
+        self.calibration_frame_index += 1
+        if self.calibration_frame_index < calibration_frames_per_step:
+            self.calibrationTimer.start(max(1, round(self.frame_time/4)))
+            return
+        self.calibration_frame_index = 0
+        self.calibration_step_index += 1
+        if self.calibration_step_index < len(self.calibration_offsets):
+            self.move_calibration_piezo(self.calibration_offsets[self.calibration_step_index])
+            self.calibration_last_frame = self.frame_counter
+            self.calibrationTimer.start(calibration_settling_time)
+            return
+        self.stop_calibration()
+        self.finish_calibration()
+        return
+
+    def stop_calibration(self):
+        # back to the initial position
+        self.calibrationTimer.stop()
+        if self.calibration_running:
+            self.move_calibration_piezo(0)
+            self.calibration_running = False
+        return
+
+    def finish_calibration(self):
+        # fit displacement (px) vs offset (um), the slope is in px/um
+        offsets = np.repeat(self.calibration_offsets[:, np.newaxis], calibration_frames_per_step, axis = 1)
+        slope, intercept, residual_scale = drift.robust_linear_fit(offsets, self.calibration_centers)
+        if not np.isfinite(slope) or abs(slope) < 1e-3:
+            print('Calibration failed. Conversion factor not changed.')
+            return
+        conversion_factor = 1/abs(slope) # in um/px
+        print('Slope {:.2f} px/um, residuals {:.2f} px (robust std).'.format(slope, residual_scale))
+        self.new_conversion_factor(conversion_factor)
+        self.conversionFactorCalibratedSignal.emit(conversion_factor)
+        update_z_calibration_params_file(param_z_calib_filename, conversion_factor = round(conversion_factor, 6))
+        # keep the raw data of the calibration
+        data_to_save = np.column_stack((offsets.ravel(), self.calibration_centers.ravel()))
+        timestr = datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
+        filename = "z_calibration_" + timestr + ".dat"
+        full_filename = os.path.join(self.file_path, filename)
+        header_txt = 'slope %.4f px/um\nconversion_factor %.6f um/px\noffset center\num px' % (slope, conversion_factor)
+        np.savetxt(full_filename, data_to_save, fmt='%.3f', header=header_txt)
+        print('Calibration data %s saved' % filename)
+        return
+
+    def shrink_readout(self):
+        # read only the reflection ROI plus a margin
+        # the camera is re-armed, so it only works in live view
+        if not self.viewTimer.isActive():
+            print('Lock-mode readout requires the live view. Reading the full sensor.')
+            return
+        self.stop_liveview()
+        roi = tl_cam.set_roi(camera, self.y1 - readout_margin, self.x1 - readout_margin, \
+                             self.y2 - 1 + readout_margin, self.x2 - 1 + readout_margin)
+        if roi is not None:
+            if roi[0] > self.y1 or roi[1] > self.x1 or roi[2] < self.y2 - 1 or roi[3] < self.x2 - 1:
+                print('Camera ROI does not contain the reflection ROI. Reading the full sensor.')
+                tl_cam.set_roi(camera, *tl_cam.get_full_roi(camera))
+            else:
+                self.readout_roi = roi
+                self.readout_offset = np.array([roi[1], roi[0]])
+                self.readout_shape = (roi[3] - roi[1] + 1, roi[2] - roi[0] + 1)
+        self.start_liveview(self.exposure_time_ms)
+        return
+
+    def restore_readout(self):
+        # back to the full sensor
+        if self.readout_roi is None:
+            return
+        live_bool = self.viewTimer.isActive()
+        if live_bool:
+            self.stop_liveview()
+        tl_cam.set_roi(camera, *tl_cam.get_full_roi(camera))
+        self.readout_roi = None
+        self.readout_offset = np.array([0, 0])
+        self.readout_shape = None
+        if live_bool:
+            self.start_liveview(self.exposure_time_ms)
         return
     
     def calculate_center_of_mass(self):
         # find center of mass
-        frame_roi_intensity = self.image_np[self.x1:self.x2, self.y1:self.y2]
-        roi_threshold = self.threshold*np.max(frame_roi_intensity)
-        frame_roi_th = np.where(frame_roi_intensity > roi_threshold, frame_roi_intensity, 0)
-        cm_y, cm_x = ndimage.center_of_mass(frame_roi_th) # vertical, horizontal
+        # frames taken before the readout change are still full frames
+        if self.image_np.shape[:2] == self.readout_shape:
+            row_offset, col_offset = self.readout_offset
+        else:
+            row_offset, col_offset = 0, 0
+        # the ROI is a view, the locator works on its own buffers
+        cm_y, cm_x = self.spot_locator.locate(self.image_np[self.x1 - row_offset:self.x2 - row_offset, \
+                                                            self.y1 - col_offset:self.y2 - col_offset]) # vertical, horizontal
         # print(cm_y, cm_x)
+        # relative to the reflection ROI, the same sensor region with or
+        # without the lock-mode readout
         center = np.array([cm_x, cm_y])
         timeaxis = timer() - self.start_tracking_time
         return center, timeaxis
@@ -910,6 +1328,7 @@ class Backend(QtCore.QObject):
     @pyqtSlot(float)
     def new_threshold(self, new_threshold):
         self.threshold = new_threshold
+        self.spot_locator.threshold = new_threshold
         print('Intesity threshold has been changed to %.2f.' % self.threshold)        
         return
 
@@ -940,7 +1359,7 @@ class Backend(QtCore.QObject):
                                                                         pid_param_list[1], \
                                                                         pid_param_list[2]))
         self.pid_param_list = pid_param_list
-        if lockbool:
+        if lockbool and not self.frame_driven_lock:
             print('Restarting QtTimer...')
             self.trackingTimer.stop()
             self.trackingTimer.start(self.tracking_period)
@@ -948,7 +1367,7 @@ class Backend(QtCore.QObject):
     
     @pyqtSlot(float)
     def new_conversion_factor(self, new_conv_factor):
-        print('Conversion factor changed to {:.1f} μm/px'.format(new_conv_factor))
+        print('Conversion factor changed to {:.4f} μm/px'.format(new_conv_factor))
         self.conversion_factor = new_conv_factor
         return
     
@@ -974,7 +1393,7 @@ class Backend(QtCore.QObject):
         timestr = datetime.today().strftime('%Y-%m-%d_%H-%M-%S')
         filename = "inspec_cam_pic_" + timestr + ".jpg"
         full_filename = os.path.join(self.file_path, filename)
-        image_to_save = Image.fromarray(self.image_np)
+        image_to_save = tl_cam.to_pil_image(self.image_np)
         image_to_save.save(full_filename) 
         print('Image %s saved' % filename)
         return
@@ -1006,6 +1425,10 @@ class Backend(QtCore.QObject):
         print('Stopping timers...')
         self.viewTimer.stop()
         self.trackingTimer.stop()
+        self.stop_calibration()
+        self.frame_driven_lock = False
+        self.loop_profiler.stop_log()
+        self.restore_readout()
         if main_app:
             self.piezoWorker.updateTimer.stop()
             print('Shutting down piezo stage...')
@@ -1035,6 +1458,9 @@ class Backend(QtCore.QObject):
         frontend.conversionFactorChangedSignal.connect(self.new_conversion_factor)
         frontend.gainChangedSignal.connect(self.change_gain)
         frontend.correctionThresholdChangedSignal.connect(self.correction_threshold_changed)
+        frontend.trackingTriggerSignal.connect(self.change_tracking_trigger)
+        frontend.lockModeReadoutSignal.connect(self.change_lock_mode_readout)
+        frontend.calibrateSignal.connect(self.start_calibration)
         if self.connect_to_piezo_module:
             frontend.piezoWidget.make_connections(self.piezoWorker)
         return
@@ -1062,9 +1488,11 @@ if __name__ == '__main__':
     workerThread = QtCore.QThread()
     worker.trackingTimer.moveToThread(workerThread)
     worker.viewTimer.moveToThread(workerThread)
+    worker.calibrationTimer.moveToThread(workerThread)
     # configure the connection to allow queued executions to avoid interruption of previous calls
     worker.viewTimer.timeout.connect(worker.update_view, QtCore.Qt.QueuedConnection)
     worker.trackingTimer.timeout.connect(worker.call_pid, QtCore.Qt.QueuedConnection) 
+    worker.calibrationTimer.timeout.connect(worker.calibration_step, QtCore.Qt.QueuedConnection)
     worker.piezoWorker.updateTimer.moveToThread(workerThread)
     worker.piezoWorker.updateTimer.timeout.connect(worker.piezoWorker.read_position)
     worker.piezoWorker.moveToThread(workerThread)